@@ -0,0 +1,200 @@
+# Bottom depth lookup from a local tiled copy of the GEBCO grid, replacing the per-transect reads of
+# matlab/utils/get_gebco_bathy.m.
+#
+# The GEBCO netCDF file is converted once into a folder of tiles:
+#   tiles.json           the grid axes (start, step, size), the tile size, the storage dtype, the fingerprint of
+#                        the source file and the file, first row/column and shape of each tile
+#   tile_<r>_<c>.bin     raw (rows x cols) array of the heights of one tile, memory mapped to read
+# Each tile holds tile_size x tile_size grid cells plus the row and column shared with its neighbours, so the four
+# corners of any cell are in one tile. On a global grid the last column of tiles wraps around to the first grid
+# column, which closes the -180/180 (or 0/360) seam. The index is written last, so an interrupted conversion is
+# redone on the next run.
+import os
+import json
+import argparse
+import threading
+from pathlib import Path
+from functools import lru_cache
+from collections import OrderedDict
+
+import numpy as np
+from netCDF4 import Dataset
+
+from utils import HDF5_LOCK
+from profile_cache import file_fingerprint
+
+TILE_INDEX = 'tiles.json'
+TILE_FORMAT = 1
+# 5 degree tiles of the 15 arc second GEBCO grid, about 2.9 MB each as int16
+TILE_SIZE = 1200
+# tiles kept memory mapped per service
+MAX_TILES = 64
+
+
+def _axis(values):
+    """(start, step, size) of a regularly spaced, increasing grid axis"""
+    values = np.asarray(values, dtype=float)
+    step = (values[-1] - values[0]) / (len(values) - 1)
+    if step <= 0 or not np.allclose(np.diff(values), step, rtol=0, atol=1e-6 * step + 1e-9):
+        raise ValueError('the bathymetry grid axes must be regularly spaced and increasing')
+    return float(values[0]), float(step), len(values)
+
+
+def _cells(size, tile_size, wrap):
+    """First and last+1 grid cell of each tile along an axis, a cell being the span from a grid line to the next"""
+    n_cells = size if wrap else size - 1
+    starts = np.arange(0, n_cells, tile_size)
+    return [(int(start), int(min(start + tile_size, n_cells))) for start in starts]
+
+
+def convert_gebco(gebco_file, tiles_dir, tile_size=TILE_SIZE):
+    """
+    Convert a GEBCO netCDF file (lat, lon and elevation or height) into the memory mappable tiles of tiles_dir,
+    reading one band of tile rows at a time.
+    :return: the tile index
+    """
+    tiles_dir = Path(tiles_dir)
+    tiles_dir.mkdir(parents=True, exist_ok=True)
+    with HDF5_LOCK, Dataset(gebco_file) as ds:
+        lat_name = 'lat' if 'lat' in ds.variables else 'latitude'
+        lon_name = 'lon' if 'lon' in ds.variables else 'longitude'
+        height_name = 'elevation' if 'elevation' in ds.variables else 'height'
+        lat0, lat_step, n_lat = _axis(ds[lat_name][:])
+        lon0, lon_step, n_lon = _axis(ds[lon_name][:])
+        height = ds[height_name]
+        # keep GEBCO's int16 heights, unless missing values need NaN
+        masked = any(att in height.ncattrs() for att in ('_FillValue', 'missing_value'))
+        dtype = height.dtype if np.issubdtype(height.dtype, np.integer) and not masked else np.dtype(np.float32)
+
+    wrap = abs(n_lon * lon_step - 360) < lon_step / 2
+    print('Converting %s (%d x %d) into %s tiles of %d cells' % (gebco_file, n_lat, n_lon, dtype, tile_size))
+    tiles = {}
+    for row_first, row_last in _cells(n_lat, tile_size, False):
+        with HDF5_LOCK, Dataset(gebco_file) as ds:
+            band = ds[height_name][row_first:row_last + 1, :]
+        if np.issubdtype(dtype, np.integer):
+            band = np.ma.getdata(band).astype(dtype)
+        else:
+            band = np.ma.filled(np.ma.asarray(band).astype(dtype), np.nan)
+        for col_first, col_last in _cells(n_lon, tile_size, wrap):
+            # the column shared with the next tile is the first grid column at the seam
+            cols = np.arange(col_first, col_last + 1) % n_lon
+            tile = np.ascontiguousarray(band[:, cols])
+            name = 'tile_%d_%d.bin' % (row_first // tile_size, col_first // tile_size)
+            tmp_path = tiles_dir / (name + '.tmp')
+            tile.tofile(tmp_path)
+            os.replace(tmp_path, tiles_dir / name)
+            tiles['%d_%d' % (row_first // tile_size, col_first // tile_size)] = {
+                'file': name, 'row': row_first, 'col': col_first, 'shape': list(tile.shape)}
+
+    file_size, mtime = file_fingerprint(str(gebco_file))
+    index = {'format': TILE_FORMAT, 'source': str(Path(gebco_file).resolve()), 'size': file_size, 'mtime': mtime,
+             'lat': [lat0, lat_step, n_lat], 'lon': [lon0, lon_step, n_lon], 'wrap': bool(wrap),
+             'tile_size': tile_size, 'dtype': np.dtype(dtype).str, 'tiles': tiles}
+    tmp_path = tiles_dir / (TILE_INDEX + '.tmp')
+    tmp_path.write_text(json.dumps(index))
+    os.replace(tmp_path, tiles_dir / TILE_INDEX)
+    return index
+
+
+def _read_tile_index(tiles_dir, gebco_file=None):
+    """The tile index of tiles_dir, None if there is none or it was converted from another version of gebco_file"""
+    index_path = Path(tiles_dir) / TILE_INDEX
+    if not index_path.exists():
+        return None
+    index = json.loads(index_path.read_text())
+    if index.get('format') != TILE_FORMAT:
+        return None
+    if gebco_file is not None and os.path.exists(gebco_file):
+        if (index['size'], index['mtime']) != tuple(file_fingerprint(str(gebco_file))):
+            return None
+    return index
+
+
+@lru_cache(maxsize=None)
+def open_bathymetry(tiles_dir, gebco_file=None, max_tiles=MAX_TILES):
+    """
+    The bathymetry service of a tiles folder, shared by every caller of the process, converting gebco_file into
+    tiles_dir first if it has no tiles yet or gebco_file changed since.
+    :param max_tiles: number of most recently used tiles kept memory mapped
+    :return: dict of the tile index, the folder and the LRU of open tiles, for bathymetry_depths
+    """
+    index = _read_tile_index(tiles_dir, gebco_file)
+    if index is None:
+        if gebco_file is None:
+            raise FileNotFoundError('no bathymetry tiles in %s, give the GEBCO file to convert' % tiles_dir)
+        index = convert_gebco(gebco_file, tiles_dir)
+    return {'index': index, 'folder': Path(tiles_dir), 'tiles': OrderedDict(), 'max_tiles': max_tiles,
+            'lock': threading.Lock()}
+
+
+def _tile(service, key):
+    """Memory mapped heights of one tile, through the LRU of the service"""
+    with service['lock']:
+        tiles = service['tiles']
+        if key in tiles:
+            tiles.move_to_end(key)
+            return tiles[key]
+        entry = service['index']['tiles'][key]
+        tile = np.memmap(service['folder'] / entry['file'], dtype=np.dtype(service['index']['dtype']), mode='r',
+                         shape=tuple(entry['shape']))
+        tiles[key] = tile
+        if len(tiles) > service['max_tiles']:
+            tiles.popitem(last=False)
+        return tile
+
+
+def bathymetry_depths(service, lats, lons):
+    """
+    Bottom depths (positive down) at lats, lons, interpolated bilinearly in the tiles of an open_bathymetry service.
+    Longitudes may be given in -180/180 or 0/360. Points outside the grid or with NaN positions get NaN.
+    """
+    index = service['index']
+    lat0, lat_step, n_lat = index['lat']
+    lon0, lon_step, n_lon = index['lon']
+    tile_size = index['tile_size']
+    wrap = index['wrap']
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    shape = np.broadcast(lats, lons).shape
+    lats, lons = np.broadcast_to(lats, shape).ravel(), np.broadcast_to(lons, shape).ravel()
+
+    # fractional grid positions, longitudes taken east of the first grid column
+    fi = (lats - lat0) / lat_step
+    fj = np.mod(lons - lon0, 360) / lon_step
+    n_cells_lon = n_lon if wrap else n_lon - 1
+    valid = (fi >= 0) & (fi <= n_lat - 1) & (fj >= 0) & (fj <= n_cells_lon)
+    # points on the last grid line fall in the last cell
+    i0 = np.minimum(np.floor(np.where(valid, fi, 0)), n_lat - 2).astype(np.int64)
+    j0 = np.minimum(np.floor(np.where(valid, fj, 0)), n_cells_lon - 1).astype(np.int64)
+    wi = np.where(valid, fi, 0) - i0
+    wj = np.where(valid, fj, 0) - j0
+
+    heights = np.full(len(lats), np.nan)
+    rows = np.flatnonzero(valid)
+    tile_rows, tile_cols = i0[rows] // tile_size, j0[rows] // tile_size
+    keys = tile_rows * (n_lon // tile_size + 1) + tile_cols
+    order = np.argsort(keys, kind='stable')
+    rows, keys = rows[order], keys[order]
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    for group in np.split(np.arange(len(rows)), bounds):
+        if len(group) == 0:
+            continue
+        pts = rows[group]
+        tile_row, tile_col = i0[pts[0]] // tile_size, j0[pts[0]] // tile_size
+        tile = _tile(service, '%d_%d' % (tile_row, tile_col))
+        i = i0[pts] - tile_row * tile_size
+        j = j0[pts] - tile_col * tile_size
+        a, b = wi[pts], wj[pts]
+        heights[pts] = (1 - a) * ((1 - b) * tile[i, j] + b * tile[i, j + 1]) + \
+            a * ((1 - b) * tile[i + 1, j] + b * tile[i + 1, j + 1])
+    return -heights.reshape(shape)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a GEBCO netCDF file into memory mapped bathymetry tiles')
+    parser.add_argument('gebco_file', help='GEBCO netCDF file')
+    parser.add_argument('tiles_dir', help='folder to write the tiles to')
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE, help='grid cells per tile side (default: 1200)')
+    args = parser.parse_args()
+    convert_gebco(args.gebco_file, args.tiles_dir, tile_size=args.tile_size)
@@ -0,0 +1,96 @@
+# Reading a SOOP line from one file per transect against its per-line archive (line_archive.py): synthetic transects
+# (see bench_write.py) are written both ways, then the whole line, one transect and a one year window are read back.
+# Reported are the files opened, the bytes on disk and the read time of each, plus the time to append the transects
+# to the archive, first all at once and then one more transect to a full archive.
+#
+# usage: python benchmarks/bench_archive.py [--transects 200] [--profiles 40 200] [--repeats 3]
+
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import io
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from line_config import load_line_registry, DEFAULT_LINE
+from write2netcdf import write_payload_nc
+from line_archive import append_transects, archive_path, read_transect, read_window, read_transect_file
+from bench_write import synthetic_payload
+
+
+def best_time(function, repeats):
+    """(best seconds of repeats calls of function, its last result)"""
+    seconds = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - t0)
+    return seconds, result
+
+
+def read_files(files, start=None, end=None):
+    """Read transect files, keeping the profiles from start to end, the way a user of the per-transect files does"""
+    times = []
+    for f in files:
+        payload = read_transect_file(f)
+        keep = np.ones(len(payload['TIME']), dtype=bool)
+        if start is not None:
+            keep &= (payload['TIME'] >= np.datetime64(start)) & (payload['TIME'] < np.datetime64(end))
+        times.append(payload['TIME'][keep])
+    return np.concatenate(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Read times of per-transect files and per-line archives')
+    parser.add_argument('--transects', type=int, default=200)
+    parser.add_argument('--profiles', type=int, nargs=2, default=[40, 200],
+                        help='range of profiles per transect (default: 40 200)')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    v_grid = np.asarray(load_line_registry('soopLines.csv')[DEFAULT_LINE]['v_grid'])
+    rng = np.random.default_rng(args.seed)
+    payloads = [synthetic_payload(rng, i, rng.integers(*args.profiles), v_grid) for i in range(args.transects)]
+    n_profiles = sum(len(p['TIME']) for p in payloads)
+    print(f"{args.transects} transects, {n_profiles} profiles of line IX22")
+
+    with tempfile.TemporaryDirectory() as folder:
+        files_folder, archive_dir = Path(folder) / 'transects', Path(folder) / 'archive'
+        files_folder.mkdir()
+        with contextlib.redirect_stdout(io.StringIO()):
+            files = [write_payload_nc(files_folder, p) for p in payloads]
+        archive = archive_path(archive_dir, 'IX22')
+        append_seconds, _ = best_time(lambda: append_transects(archive, payloads[:-1]), 1)
+        append_one_seconds, _ = best_time(lambda: append_transects(archive, payloads[-1:]), 1)
+        print(f"archive: {append_seconds:.2f} s to append {args.transects - 1} transects, "
+              f"{append_one_seconds * 1000:.1f} ms to append one more")
+
+        transect = str(payloads[args.transects // 2]['transect_id'][0])
+        year = pd.Timestamp(payloads[args.transects // 2]['TIME'][0])
+        start, end = year.strftime('%Y-01-01'), (year + pd.DateOffset(years=1)).strftime('%Y-01-01')
+        window_files = [f for f, p in zip(files, payloads) if p['TIME'][-1] >= np.datetime64(start)
+                        and p['TIME'][0] < np.datetime64(end)]
+        reads = {'whole line': (lambda: read_files(files), len(files),
+                                lambda: read_window(archive)['TIME']),
+                 'one transect': (lambda: read_files([files_folder / f'{transect}.nc']), 1,
+                                  lambda: read_transect(archive, transect)['TIME']),
+                 f'year {year.year}': (lambda: read_files(window_files, start, end), len(window_files),
+                                       lambda: read_window(archive, start, end)['TIME'])}
+
+        files_bytes = sum(f.stat().st_size for f in files)
+        print(f"on disk: {len(files)} files {files_bytes / 1e6:.1f} MB, archive {archive.stat().st_size / 1e6:.1f} MB")
+        print(f"{'read':>14} {'files opened':>13} {'files s':>9} {'archive s':>10} {'speedup':>8}")
+        for name, (from_files, n_opened, from_archive) in reads.items():
+            files_seconds, times_files = best_time(from_files, args.repeats)
+            archive_seconds, times_archive = best_time(from_archive, args.repeats)
+            if len(times_files) != len(times_archive):
+                raise RuntimeError(f'{name}: {len(times_files)} profiles from the files, {len(times_archive)} from '
+                                   f'the archive')
+            print(f"{name:>14} {n_opened:>6} vs 1 {files_seconds:>9.3f} {archive_seconds:>10.3f} "
+                  f"{files_seconds / archive_seconds:>7.1f}x")
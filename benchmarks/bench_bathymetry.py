@@ -0,0 +1,96 @@
+# Benchmark the bottom depth lookup of the tiled bathymetry service (bathymetry.py) against
+# grid_horizontal.gebco_depths, which reads the region around each transect from the GEBCO netCDF file as
+# matlab/utils/get_gebco_bathy.m does. The GEBCO file is synthetic: a global int16 grid of smooth ridges and basins
+# at --resolution arc minutes. Transects are tracks of a few hundred points, some crossing the 180 meridian with
+# longitudes in 0/360.
+#
+# usage: python benchmarks/bench_bathymetry.py [--resolution 2] [--transects 200] [--points 300]
+
+import io
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from bathymetry import convert_gebco, open_bathymetry, bathymetry_depths
+from grid_horizontal import gebco_depths
+
+
+def synthetic_gebco(path, resolution, rng):
+    """Write a global GEBCO-like file of cell centred lat, lon and int16 elevation every resolution arc minutes"""
+    step = resolution / 60
+    lat = -90 + step / 2 + step * np.arange(int(round(180 / step)))
+    lon = -180 + step / 2 + step * np.arange(int(round(360 / step)))
+    with Dataset(path, 'w') as nc:
+        nc.createDimension('lat', len(lat))
+        nc.createDimension('lon', len(lon))
+        nc.createVariable('lat', 'f8', ('lat',))[:] = lat
+        nc.createVariable('lon', 'f8', ('lon',))[:] = lon
+        elevation = nc.createVariable('elevation', 'i2', ('lat', 'lon'))
+        phase = rng.uniform(0, 2 * np.pi, 4)
+        for first in range(0, len(lat), 500):
+            la = np.radians(lat[first:first + 500])[:, None]
+            lo = np.radians(lon)[None, :]
+            elevation[first:first + 500, :] = (-3000 + 2500 * np.sin(3 * lo + phase[0]) * np.cos(2 * la + phase[1])
+                                               + 800 * np.sin(17 * lo + phase[2]) * np.sin(11 * la + phase[3])
+                                               ).astype(np.int16)
+
+
+def synthetic_tracks(rng, n_transects, n_points):
+    """Tracks of n_points positions, a third of them crossing the 180 meridian in 0/360 longitudes"""
+    tracks = []
+    for i in range(n_transects):
+        lat = rng.uniform(-60, 0) + np.linspace(0, rng.uniform(5, 25), n_points)
+        if i % 3 == 0:
+            lon = rng.uniform(165, 175) + np.linspace(0, rng.uniform(10, 20), n_points)
+        else:
+            lon = rng.uniform(-170, 150) + np.linspace(0, rng.uniform(5, 25), n_points)
+        tracks.append((lat, lon))
+    return tracks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bottom depth lookup time, tiled service against GEBCO reads')
+    parser.add_argument('--resolution', type=float, default=2, help='grid spacing of the synthetic GEBCO, arc min')
+    parser.add_argument('--transects', type=int, default=200)
+    parser.add_argument('--points', type=int, default=300, help='positions per transect')
+    parser.add_argument('--tile-size', type=int, default=1200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    tracks = synthetic_tracks(rng, args.transects, args.points)
+    with tempfile.TemporaryDirectory() as folder:
+        gebco_file = str(Path(folder) / 'gebco.nc')
+        synthetic_gebco(gebco_file, args.resolution, rng)
+        print(f"synthetic GEBCO {Path(gebco_file).stat().st_size / 1e6:.0f} MB, "
+              f"{args.transects} transects of {args.points} points")
+
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index = convert_gebco(gebco_file, Path(folder) / 'tiles', tile_size=args.tile_size)
+        convert_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        direct = [gebco_depths(gebco_file, lat, lon) for lat, lon in tracks]
+        direct_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        service = open_bathymetry(str(Path(folder) / 'tiles'))
+        tiled = [bathymetry_depths(service, lat, lon) for lat, lon in tracks]
+        tiled_seconds = time.perf_counter() - t0
+
+    direct, tiled = np.concatenate(direct), np.concatenate(tiled)
+    both = ~np.isnan(direct)
+    print(f"conversion {convert_seconds:.2f} s into {len(index['tiles'])} tiles")
+    print(f"{'lookup':>10} {'seconds':>8} {'transects/s':>12} {'NaN':>6}")
+    print(f"{'netCDF':>10} {direct_seconds:>8.2f} {args.transects / direct_seconds:>12.1f} {np.sum(~both):>6}")
+    print(f"{'tiles':>10} {tiled_seconds:>8.3f} {args.transects / tiled_seconds:>12.1f} "
+          f"{np.sum(np.isnan(tiled)):>6}")
+    print(f"speedup {direct_seconds / tiled_seconds:.0f}x, max difference {np.max(np.abs(direct - tiled)[both]):.1e} m")
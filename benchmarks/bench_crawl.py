@@ -0,0 +1,100 @@
+# Benchmark the THREDDS crawler against a local HTTP stand-in of a THREDDS server.
+# The stand-in serves catalog.xml pages from a folder, either recorded pages laid out as on the server
+# (e.g. <folder>/thredds/catalog/IMOS/SOOP/SOOP-XBT/DELAYED/catalog.xml) or a synthetic tree of catalogs,
+# with an optional delay per request to mimic the latency of the real server.
+#
+# usage: python benchmarks/bench_crawl.py [--pages <folder> --root thredds/catalog/.../catalog.xml]
+#                                         [--depth 3 --fanout 4 --files 20] [--latency 0.05] [--concurrency 1 4 8 16]
+
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from thredds_crawler import crawl_thredds
+
+CATALOG_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.1">\n'
+                '  <service name="all" serviceType="Compound" base="">\n'
+                '    <service name="odap" serviceType="OPENDAP" base="/thredds/dodsC/"/>\n'
+                '  </service>\n')
+
+
+def write_synthetic_catalogs(folder, depth, fanout, files):
+    """Write a tree of catalog.xml pages, depth levels of fanout sub catalogs with files datasets in each leaf"""
+    def write(rel_dir, level):
+        lines = [CATALOG_HEAD, f'  <dataset name="{rel_dir}" ID="{rel_dir}">\n']
+        if level < depth:
+            for i in range(fanout):
+                lines.append(f'    <catalogRef xlink:href="sub{i}/catalog.xml" xlink:title="sub{i}" name=""/>\n')
+                write(f'{rel_dir}/sub{i}', level + 1)
+        else:
+            for i in range(files):
+                name = f'IMOS_SOOP-XBT_T_{level}{i:04d}_FV01.nc'
+                lines.append(f'    <dataset name="{name}" ID="{rel_dir}/{name}" urlPath="{rel_dir}/{name}"/>\n')
+        lines.append('  </dataset>\n</catalog>\n')
+        path = Path(folder) / 'thredds' / 'catalog' / rel_dir / 'catalog.xml'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(''.join(lines))
+
+    write('IMOS/SOOP/SOOP-XBT/DELAYED', 0)
+    return 'thredds/catalog/IMOS/SOOP/SOOP-XBT/DELAYED/catalog.xml'
+
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    """Serve files from a folder, sleeping latency seconds before each response"""
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(folder, latency):
+    """Start the stand-in server on a free local port, returning the server and its base url"""
+    handler = partial(type('Handler', (SlowHandler,), {'latency': latency}), directory=str(folder))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='THREDDS crawl time against concurrency on a local stand-in server')
+    parser.add_argument('--pages', default=None, help='folder of recorded catalog.xml pages (default: synthetic)')
+    parser.add_argument('--root', default=None, help='path of the root catalog under --pages')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of delay per request')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.pages is None:
+            folder = tmp
+            root = write_synthetic_catalogs(folder, args.depth, args.fanout, args.files)
+        else:
+            folder, root = args.pages, args.root
+        server, base_url = serve(folder, args.latency)
+        n_catalogs = sum(1 for _ in Path(folder).rglob('catalog.xml'))
+        print(f"{n_catalogs} catalogs, {args.latency * 1000:.0f} ms per request")
+
+        print(f"{'concurrency':>12} {'seconds':>9} {'files':>7} {'catalogs/s':>11} {'speedup':>8}")
+        baseline = None
+        for concurrency in args.concurrency:
+            t0 = time.perf_counter()
+            file_urls = crawl_thredds([base_url + root], max_concurrency=concurrency)
+            elapsed = time.perf_counter() - t0
+            baseline = baseline or elapsed
+            print(f"{concurrency:>12} {elapsed:>9.2f} {len(file_urls):>7} {n_catalogs / elapsed:>11.1f} "
+                  f"{baseline / elapsed:>8.2f}")
+        server.shutdown()
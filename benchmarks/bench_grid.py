@@ -0,0 +1,127 @@
+# Benchmark the horizontal objective mapping of grid_horizontal against a line by line port of hinterp_objmap in
+# matlab/grid_simple.m (kept below as the reference), which solves four small systems per station and depth level.
+# Sections are synthetic: a thermocline along the section, profiles ending at random depths and a few missing
+# values, or the transect files written by transect_vertical_grid for one line.
+#
+# usage: python benchmarks/bench_grid.py [--stations 50 200] [--repeats 3]
+#        python benchmarks/bench_grid.py --input <folder of transect files> --line IX28
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from grid_horizontal import (hinterp_objmap, grid_transect, read_transect_nc, make_unique, distance, line_grid,
+                             EFOLD_SMALL, NOISE_LARGE, NOISE_SMALL)
+
+
+def hinterp_objmap_loop(temp, x, maxp, pr_grid, x_grid, efold1):
+    """hinterp_objmap of grid_simple.m as written in MATLAB, one station interval and depth level at a time"""
+    zinterp = np.full((len(x_grid), len(pr_grid)), np.nan)
+    n = len(x)
+    for i in range(n - 1):
+        if i >= n - 2:
+            ih = np.nonzero(x[i] <= x_grid)[0]
+        else:
+            ih = np.nonzero((x[i] <= x_grid) & (x_grid < x[i + 1]))[0]
+        if len(ih) == 0:
+            continue
+        x_h = np.interp(x_grid[ih], x[i:i + 2], [i, i + 1], left=np.nan, right=np.nan)
+        irange = np.arange(max(0, i - 6), min(i + 8, n))
+        for j in range(len(pr_grid)):
+            z1 = temp[irange, j]
+            if np.all(np.isnan(z1)):
+                continue
+            ig = ~np.isnan(z1)
+            x1 = irange[ig].astype(float)
+            z1 = z1[ig]
+            xn = x1[:, None] - x1[None, :]
+            gaus1 = np.exp(-xn ** 2 / efold1 ** 2)
+            acov1 = gaus1 + np.eye(len(x1)) * NOISE_LARGE
+            mred = np.linalg.solve(acov1, z1).sum() / np.linalg.solve(acov1, np.ones(len(x1))).sum()
+            z1 = z1 - mred
+            w1 = np.linalg.solve(acov1, z1)
+            zlarge = gaus1 @ w1
+            acov2 = np.exp(-np.abs(xn) / EFOLD_SMALL) + np.eye(len(x1)) * NOISE_SMALL
+            w2 = np.linalg.solve(acov2, z1 - zlarge)
+            xh = x1[None, :] - x_h[:, None]
+            zinterp[ih, j] = mred + np.exp(-xh ** 2 / efold1 ** 2) @ w1 + np.exp(-np.abs(xh) / EFOLD_SMALL) @ w2
+    maxpinterp = np.interp(x_grid, x, maxp, left=np.nan, right=np.nan)
+    zinterp[np.asarray(pr_grid)[None, :] > maxpinterp[:, None]] = np.nan
+    return zinterp, maxpinterp
+
+
+def synthetic_section(rng, n_stations, depth):
+    """(temp, x, maxp, x_grid) of a section of n_stations about 10 km apart over a shelf and a deep basin"""
+    x = np.cumsum(rng.uniform(5e3, 15e3, n_stations))
+    x_grid = np.arange(x[0], x[-1], 11e3)
+    maxp = np.where(np.arange(n_stations) < n_stations // 5, 300.0, 4000.0) + rng.uniform(0, 50, n_stations)
+    thermocline = rng.uniform(200, 600)
+    surface = 20 + 5 * np.sin(x / x[-1] * np.pi)
+    temp = 2 + (surface[:, None] - 2) * np.exp(-depth[None, :] / thermocline) + \
+        rng.normal(0, 0.05, (n_stations, len(depth)))
+    max_depths = np.minimum(rng.uniform(700, 1800, n_stations), maxp)
+    temp[depth[None, :] > max_depths[:, None]] = np.nan
+    temp[rng.random(temp.shape) < 0.002] = np.nan
+    return temp, x, maxp, x_grid
+
+
+def section_inputs(transect, line):
+    """The hinterp_objmap inputs of a whole transect file, sorted as grid_transect sorts it, gaps not split"""
+    settings = line_grid(line)
+    gridded = grid_transect(transect, line)
+    if gridded is None:
+        return None
+    x = make_unique(np.r_[0, np.cumsum(distance(gridded['LONGITUDE'], gridded['LATITUDE']))])
+    in_grid = ~np.isnan(gridded['LAT_grid'] + gridded['LON_grid'])
+    x_grid = np.r_[0, np.cumsum(distance(gridded['LON_grid'][in_grid], gridded['LAT_grid'][in_grid]))]
+    return gridded['TEMP'], x, np.full(len(x), np.nan), x_grid, settings['efold']
+
+
+def best_time(function, args, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Objective mapping time, batched solves against the MATLAB loop')
+    parser.add_argument('--stations', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--input', default=None, help='folder of transect files to grid instead of synthetic sections')
+    parser.add_argument('--line', default=None, help='line of the transect files in --input')
+    parser.add_argument('--efold', type=float, default=40)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    depth = np.arange(0, 1810, 10).astype(float)
+    sections = []
+    if args.input is None:
+        rng = np.random.default_rng(args.seed)
+        for n in args.stations:
+            temp, x, maxp, x_grid = synthetic_section(rng, n, depth)
+            sections.append((f'synthetic {n}', (temp, x, maxp, depth, x_grid, args.efold)))
+    else:
+        filenames = [f for f in os.listdir(args.input) if f.endswith('.nc') and f.split('-')[0] in args.line]
+        for filename in sorted(filenames):
+            transect = read_transect_nc(os.path.join(args.input, filename))
+            inputs = section_inputs(transect, args.line)
+            if inputs is not None:
+                temp, x, maxp, x_grid, efold = inputs
+                sections.append((filename, (temp, x, maxp, transect['DEPTH'], x_grid, efold)))
+
+    print(f"{'section':>24} {'stations':>9} {'loop s':>8} {'batched s':>10} {'speedup':>8} {'max diff':>9}")
+    for name, section_args in sections:
+        loop_seconds, (loop_z, _) = best_time(hinterp_objmap_loop, section_args, 1)
+        batched_seconds, (batched_z, _) = best_time(hinterp_objmap, section_args, args.repeats)
+        assert np.array_equal(np.isnan(loop_z), np.isnan(batched_z))
+        max_diff = np.nanmax(np.abs(loop_z - batched_z)) if np.any(~np.isnan(loop_z)) else 0
+        print(f"{name:>24} {len(section_args[0]):>9} {loop_seconds:>8.2f} {batched_seconds:>10.3f} "
+              f"{loop_seconds / batched_seconds:>8.1f} {max_diff:>9.1e}")
@@ -0,0 +1,51 @@
+# Benchmark the ingestion stage (reading, QC and vertical interpolation of every file)
+# for the thread and process backends of transect_vertical_grid.load_profiles against worker count.
+#
+# usage: python benchmarks/bench_ingest.py <input_directory> [--workers 1 2 4 8] [--files-per-task 64]
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from transect_vertical_grid import load_profiles
+
+
+def time_ingest(filepaths, v_grid, backend, max_workers, files_per_task, repeats=1):
+    """Return the best wall time of load_profiles over repeats runs"""
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        load_profiles(filepaths, v_grid, backend=backend, max_workers=max_workers, files_per_task=files_per_task)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == "__main__":
+    n_cpus = os.cpu_count()
+    parser = argparse.ArgumentParser(description='Ingestion speedup against worker count')
+    parser.add_argument('input_directory', help='folder of XBT .nc files')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({w for w in [1, 2, 4, 8, 16, 32] if w <= n_cpus} | {n_cpus}))
+    parser.add_argument('--backends', nargs='+', default=['thread', 'process'])
+    parser.add_argument('--files-per-task', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=1)
+    args = parser.parse_args()
+
+    filepaths = sorted(os.path.join(args.input_directory, f) for f in os.listdir(args.input_directory)
+                       if f.endswith('.nc') and 'TEST' not in f)
+    v_grid = np.arange(0, 1800 + 10, 10)
+    print(f"{len(filepaths)} files, {n_cpus} CPUs, {args.files_per_task} files per task")
+
+    # baseline is a single thread worker
+    baseline = time_ingest(filepaths, v_grid, 'thread', 1, args.files_per_task, args.repeats)
+    print(f"{'backend':>8} {'workers':>8} {'seconds':>9} {'files/s':>9} {'speedup':>8}")
+    for backend in args.backends:
+        for workers in args.workers:
+            elapsed = time_ingest(filepaths, v_grid, backend, workers, args.files_per_task, args.repeats)
+            print(f"{backend:>8} {workers:>8} {elapsed:>9.2f} {len(filepaths) / elapsed:>9.1f} "
+                  f"{baseline / elapsed:>8.2f}")
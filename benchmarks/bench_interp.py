@@ -0,0 +1,69 @@
+# Benchmark the batched Gaussian interpolation of interp_gaussian (vinterp_gauss_batch) against calling
+# vinterp_gauss_simple once per profile, as process_single_file did. Profiles are XBT-like: float32 depths every
+# 0.67 m rounded to the cm as in the IMOS files, down to 80-100% of a T4, T5 or T7 probe's rated depth, and a
+# thermocline with noise. The largest difference between the two results is reported with the times.
+#
+# usage: python benchmarks/bench_interp.py [--profiles 10000] [--repeats 3]
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from interp_gaussian import vinterp_gauss_simple, vinterp_gauss_batch
+from line_config import load_line_registry, DEFAULT_LINE
+
+SPACING = 0.67
+PROBE_DEPTHS = [460, 760, 1830]
+
+
+def synthetic_profiles(n_profiles, seed=0):
+    """Ragged lists of float32 depths and temperatures"""
+    rng = np.random.default_rng(seed)
+    depths, temps = [], []
+    for _ in range(n_profiles):
+        max_depth = rng.choice(PROBE_DEPTHS) * rng.uniform(0.8, 1)
+        z = np.round(np.arange(SPACING, max_depth, SPACING), 2)
+        t = 4 + rng.uniform(12, 24) * np.exp(-z / rng.uniform(200, 400)) + rng.normal(0, 0.02, len(z))
+        depths.append(z.astype(np.float32))
+        temps.append(t.astype(np.float32))
+    return depths, temps
+
+
+def best_time(function, repeats):
+    """(best seconds of repeats calls of function, its last result)"""
+    seconds = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - t0)
+    return seconds, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Batched against per-profile Gaussian interpolation')
+    parser.add_argument('--profiles', type=int, default=10000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--lines-config', default=str(Path(__file__).resolve().parents[1] / 'soopLines.csv'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    registry = load_line_registry(args.lines_config)
+    v_grid = np.asarray(registry[DEFAULT_LINE]['v_grid'])
+    half_width = registry[DEFAULT_LINE]['half_width']
+    depths, temps = synthetic_profiles(args.profiles, args.seed)
+    print(f"{args.profiles} profiles, {sum(len(d) for d in depths)} samples, {len(v_grid)} levels, "
+          f"half width {half_width} m")
+
+    loop_seconds, loop = best_time(lambda: np.array([vinterp_gauss_simple(d, t, v_grid, half_width)
+                                                     for d, t in zip(depths, temps)]), args.repeats)
+    batch_seconds, batch = best_time(lambda: vinterp_gauss_batch(depths, temps, v_grid, half_width), args.repeats)
+    if not np.array_equal(np.isnan(loop), np.isnan(batch)):
+        raise RuntimeError('the batch leaves other levels empty than the per-profile loop')
+    print(f"{'':>10} {'seconds':>8} {'us/profile':>11}")
+    print(f"{'loop':>10} {loop_seconds:>8.2f} {loop_seconds / args.profiles * 1e6:>11.0f}")
+    print(f"{'batch':>10} {batch_seconds:>8.2f} {batch_seconds / args.profiles * 1e6:>11.0f}")
+    print(f"speedup {loop_seconds / batch_seconds:.1f}x, largest difference {np.nanmax(np.abs(loop - batch)):.2g}")
@@ -0,0 +1,252 @@
+# Benchmark the stages of the vertical gridding pipeline one at a time on a synthetic archive (see
+# synthetic_archive.py) or a folder of XBT files, and keep the results in a history file so regressions show up:
+#   ingest        read_single_file of every file: open, read and QC
+#   interpolate   vinterp_gauss_batch of the QC'd profiles onto the vertical grid, and the profile store
+#   segment       segmentation.segment_transects
+#   merge         segmentation.combine_transects
+#   write         transect assembly and write2netcdf.write_transects
+# Each stage is timed (best of --repeats) with its peak resident memory sampled while it runs, and with
+# --trace-allocations in a second run under tracemalloc for the peak of its Python and numpy allocations.
+# Every run appends one JSON line to --history: the time, commit, machine, parameters and the results of each stage.
+# Stages more than --tolerance (and 10 ms) slower than in the last run with the same parameters on the same machine
+# are reported as regressions, and make the benchmark exit with an error with --fail-on-regression.
+#
+# usage: python benchmarks/bench_pipeline.py [--profiles 10000] [--archive <folder>] [--repeats 1]
+#        python benchmarks/bench_pipeline.py --input <folder of XBT files>
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from transect_vertical_grid import read_single_file, list_input_files
+from interp_gaussian import vinterp_gauss_batch
+from profile_store import build_profile_store, transect_rows, transect_payload
+from segmentation import segment_transects, combine_transects
+from write2netcdf import write_transects
+from line_config import load_line_registry, DEFAULT_LINE
+from run_report import rss_peak
+from synthetic_archive import generate_archive, LINES, LAYOUTS
+
+REPO = Path(__file__).resolve().parents[1]
+STAGES = ['ingest', 'interpolate', 'segment', 'merge', 'write']
+ARCHIVE_PARAMS = 'synthetic.json'
+# slowdowns smaller than this are timing noise, not regressions
+MIN_SLOWDOWN_SECONDS = 0.01
+
+
+def measure(function, repeats=1, trace=False):
+    """
+    Run function repeats times, quietly, and return (its last result, dict of the best wall seconds, the peak
+    resident memory and its growth over the stage, and with trace the peak traced allocations, in MB)
+    """
+    seconds, peak_mb, growth_mb = np.inf, 0.0, 0.0
+    for _ in range(repeats):
+        with rss_peak() as rss, contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = function()
+            seconds = min(seconds, time.perf_counter() - t0)
+        if rss['start'] is not None:
+            peak_mb = max(peak_mb, rss['peak'] / 1e6)
+            growth_mb = max(growth_mb, (rss['peak'] - rss['start']) / 1e6)
+    stats = {'seconds': seconds, 'peak_rss_mb': peak_mb or None, 'rss_growth_mb': growth_mb or None}
+    if trace:
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                function()
+            stats['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+
+def ingest(filepaths):
+    """Read and QC every file, as the workers of load_profiles do"""
+    results = [(f, read_single_file(f)) for f in filepaths]
+    return [(f, r) for f, r in results if r is not None]
+
+
+def interpolate(raw, v_grid, half_width):
+    """Interpolate the QC'd profiles onto v_grid and build the profile store, as process_file_batch does"""
+    results = [r for _, r in raw]
+    profiles = {
+        'TEMP': vinterp_gauss_batch([r['depths'] for r in results], [r['temps'] for r in results], v_grid,
+                                    half_width=half_width).astype(np.float32),
+        'LATITUDE': np.array([r['lat'] for r in results], dtype=float),
+        'LONGITUDE': np.array([r['lon'] for r in results], dtype=float),
+        'TIME': np.array([r['time'] for r in results], dtype='datetime64[ns]'),
+        'SOOP_line': np.array([r['soop_line'] for r in results], dtype=str),
+        'SOOP_line_description': np.array([r['soop_line_description'] for r in results], dtype=str),
+        'Cruise_ID': np.array([r['cruise_id'] for r in results], dtype=str),
+        'Institution_unique_identifier': np.array([r['station_number'] for r in results], dtype=str),
+        'path': np.array([f for f, _ in raw], dtype=str)}
+    return build_profile_store(profiles)
+
+
+def write(meta, temp, v_grid, folder, writers):
+    """Assemble and write every transect into a fresh folder"""
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    payloads = (transect_payload(meta, temp, rows, v_grid) for rows in transect_rows(meta).values())
+    return write_transects(folder, payloads, workers=writers, globals_file_path=str(REPO / 'netcdfGlobalAtts.csv'),
+                           vars_file_path=str(REPO / 'netcdfVars.csv'))
+
+
+def run_stages(filepaths, folder, repeats=1, trace=False, writers=2, lines_config='soopLines.csv'):
+    """Run the stages in turn, each on the output of the one before, returning a dict of stage: stats"""
+    registry = load_line_registry(lines_config)
+    v_grid = registry[DEFAULT_LINE]['v_grid']
+    half_width = registry[DEFAULT_LINE]['half_width']
+    results = {}
+
+    raw, results['ingest'] = measure(lambda: ingest(filepaths), repeats, trace)
+    results['ingest']['items'] = len(filepaths)
+    (meta, temp), results['interpolate'] = measure(lambda: interpolate(raw, v_grid, half_width), repeats, trace)
+    results['interpolate']['items'] = len(raw)
+    del raw
+    segmented, results['segment'] = measure(lambda: segment_transects(meta, registry=registry), repeats, trace)
+    results['segment']['items'] = len(meta)
+    meta['transect_id'] = segmented
+    combined, results['merge'] = measure(lambda: combine_transects(meta, registry=registry), repeats, trace)
+    results['merge']['items'] = len(meta)
+    meta['transect_id'] = combined
+    metrics, results['write'] = measure(lambda: write(meta, temp, v_grid, folder, writers), repeats, trace)
+    results['write']['items'] = len(metrics)
+    results['write']['output_mb'] = float(metrics['bytes'].sum()) / 1e6
+    for stats in results.values():
+        stats['items_per_second'] = stats['items'] / stats['seconds'] if stats['seconds'] > 0 else None
+    return results
+
+
+def git_commit():
+    """Commit of the repository and whether tracked files have changes, (None, None) outside a git checkout"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def machine():
+    """What the results depend on besides the code"""
+    return {'host': platform.node(), 'cpus': os.cpu_count(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+def read_history(path):
+    """Records of the history file, oldest first"""
+    if not Path(path).exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_run(history, params, host):
+    """The last record with the same parameters on the same machine, None if there is none"""
+    same = [r for r in history if r['params'] == params and r['machine']['host'] == host]
+    return same[-1] if same else None
+
+
+def compare(results, previous, tolerance):
+    """Change of the seconds of each stage against the previous record, and the stages that regressed"""
+    changes, regressions = {}, []
+    for stage, stats in results.items():
+        if previous is None or stage not in previous['stages']:
+            continue
+        last_seconds = previous['stages'][stage]['seconds']
+        changes[stage] = stats['seconds'] / last_seconds - 1
+        if changes[stage] > tolerance and stats['seconds'] - last_seconds > MIN_SLOWDOWN_SECONDS:
+            regressions.append(stage)
+    return changes, regressions
+
+
+def archive_files(args, folder):
+    """The input files: those of --input, or of the synthetic archive in folder, written unless already there"""
+    if args.input is not None:
+        return list_input_files([args.input])
+    params = {'profiles': args.profiles, 'lines': args.lines, 'layout': args.layout, 'seed': args.seed}
+    params_path = Path(folder) / ARCHIVE_PARAMS
+    if not params_path.exists() or json.loads(params_path.read_text()) != params:
+        shutil.rmtree(folder, ignore_errors=True)
+        t0 = time.perf_counter()
+        generate_archive(folder, args.profiles, lines=args.lines, layout=args.layout, seed=args.seed,
+                         workers=args.generate_workers, lines_config=args.lines_config)
+        params_path.write_text(json.dumps(params))
+        print(f"synthetic archive of {args.profiles} files written in {time.perf_counter() - t0:.1f} s")
+    return list_input_files([str(folder)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time and memory of each pipeline stage, with a history of runs')
+    parser.add_argument('--input', default=None, help='folder of XBT files to use instead of a synthetic archive')
+    parser.add_argument('--profiles', type=int, default=10000, help='files in the synthetic archive (default: 10000)')
+    parser.add_argument('--lines', nargs='+', default=LINES)
+    parser.add_argument('--layout', choices=LAYOUTS, default='mixed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--archive', default=None,
+                        help='folder to keep the synthetic archive in and reuse it from (default: a temporary one)')
+    parser.add_argument('--generate-workers', type=int, default=os.cpu_count(),
+                        help='processes writing the synthetic archive (default: one per CPU)')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='run each stage once more under tracemalloc for the peak of its allocations')
+    parser.add_argument('--lines-config', default='soopLines.csv')
+    parser.add_argument('--history', default=str(REPO / 'benchmarks' / 'history.jsonl'),
+                        help='JSON lines file the results are appended to (default: benchmarks/history.jsonl)')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown against the previous run reported as a regression (default: 0.2, i.e. 20%%)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on a regression')
+    args = parser.parse_args()
+    # the configs are found relative to the repository
+    os.chdir(REPO)
+
+    with tempfile.TemporaryDirectory() as folder:
+        filepaths = archive_files(args, args.archive or os.path.join(folder, 'archive'))
+        print(f"{len(filepaths)} files, stages: {', '.join(STAGES)}")
+        results = run_stages(filepaths, os.path.join(folder, 'output'), repeats=args.repeats,
+                             trace=args.trace_allocations, writers=args.writers, lines_config=args.lines_config)
+
+    params = {'input': args.input, 'files': len(filepaths), 'repeats': args.repeats, 'writers': args.writers,
+              'lines_config': args.lines_config}
+    if args.input is None:
+        params.update({'profiles': args.profiles, 'lines': args.lines, 'layout': args.layout, 'seed': args.seed})
+    commit, dirty = git_commit()
+    record = {'benchmark': 'pipeline', 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'commit': commit, 'dirty': dirty, 'machine': machine(), 'params': params, 'stages': results}
+    history = read_history(args.history)
+    changes, regressions = compare(results, previous_run(history, params, record['machine']['host']),
+                                   args.tolerance)
+    Path(args.history).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    print(f"{'stage':>12} {'seconds':>9} {'items/s':>10} {'peak RSS MB':>12} {'RSS +MB':>8} "
+          f"{'traced MB':>10} {'vs last':>8}")
+    for stage, stats in results.items():
+        traced = stats.get('traced_peak_mb')
+        print(f"{stage:>12} {stats['seconds']:>9.3f} {stats['items_per_second'] or 0:>10.0f} "
+              f"{stats['peak_rss_mb'] or 0:>12.0f} {stats['rss_growth_mb'] or 0:>8.0f} "
+              f"{'' if traced is None else f'{traced:.0f}':>10} "
+              f"{'' if stage not in changes else f'{changes[stage]:+.0%}':>8}"
+              f"{'  REGRESSION' if stage in regressions else ''}")
+    print(f"results appended to {args.history}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
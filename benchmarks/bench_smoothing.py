@@ -0,0 +1,122 @@
+# Compare the vertical smoothing methods of interp_gaussian (SMOOTHING_METHODS) for speed and accuracy on synthetic
+# XBT profiles: depths from the fall rate equation (spacing shrinking with depth) with holes left by QC, and a
+# temperature made of exponentials and damped waves whose Gaussian smoothing in depth has a closed form. Each
+# method's output on v_grid is compared with the smoothed truth, over every level and near the holes, and the
+# levels falling inside a hole are counted as bridged when a method gives a value there.
+#
+# usage: python benchmarks/bench_smoothing.py [--profiles 2000] [--repeats 3] [--holes 2]
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from interp_gaussian import SMOOTHING_METHODS
+from line_config import load_line_registry, DEFAULT_LINE
+
+# Hanawa et al. (1995) fall rate, z = A t - B t^2, sampled at 10 Hz
+FALL_RATE_A = 6.691
+FALL_RATE_B = 0.00225
+SAMPLE_HZ = 10
+
+
+def fall_rate_depths(max_depth):
+    """Sample depths of a drop down to max_depth"""
+    t_end = (FALL_RATE_A - np.sqrt(FALL_RATE_A ** 2 - 4 * FALL_RATE_B * max_depth)) / (2 * FALL_RATE_B)
+    t = np.arange(1, int(t_end * SAMPLE_HZ) + 1) / SAMPLE_HZ
+    return FALL_RATE_A * t - FALL_RATE_B * t ** 2
+
+
+def profile_terms(rng):
+    """(constant, amplitudes, rates) of a temperature profile constant + Re(sum(amplitude * exp(rate * z)))"""
+    surface = rng.uniform(15, 29)
+    mixed = rng.uniform(1, 3)
+    phase = rng.uniform(0, 2 * np.pi)
+    amplitudes = np.array([surface - 2.5 - mixed, mixed, -0.4j * np.exp(1j * phase)])
+    rates = np.array([-1 / rng.uniform(150, 400), -1 / rng.uniform(20, 60), -1 / 600 + 1j / rng.uniform(60, 120)])
+    return 2.5, amplitudes, rates
+
+
+def evaluate(terms, depths, sigma=0.0):
+    """The profile at depths, Gaussian smoothed in depth with sigma: exp(c z) smooths to exp(c z + c^2 sigma^2 / 2)"""
+    constant, amplitudes, rates = terms
+    z = np.asarray(depths, dtype=float)[:, None]
+    terms = amplitudes[None, :] * np.exp(rates[None, :] * z + rates ** 2 * sigma ** 2 / 2)
+    return constant + np.real(terms).sum(axis=1)
+
+
+def synthetic_profiles(n_profiles, v_grid, half_width, max_holes, seed=0):
+    """
+    (depths, temps, truth, hole_levels, near_hole_levels): the ragged float32 profiles, the smoothed truth on v_grid
+    and boolean (n_profiles x len(v_grid)) masks of the levels inside a hole and within 2 half widths of one
+    """
+    rng = np.random.default_rng(seed)
+    depths, temps = [], []
+    truth = np.full((n_profiles, len(v_grid)), np.nan)
+    holes = np.zeros((n_profiles, len(v_grid)), dtype=bool)
+    near = np.zeros((n_profiles, len(v_grid)), dtype=bool)
+    for i in range(n_profiles):
+        terms = profile_terms(rng)
+        z = fall_rate_depths(rng.choice([460, 760, 1830]) * rng.uniform(0.8, 1))
+        keep = np.ones(len(z), dtype=bool)
+        for _ in range(rng.integers(0, max_holes + 1)):
+            top = rng.uniform(30, z[-1] - 100)
+            bottom = top + rng.uniform(5, 80)
+            keep &= (z < top) | (z > bottom)
+            holes[i] |= (v_grid > top) & (v_grid < bottom)
+            near[i] |= (v_grid > top - 2 * half_width) & (v_grid < bottom + 2 * half_width)
+        z = z[keep]
+        depths.append(z.astype(np.float32))
+        temps.append((evaluate(terms, z) + rng.normal(0, 0.02, len(z))).astype(np.float32))
+        in_range = v_grid <= z[-1]
+        truth[i, in_range] = evaluate(terms, v_grid[in_range], half_width)
+    return depths, temps, truth, holes, near
+
+
+def rmse(values, truth, mask):
+    """Root mean square difference where mask is set and values are given, and the number of levels compared"""
+    compared = mask & ~np.isnan(values) & ~np.isnan(truth)
+    if not compared.any():
+        return np.nan, 0
+    return float(np.sqrt(np.mean((values[compared] - truth[compared]) ** 2))), int(compared.sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Speed and accuracy of the vertical smoothing methods')
+    parser.add_argument('--profiles', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--holes', type=int, default=2, help='most QC holes per profile (default: 2)')
+    parser.add_argument('--methods', nargs='+', choices=list(SMOOTHING_METHODS), default=list(SMOOTHING_METHODS))
+    parser.add_argument('--lines-config', default=str(Path(__file__).resolve().parents[1] / 'soopLines.csv'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    registry = load_line_registry(args.lines_config)
+    v_grid = np.asarray(registry[DEFAULT_LINE]['v_grid'], dtype=float)
+    half_width = registry[DEFAULT_LINE]['half_width']
+    depths, temps, truth, holes, near = synthetic_profiles(args.profiles, v_grid, half_width, args.holes, args.seed)
+    n_samples = sum(len(d) for d in depths)
+    print(f"{args.profiles} profiles, {n_samples} samples, {holes.any(axis=1).sum()} with holes, "
+          f"half width {half_width} m")
+
+    # the first two levels are filled from the shallow data by every method, they are left out
+    levels = np.ones(len(v_grid), dtype=bool)
+    levels[:2] = False
+    print(f"{'method':>8} {'profiles/s':>11} {'samples/s':>11} {'rmse':>8} {'near holes':>11} {'max error':>10} "
+          f"{'bridged':>8}")
+    for method in args.methods:
+        seconds = np.inf
+        for _ in range(args.repeats):
+            t0 = time.perf_counter()
+            result = SMOOTHING_METHODS[method](depths, temps, v_grid, half_width=half_width)
+            seconds = min(seconds, time.perf_counter() - t0)
+        error, _ = rmse(result, truth, levels[None, :] & ~holes)
+        near_error, _ = rmse(result, truth, levels[None, :] & near & ~holes)
+        compared = levels[None, :] & ~holes & ~np.isnan(result) & ~np.isnan(truth)
+        max_error = np.abs(result - truth)[compared].max() if compared.any() else np.nan
+        bridged = (~np.isnan(result) & holes).sum() / max(holes.sum(), 1)
+        print(f"{method:>8} {args.profiles / seconds:>11.0f} {n_samples / seconds:>11.0f} {error:>8.4f} "
+              f"{near_error:>11.4f} {max_error:>10.4f} {bridged:>8.0%}")
@@ -0,0 +1,135 @@
+# Peak memory of the gridding pipeline against the size of its input, with and without streaming: the whole of
+# transect_vertical_grid.py is run on synthetic archives of growing size (see synthetic_archive.py), once loading the
+# TEMP of every transect before writing and once with --stream within --memory-budget-mb. Each run is a fresh
+# process whose peak resident memory is taken from the kernel when it exits, so it covers the whole run (with the
+# default thread backend every worker is in that process).
+# Both modes hold the per-profile metadata of the scan for the whole run, which grows with the input. On top of it,
+# the TEMP loaded to write the transects grows with the profiles written without streaming, and stays within the
+# budget with it: the benchmark reports the peak of the whole run and how much the load_temps and write stages
+# (from the run report) add to the peak of the stages before them. Every run appends one JSON line to --history, as
+# bench_pipeline.py does.
+#
+# usage: python benchmarks/bench_streaming.py [--sizes 2000 4000 8000 16000] [--memory-budget-mb 4]
+#                                             [--archive <folder>]
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from synthetic_archive import LINES, LAYOUTS
+from bench_pipeline import REPO, archive_files, git_commit, machine
+
+MODES = ['batch', 'stream']
+
+
+def run_pipeline(input_folder, output_folder, stream, memory_budget_mb, report_file):
+    """
+    Run transect_vertical_grid.py in a new process, return (wall seconds, its peak resident memory in MB, the
+    summarized run report)
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    command = [sys.executable, str(REPO / 'transect_vertical_grid.py'), input_folder, output_folder,
+               '--report', report_file]
+    if stream:
+        command += ['--stream', '--memory-budget-mb', str(memory_budget_mb)]
+    t0 = time.perf_counter()
+    process = subprocess.Popen(command, cwd=REPO, stdout=subprocess.DEVNULL)
+    # the rusage of this child alone, ru_maxrss in kB on Linux
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - t0
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError('%s exited with status %d' % (' '.join(command), process.returncode))
+    with open(report_file) as f:
+        return seconds, usage.ru_maxrss / 1e3, json.load(f)
+
+
+def write_stages_mb(report):
+    """Peak resident memory of the load_temps and write stages above the peak of the stages before them, in MB"""
+    peaks = {name: entry['peak_rss_mb'] or 0 for name, entry in report['stages'].items()}
+    before = max([peak for name, peak in peaks.items() if name not in ('load_temps', 'write')] or [0])
+    return max(peaks.get('load_temps', 0), peaks.get('write', 0)) - before
+
+
+def growth(sizes, peaks):
+    """Slope of a least squares line through the peaks, in MB per 1000 profiles"""
+    if len(sizes) < 2:
+        return None
+    return float(np.polyfit(np.asarray(sizes) / 1000, peaks, 1)[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Peak memory of the pipeline against input size, with and without '
+                                                 'streaming')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 4000, 8000, 16000],
+                        help='files in the synthetic archives (default: 2000 4000 8000 16000)')
+    parser.add_argument('--memory-budget-mb', type=float, default=4,
+                        help='memory budget of the streamed runs, below the TEMP of the smallest archive to show the '
+                             'bound (default: 4)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--lines', nargs='+', default=LINES)
+    parser.add_argument('--layout', choices=LAYOUTS, default='mixed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--archive', default=None,
+                        help='folder to keep the synthetic archives in and reuse them from (default: a temporary '
+                             'one)')
+    parser.add_argument('--generate-workers', type=int, default=os.cpu_count(),
+                        help='processes writing the synthetic archives (default: one per CPU)')
+    parser.add_argument('--lines-config', default='soopLines.csv')
+    parser.add_argument('--history', default=str(REPO / 'benchmarks' / 'history.jsonl'),
+                        help='JSON lines file the results are appended to (default: benchmarks/history.jsonl)')
+    args = parser.parse_args()
+    os.chdir(REPO)
+
+    results = {mode: [] for mode in args.modes}
+    with tempfile.TemporaryDirectory() as folder:
+        archives = args.archive or os.path.join(folder, 'archives')
+        for size in args.sizes:
+            archive_args = argparse.Namespace(input=None, profiles=size, lines=args.lines, layout=args.layout,
+                                              seed=args.seed, generate_workers=args.generate_workers,
+                                              lines_config=args.lines_config)
+            archive = os.path.join(archives, 'profiles-%d' % size)
+            archive_files(archive_args, archive)
+            for mode in args.modes:
+                seconds, peak_mb, report = run_pipeline(archive, os.path.join(folder, 'output-%s-%d' % (mode, size)),
+                                                        mode == 'stream', args.memory_budget_mb,
+                                                        os.path.join(folder, 'report.json'))
+                results[mode].append({'files': size, 'seconds': seconds, 'peak_rss_mb': peak_mb,
+                                      'write_stages_mb': write_stages_mb(report),
+                                      'profiles_written': report['counts'].get('profiles_written'),
+                                      'stream_groups': report['counts'].get('stream_groups')})
+                print(f"{size} files, {mode}: {seconds:.1f} s, peak RSS {peak_mb:.0f} MB, "
+                      f"load and write +{results[mode][-1]['write_stages_mb']:.0f} MB")
+
+    params = {'sizes': args.sizes, 'memory_budget_mb': args.memory_budget_mb, 'lines': args.lines,
+              'layout': args.layout, 'seed': args.seed, 'lines_config': args.lines_config}
+    commit, dirty = git_commit()
+    record = {'benchmark': 'streaming', 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'commit': commit, 'dirty': dirty, 'machine': machine(), 'params': params,
+              'runs': results,
+              'growth_mb_per_1000': {mode: growth(args.sizes, [r['peak_rss_mb'] for r in runs])
+                                     for mode, runs in results.items()},
+              'write_stages_growth_mb_per_1000': {mode: growth(args.sizes, [r['write_stages_mb'] for r in runs])
+                                                  for mode, runs in results.items()}}
+    Path(args.history).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    print(f"{'files':>8} " + ' '.join(f"{mode + ' s':>10} {mode + ' MB':>10} {'+MB':>6}" for mode in args.modes))
+    for i, size in enumerate(args.sizes):
+        print(f"{size:>8} " + ' '.join(f"{results[mode][i]['seconds']:>10.1f} {results[mode][i]['peak_rss_mb']:>10.0f} "
+                                       f"{results[mode][i]['write_stages_mb']:>6.0f}" for mode in args.modes))
+    for mode in args.modes:
+        slope, write_slope = record['growth_mb_per_1000'][mode], record['write_stages_growth_mb_per_1000'][mode]
+        if slope is not None:
+            print(f"{mode}: peak RSS grows {slope:.1f} MB per 1000 files, {write_slope:.1f} MB of it in the load "
+                  f"and write stages")
+    print(f"results appended to {args.history}")
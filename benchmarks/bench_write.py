@@ -0,0 +1,153 @@
+# Benchmark the netCDF writer: files written per second, bytes on disk and the time to read whole sections back,
+# for the previous writer (one element at a time, kept below as the reference) and write2netcdf.write_payload_nc
+# with different compression, TIME dimension and chunk options. Transects are synthetic: profiles of a
+# thermocline on the 10 m grid with a random maximum depth.
+#
+# usage: python benchmarks/bench_write.py [--transects 50] [--profiles 40 200] [--repeats 1]
+
+import io
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+from pathlib import Path
+from time import strftime, gmtime
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset, date2num
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from utils import read_variables_config, read_globals_config
+from profile_store import payload_frames
+from write2netcdf import write_payload_nc, create_filename_output
+
+CONFIGS = {
+    'previous': None,
+    'bulk': {},
+    'bulk fixed section': {'fixed_time': True, 'chunks': 'section'},
+    'zlib 1': {'complevel': 1, 'fixed_time': True, 'chunks': 'section'},
+    'zlib 4': {'complevel': 4, 'fixed_time': True, 'chunks': 'section'},
+    'zlib 4 no shuffle': {'complevel': 4, 'shuffle': False, 'fixed_time': True, 'chunks': 'section'},
+    'zlib 9': {'complevel': 9, 'fixed_time': True, 'chunks': 'section'},
+}
+
+
+def previous_write(output_folder, transect_df, data_df, globals_file_path='netcdfGlobalAtts.csv',
+                   vars_file_path='netcdfVars.csv'):
+    """The writer before the bulk write path: configs read on every call, coordinates written one at a time"""
+    netcdf_filepath = Path(output_folder) / f"{create_filename_output(transect_df)}.nc"
+    vars = read_variables_config(vars_file_path)
+    globals_list = read_globals_config(globals_file_path)
+    att_cols = [col for col in vars.columns if col.startswith('att_')]
+    att_labels = [col.replace('att_', '') for col in att_cols]
+    with Dataset(str(netcdf_filepath), "w", format="NETCDF4") as nc:
+        depth_data = data_df.index.values
+        transect_df['TIME'] = pd.to_datetime(transect_df['TIME'])
+        nc.createDimension('DEPTH', len(depth_data))
+        nc.createDimension('TIME', None)
+        nc.createVariable('TIME', 'f8', ('TIME',))
+        nc.createVariable('LATITUDE', 'f8', ('TIME',))
+        nc.createVariable('LONGITUDE', 'f8', ('TIME',))
+        nc.createVariable('TEMP', 'f4', ('TIME', 'DEPTH',), fill_value=np.float32(-9999.9))
+        nc.createVariable('DEPTH', 'f4', ('DEPTH',))
+        data_df = data_df.fillna(np.float32(-9999.9))
+        for var_name in vars['variable_name']:
+            var_info = vars[vars['variable_name'] == var_name].iloc[0]
+            for att_label, att_col in zip(att_labels, att_cols):
+                if not pd.isna(var_info[att_col]):
+                    nc.variables[var_name].setncattr(att_label, var_info[att_col])
+        for i, t in enumerate(transect_df['TIME']):
+            nc.variables['TIME'][i] = date2num(t, units=nc.variables['TIME'].units,
+                                               calendar=nc.variables['TIME'].calendar)
+            nc.variables['LATITUDE'][i] = transect_df['LATITUDE'].iloc[i]
+            nc.variables['LONGITUDE'][i] = transect_df['LONGITUDE'].iloc[i]
+        nc.variables['TEMP'][:, :] = data_df.values.T
+        nc.variables['DEPTH'][:] = depth_data
+        globals_list['geospatial_lat_max'] = transect_df['LATITUDE'].max()
+        globals_list['geospatial_lat_min'] = transect_df['LATITUDE'].min()
+        globals_list['geospatial_lon_max'] = transect_df['LONGITUDE'].max()
+        globals_list['geospatial_lon_min'] = transect_df['LONGITUDE'].min()
+        globals_list['geospatial_vertical_max'] = max(depth_data)
+        globals_list['geospatial_vertical_min'] = min(depth_data)
+        globals_list['time_coverage_start'] = min(transect_df['TIME']).strftime("%Y-%m-%dT%H:%M:%SZ")
+        globals_list['time_coverage_end'] = max(transect_df['TIME']).strftime("%Y-%m-%dT%H:%M:%SZ")
+        globals_list['date_created'] = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
+        globals_list['SOOP_line_label'] = transect_df['SOOP_line'].iloc[0]
+        globals_list['SOOP_line_description'] = transect_df['SOOP_line_description'].iloc[0]
+        globals_list['transect_id'] = transect_df['transect_id'].iloc[0]
+        globals_list['Cruise_ID'] = transect_df['Cruise_ID'].iloc[0]
+        for att_name, att_value in globals_list.items():
+            nc.setncattr(att_name, 'Unknown' if pd.isna(att_value) else att_value)
+    return netcdf_filepath
+
+
+def synthetic_payload(rng, i, n_profiles, v_grid):
+    """A transect payload of n_profiles thermocline profiles, NaN below a random maximum depth per profile"""
+    start = np.datetime64('2010-01-01T00:00:00') + np.timedelta64(int(i) * 30, 'D')
+    times = start + np.sort(rng.choice(10 * 86400, n_profiles, replace=False)).astype('timedelta64[s]')
+    surface = rng.uniform(15, 28, n_profiles)[:, None]
+    temps = 2 + (surface - 2) * np.exp(-v_grid[None, :] / rng.uniform(200, 600)) + \
+        rng.normal(0, 0.02, (n_profiles, len(v_grid)))
+    max_depths = rng.uniform(700, 1800, n_profiles)
+    temps[v_grid[None, :] > max_depths[:, None]] = np.nan
+    payload = {'LATITUDE': np.linspace(-32, -10, n_profiles), 'LONGITUDE': np.linspace(114, 105, n_profiles),
+               'TIME': times.astype('datetime64[ns]'), 'SOOP_line': np.full(n_profiles, 'IX22'),
+               'SOOP_line_description': np.full(n_profiles, 'Fremantle - Sunda Strait'),
+               'Cruise_ID': np.full(n_profiles, 'synthetic'),
+               'Institution_unique_identifier': np.arange(n_profiles).astype(str),
+               'transect_id': np.full(n_profiles, f'IX22-{i:06d}-1')}
+    payload['DEPTH'] = v_grid
+    payload['TEMP'] = temps.astype(np.float32)
+    return payload
+
+
+def time_config(payloads, options, folder, repeats=1):
+    """Return (best write seconds, bytes on disk, seconds to read TEMP of every file) of one writer configuration"""
+    best = np.inf
+    for _ in range(repeats):
+        for f in Path(folder).glob('*.nc'):
+            f.unlink()
+        t0 = time.perf_counter()
+        for payload in payloads:
+            if options is None:
+                previous_write(folder, *payload_frames(payload))
+            else:
+                write_payload_nc(folder, payload, **options)
+        best = min(best, time.perf_counter() - t0)
+    files = sorted(Path(folder).glob('*.nc'))
+    t0 = time.perf_counter()
+    for f in files:
+        with Dataset(str(f)) as nc:
+            nc.variables['TEMP'][:]
+    return best, sum(f.stat().st_size for f in files), time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='netCDF writer throughput and size on disk')
+    parser.add_argument('--transects', type=int, default=50)
+    parser.add_argument('--profiles', type=int, nargs=2, default=[40, 200],
+                        help='range of the number of profiles per transect')
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    v_grid = np.arange(0, 1810, 10)
+    payloads = [synthetic_payload(rng, i, rng.integers(args.profiles[0], args.profiles[1] + 1), v_grid)
+                for i in range(args.transects)]
+    n_profiles = sum(len(p['TIME']) for p in payloads)
+    print(f"{args.transects} transects, {n_profiles} profiles on {len(v_grid)} depths")
+
+    print(f"{'writer':>20} {'seconds':>8} {'files/s':>8} {'speedup':>8} {'MB':>7} {'kB/file':>8} {'read s':>7}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as folder:
+        for name in args.configs:
+            # the writer prints each file it creates, keep that out of the table
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, n_bytes, read_seconds = time_config(payloads, CONFIGS[name], folder, args.repeats)
+            baseline = baseline or seconds
+            print(f"{name:>20} {seconds:>8.2f} {args.transects / seconds:>8.1f} {baseline / seconds:>8.2f} "
+                  f"{n_bytes / 1e6:>7.2f} {n_bytes / 1e3 / args.transects:>8.1f} {read_seconds:>7.3f}")
@@ -0,0 +1,210 @@
+# Write a synthetic archive of IMOS-style XBT profile files, one netCDF file per drop as on the AODN server, for
+# reproducible benchmarks without the server.
+#
+# Each line of the lines config with a polygon is run by one ship, cruise after cruise: a crossing of the line
+# inside its polygon, alternately outbound and back, with drops every few hours. Some cruises turn back part way
+# (a direction reversal), some stop for two to three weeks in the middle (a gap that splits the cruise), and some
+# follow the previous cruise within days (transects that are combined). Profiles are a latitude dependent
+# thermocline with eddies along the track, reaching 450 to 1800 m on the XBT depth spacing. Some depths are flagged
+# bad (QC 3 or 4, with spikes), some profiles end in a wire break flagged 4 and a few are bad throughout.
+# Files use either layout read by transect_vertical_grid.read_single_file: the line, cruise and station in global
+# attributes (XBT_line, XBT_cruise_ID, XBT_uniqueid) or in the SOOP_line, Ship and Institution_unique_identifier
+# variables; 'mixed' alternates them by cruise.
+#
+# usage: python benchmarks/synthetic_archive.py <folder> [--profiles 10000] [--lines PX30 IX28 ...]
+#                                               [--layout mixed] [--workers 4] [--seed 0]
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from netCDF4 import Dataset, date2num
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from line_config import load_line_registry
+
+LINES = ['PX30', 'IX28', 'PX34', 'IX01', 'PX02', 'IX22-PX11']
+LAYOUTS = ['global', 'variable', 'mixed']
+TIME_UNITS = 'days since 1950-01-01 00:00:00 UTC'
+START = np.datetime64('2000-01-01T00:00:00', 's')
+# depth spacing of the XBT fall rate, m
+DEPTH_STEP = 0.67
+
+
+def line_track(settings, n_points=200):
+    """
+    Positions along the middle of the polygon of a line, from the start to the end of its horizontal grid:
+    (along, across, half_width) arrays of the grid axis, the other coordinate and the half width of the polygon
+    across the axis, longitudes in 0/360
+    """
+    x0, y0, x1, y1 = settings['polygon_edges']
+    along = np.linspace(settings['grid'][0], settings['grid'][-1], n_points)
+    if settings['axis'] == 'LATITUDE':
+        x0, y0, x1, y1 = y0, x0, y1, x1
+    # crossings of the polygon edges with a line across the axis at each point
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (along[:, None] - x0[None, :]) / (x1 - x0)[None, :]
+        across = y0[None, :] + t * (y1 - y0)[None, :]
+    across = np.where((t >= 0) & (t <= 1), across, np.nan)
+    inside = np.sum(~np.isnan(across), axis=1) >= 2
+    low, high = np.nanmin(across[inside], axis=1), np.nanmax(across[inside], axis=1)
+    return along[inside], (low + high) / 2, (high - low) / 2
+
+
+def cruise_plan(lines, n_profiles, rng):
+    """
+    Cruises of every line until n_profiles drops: list of dicts of the line, cruise number, start time, number of
+    drops, direction and the reversal, gap or follow choice, in a fixed order for a given seed
+    """
+    cruises = []
+    next_start = {line: START + np.timedelta64(int(rng.integers(0, 30 * 86400)), 's') for line in lines}
+    outbound = {line: True for line in lines}
+    total = 0
+    while total < n_profiles:
+        for line in lines:
+            n_drops = int(min(rng.integers(40, 120), n_profiles - total))
+            if n_drops <= 0:
+                break
+            kind = rng.choice(['plain', 'reversal', 'gap', 'follow'], p=[0.7, 0.1, 0.1, 0.1])
+            cruises.append({'line': line, 'number': len(cruises), 'start': next_start[line], 'n_drops': n_drops,
+                            'outbound': outbound[line], 'kind': kind,
+                            'hours': float(rng.uniform(2, 6))})
+            total += n_drops
+            # the next cruise of the line weeks later the other way, or within days the same way for a transect
+            # to combine
+            outbound[line] = outbound[line] if kind == 'follow' else not outbound[line]
+            days_to_next = rng.uniform(3, 6) if kind == 'follow' else rng.uniform(20, 60)
+            next_start[line] = next_start[line] + np.timedelta64(int(days_to_next * 86400), 's') + \
+                np.timedelta64(int(n_drops * cruises[-1]['hours'] * 3600), 's')
+    return cruises
+
+
+def synthetic_profile(rng, lat, position, max_depth):
+    """Depths, temperatures and QC flags of one drop: a thermocline set by latitude, with eddies along the track"""
+    depths = (DEPTH_STEP * np.arange(1, int(max_depth / DEPTH_STEP) + 1)).astype(np.float32)
+    surface = 29 - 0.35 * abs(lat) + 1.5 * np.sin(position * 12) + rng.normal(0, 0.3)
+    scale = 250 + 150 * np.cos(position * 7) + rng.normal(0, 20)
+    temps = 2.5 + (surface - 2.5) * np.exp(-depths / scale) + 0.4 * np.sin(depths / 90 + position * 30) * \
+        np.exp(-depths / 600) + rng.normal(0, 0.02, len(depths))
+    qc = np.ones(len(depths), dtype=np.int8)
+    bad = rng.random(len(depths)) < 0.01
+    qc[bad] = rng.choice(np.array([3, 4], dtype=np.int8), bad.sum())
+    temps[bad] += rng.normal(0, 5, bad.sum())
+    kind = rng.random()
+    if kind < 0.05:
+        # wire break: the rest of the profile is noise, flagged bad
+        start = int(rng.integers(len(depths) // 4, len(depths)))
+        temps[start:] = rng.uniform(-2, 45, len(depths) - start)
+        qc[start:] = 4
+    elif kind < 0.06:
+        qc[:] = 4
+    return depths, temps.astype(np.float32), qc
+
+
+def write_profile(path, layout, line, description, cruise_id, station, time, lat, lon, depths, temps, qc):
+    """Write one drop in the global attribute or the variable layout"""
+    with Dataset(path, 'w') as nc:
+        nc.createDimension('DEPTH', len(depths))
+        nc.createVariable('DEPTH', 'f4', ('DEPTH',))[:] = depths
+        nc.createVariable('TEMP', 'f4', ('DEPTH',), fill_value=np.float32(999999))[:] = temps
+        nc.createVariable('TEMP_quality_control', 'i1', ('DEPTH',), fill_value=np.int8(99))[:] = qc
+        time_var = nc.createVariable('TIME', 'f8')
+        time_var.units = TIME_UNITS
+        time_var.calendar = 'gregorian'
+        time_var.assignValue(date2num(time.astype(object), TIME_UNITS, 'gregorian'))
+        nc.createVariable('LATITUDE', 'f8').assignValue(lat)
+        nc.createVariable('LONGITUDE', 'f8').assignValue(lon)
+        if layout == 'global':
+            nc.XBT_uniqueid = station
+            nc.XBT_line = line
+            nc.XBT_line_description = description
+            nc.XBT_cruise_ID = cruise_id
+        else:
+            nc.createDimension('STRING%d' % len(station), len(station))
+            nc.createVariable('Institution_unique_identifier', 'S1', ('STRING%d' % len(station),))[:] = \
+                np.array(list(station), dtype='S1')
+            soop_line = nc.createVariable('SOOP_line', 'i4')
+            soop_line.SOOP_line_label = line
+            soop_line.SOOP_line_description = description
+            nc.createVariable('Ship', 'i4').Cruise_ID = cruise_id
+
+
+def write_cruise(folder, cruise, settings, seed, layout, first_station):
+    """Write the files of one cruise, return their number"""
+    rng = np.random.default_rng([seed, cruise['number']])
+    along, across, half_width = line_track(settings)
+    n = cruise['n_drops']
+    # fraction of the track of each drop, out and back for a reversal
+    fraction = np.linspace(0, 1, n)
+    if cruise['kind'] == 'reversal':
+        turn = rng.uniform(0.4, 0.7)
+        fraction = np.where(fraction < turn, fraction, 2 * turn - fraction)
+    if not cruise['outbound']:
+        fraction = 1 - fraction
+    track = np.linspace(0, 1, len(along))
+    across = np.interp(fraction, track, across) + rng.uniform(-0.3, 0.3, n) * np.interp(fraction, track, half_width)
+    along = np.interp(fraction, track, along) + rng.normal(0, 0.02, n)
+    lat, lon = (along, across) if settings['axis'] == 'LATITUDE' else (across, along)
+    lon = np.where(lon > 180, lon - 360, lon)
+
+    seconds = np.cumsum(np.r_[0, rng.uniform(0.5, 1.5, n - 1) * cruise['hours'] * 3600]).astype(np.int64)
+    if cruise['kind'] == 'gap':
+        seconds[n // 2:] += int(rng.uniform(14, 21) * 86400)
+    times = cruise['start'] + seconds.astype('timedelta64[s]')
+    cruise_layout = layout if layout != 'mixed' else LAYOUTS[cruise['number'] % 2]
+    cruise_id = '%s-%05d' % (cruise['line'].replace('-', ''), cruise['number'])
+    for i in range(n):
+        station = str(first_station + i)
+        depths, temps, qc = synthetic_profile(rng, lat[i], fraction[i], rng.choice([460, 760, 1830]))
+        name = 'IMOS_SOOP-XBT_T_%s_%s_FV01_ID-%s.nc' % (
+            np.datetime_as_string(times[i], unit='s').replace('-', '').replace(':', '') + 'Z', cruise['line'], station)
+        write_profile(os.path.join(folder, name), cruise_layout, cruise['line'], 'synthetic %s' % cruise['line'],
+                      cruise_id, station, times[i], float(lat[i]), float(lon[i]), depths, temps, qc)
+    return n
+
+
+def generate_archive(folder, n_profiles, lines=LINES, layout='mixed', seed=0, workers=1,
+                     lines_config='soopLines.csv'):
+    """
+    Write a synthetic archive of n_profiles files into folder.
+    :param lines: lines of the lines config to run cruises on, each needs a grid and a polygon
+    :param layout: 'global', 'variable' or 'mixed', see the top of this file
+    :param workers: number of processes writing cruises
+    :return: number of files written
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('layout must be one of %s, got %r' % (', '.join(LAYOUTS), layout))
+    registry = load_line_registry(lines_config)
+    for line in lines:
+        if line not in registry or registry[line]['polygon'] is None or registry[line]['grid'] is None:
+            raise ValueError('line %s needs a grid and a polygon in %s' % (line, lines_config))
+    os.makedirs(folder, exist_ok=True)
+    cruises = cruise_plan(list(lines), n_profiles, np.random.default_rng(seed))
+    first_stations = 10000000 + np.r_[0, np.cumsum([c['n_drops'] for c in cruises])[:-1]]
+    tasks = [(folder, cruise, registry[cruise['line']], seed, layout, int(first))
+             for cruise, first in zip(cruises, first_stations)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(write_cruise, *zip(*tasks)))
+    return sum(write_cruise(*task) for task in tasks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic archive of IMOS-style XBT profile files')
+    parser.add_argument('folder', help='folder to write the files to')
+    parser.add_argument('--profiles', type=int, default=10000, help='number of files (default: 10000)')
+    parser.add_argument('--lines', nargs='+', default=LINES)
+    parser.add_argument('--layout', choices=LAYOUTS, default='mixed',
+                        help='global attribute or variable layout of the line, cruise and station (default: mixed)')
+    parser.add_argument('--workers', type=int, default=1, help='number of writing processes (default: 1)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    n = generate_archive(args.folder, args.profiles, lines=args.lines, layout=args.layout, seed=args.seed,
+                         workers=args.workers)
+    print(f"{n} files written to {args.folder} in {time.perf_counter() - t0:.1f} s")
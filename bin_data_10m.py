@@ -1,34 +1,100 @@
 import numpy as np
 
-def bin_data_10m(depths, temperatures):
+
+def bin_edges(max_depth, bin_width=10):
     """
-    Bin temperature data into 10 meter vertical intervals.
+    Edges of bins of bin_width from the surface down to max_depth, the last bin reaching or passing it.
+    :return: array of n_bins + 1 edges, bin i is [edges[i], edges[i + 1])
+    """
+    n_bins = max(1, int(np.ceil(max_depth / bin_width - 1e-9)))
+    return np.arange(n_bins + 1) * float(bin_width)
+
+
+def bin_data_batch(depths, data, edges, return_counts=False, return_std=False):
+    """
+    Average many profiles in the same depth bins at once: every sample gets the index of its profile and bin, and
+    the sums, counts and squared deviations of all bins of all profiles are taken with one np.bincount each.
+    :param depths: list of 1D depth arrays, one per profile
+    :param data: list of 1D arrays of the values at those depths
+    :param edges: increasing bin edges shared by all profiles, see bin_edges. Samples outside them are left out,
+        as are NaN values
+    :param return_counts: also return the number of samples in each bin
+    :param return_std: also return the (population) standard deviation of the samples in each bin
+    :return: (n_profiles x n_bins) mean of each bin, NaN where a bin is empty, followed by the counts and the
+        standard deviations when asked for, as np.unique does
+    """
+    edges = np.asarray(edges, dtype=float)
+    n_profiles, n_bins = len(depths), len(edges) - 1
+    lengths = np.array([len(d) for d in depths], dtype=np.int64)
+    z = np.concatenate([np.asarray(d, dtype=float).ravel() for d in depths] + [np.empty(0)])
+    values = np.concatenate([np.asarray(v, dtype=float).ravel() for v in data] + [np.empty(0)])
+    bins = np.searchsorted(edges, z, side='right') - 1
+    keep = (bins >= 0) & (bins < n_bins) & ~np.isnan(values)
+    cells = np.repeat(np.arange(n_profiles), lengths)[keep] * n_bins + bins[keep]
+    values = values[keep]
+
+    size = n_profiles * n_bins
+    counts = np.bincount(cells, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(cells, weights=values, minlength=size) / counts
+        result = [means.reshape(n_profiles, n_bins)]
+        if return_counts:
+            result.append(counts.reshape(n_profiles, n_bins))
+        if return_std:
+            # deviations from the bin means, steadier than the difference of the sums of squares
+            squares = np.bincount(cells, weights=(values - means[cells]) ** 2, minlength=size)
+            result.append(np.sqrt(squares / counts).reshape(n_profiles, n_bins))
+    return result[0] if len(result) == 1 else tuple(result)
+
+
+def bin_data(depths, temperatures, bin_width=10, return_counts=False, return_std=False):
+    """
+    Bin the temperatures of one profile into bin_width vertical intervals, from the multiple of bin_width above its
+    shallowest sample to below its deepest one. As with np.mean per bin, a bin holding a NaN temperature averages
+    to NaN and a bin holding only NaN is kept, unlike bin_data_batch which leaves NaN values out.
 
     Parameters:
     depths (np.ndarray): 1D array of depth measurements (in meters).
     temperatures (np.ndarray): 1D array of temperature measurements corresponding to the depths.
+    bin_width (float): height of the bins (in meters).
+    return_counts, return_std (bool): also return the number of samples and their standard deviation in each bin.
 
     Returns:
-    binned_depths (np.ndarray): 1D array of binned depth intervals (center of each bin).
+    binned_depths (np.ndarray): 1D array of binned depth intervals (center of each bin), for bins holding samples.
     binned_temperatures (np.ndarray): 1D array of average temperatures for each bin.
+    followed by the counts (samples, NaN or not) and standard deviations of the same bins when asked for.
     """
-    # Define bin edges from the minimum to maximum depth in 10 meter intervals
-    min_depth = np.floor(np.min(depths) / 10) * 10
-    max_depth = np.ceil(np.max(depths) / 10) * 10
-    bin_edges = np.arange(min_depth, max_depth + 10, 10)
+    depths = np.asarray(depths, dtype=float)
+    temperatures = np.asarray(temperatures, dtype=float)
+    top = np.floor(np.min(depths) / bin_width) * bin_width
+    edges = top + bin_edges(np.max(depths) - top + bin_width, bin_width)
+    means, _, std = bin_data_batch([depths], [temperatures], edges, return_counts=True, return_std=True)
+    # the share of NaN temperatures in each bin, and the number of samples NaN or not
+    nan_share, counts = bin_data_batch([depths], [np.isnan(temperatures)], edges, return_counts=True)
+    means[nan_share > 0] = np.nan
+    std[nan_share > 0] = np.nan
+    filled = counts[0] > 0
+    result = [(edges[:-1] + bin_width / 2)[filled], means[0, filled]]
+    if return_counts:
+        result.append(counts[0, filled])
+    if return_std:
+        result.append(std[0, filled])
+    return tuple(result)
+
 
-    # Initialize arrays to hold binned depths and temperatures
-    binned_depths = []
-    binned_temperatures = []
+def bin_data_10m(depths, temperatures):
+    """
+    Bin temperature data into 10 meter vertical intervals.
 
-    # Bin the data
-    for i in range(len(bin_edges) - 1):
-        bin_mask = (depths >= bin_edges[i]) & (depths < bin_edges[i + 1])
-        if np.any(bin_mask):
-            binned_depths.append((bin_edges[i] + bin_edges[i + 1]) / 2)
-            binned_temperatures.append(np.mean(temperatures[bin_mask]))
+    Parameters:
+    depths (np.ndarray): 1D array of depth measurements (in meters).
+    temperatures (np.ndarray): 1D array of temperature measurements corresponding to the depths.
 
-    return np.array(binned_depths), np.array(binned_temperatures)
+    Returns:
+    binned_depths (np.ndarray): 1D array of binned depth intervals (center of each bin).
+    binned_temperatures (np.ndarray): 1D array of average temperatures for each bin.
+    """
+    return bin_data(depths, temperatures, bin_width=10)
 
 
 # Example usage
@@ -0,0 +1,191 @@
+# Declarative bad data and merge rules, in place of the per-transect branches of matlab/remove_bad_data.m and
+# matlab/combine_transects.m. Rules are read from dataRules.csv, one row per rule:
+#   line         line(s) the rule applies to, space separated, matched against the line of each transect as
+#                the line settings are (e.g. PX30-31 transects are PX30)
+#   transect     transect the rule applies to, as its cruise month and number (e.g. 200107-1) or its full id,
+#                empty to apply it to every transect of the line
+#   action       drop_transect, drop_profiles, drop_region, mask_below or merge
+#   profiles     profile numbers in the transect, counting from 1 in time order as in the transect file once the
+#                drop_region rules of the transect have removed their profiles, as remove_bad_data.m numbers them,
+#                space separated, with MATLAB ranges such as 12:end
+#   stations     Institution_unique_identifier of the profiles, space separated, instead of or as well as profiles
+#   depth        mask_below: TEMP deeper than depth (m) is masked
+#   lon_min, lon_max, lat_min, lat_max
+#                drop_region: profiles east of lon_min and west of lon_max (0-360) and north of lat_min and south
+#                of lat_max are dropped, empty bounds are open
+#   into         merge: transect the profiles are moved into, as its cruise month and number or its full id
+# Rules are applied to the transects as segmented, before anything is assembled or written: transect and region
+# drops first, then profile rules, then merges, so profile numbers refer to the segmented transect less the
+# profiles out of its region.
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from utils import read_data_rules
+from line_config import load_line_registry, resolve_line
+from profile_store import transect_rows
+
+ACTIONS = ['drop_transect', 'drop_profiles', 'drop_region', 'mask_below', 'merge']
+# order the rules of a transect are applied in, file order otherwise
+ACTION_ORDER = {'drop_transect': 0, 'drop_region': 1}
+BOUNDS = ['lon_min', 'lon_max', 'lat_min', 'lat_max']
+
+
+def transect_key(transect_id):
+    """The cruise month and number of a transect id, e.g. 200107-1 of PX30-31-200107-1"""
+    return '-'.join(str(transect_id).rsplit('-', 2)[-2:])
+
+
+def parse_profiles(spec):
+    """Profile numbers of a rule as (first, last) ranges counting from 1, last None for the end of the transect"""
+    ranges = []
+    for token in str(spec).split():
+        first, _, last = token.partition(':')
+        if last == 'end':
+            ranges.append((int(first), None))
+        else:
+            ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+def compile_rule(row, number):
+    """Check one row of the rules config and compile it into a rule dict"""
+    action = row['action']
+    where = 'rule %d (%s %s)' % (number, row['line'], row['transect'])
+    if action not in ACTIONS:
+        raise ValueError('%s: action must be one of %s, got %r' % (where, ', '.join(ACTIONS), action))
+    if pd.isna(row['line']):
+        raise ValueError('%s: give the line(s) the rule applies to' % where)
+    rule = {'action': action, 'number': number,
+            'transect': None if pd.isna(row['transect']) else transect_key(row['transect']),
+            'profiles': [] if pd.isna(row['profiles']) else parse_profiles(row['profiles']),
+            'stations': [] if pd.isna(row['stations']) else str(row['stations']).split(),
+            'depth': None if pd.isna(row['depth']) else float(row['depth']),
+            'bounds': {col: float(row[col]) for col in BOUNDS if not pd.isna(row[col])},
+            'into': None if pd.isna(row['into']) else transect_key(row['into']),
+            'comment': '' if pd.isna(row['comment']) else row['comment']}
+    if action in ('drop_transect', 'merge') and rule['transect'] is None:
+        raise ValueError('%s: %s needs a transect' % (where, action))
+    if action in ('drop_profiles', 'mask_below') and not rule['profiles'] and not rule['stations']:
+        raise ValueError('%s: %s needs profiles or stations' % (where, action))
+    if action == 'mask_below' and rule['depth'] is None:
+        raise ValueError('%s: mask_below needs a depth' % where)
+    if action == 'drop_region' and not rule['bounds']:
+        raise ValueError('%s: drop_region needs at least one of %s' % (where, ', '.join(BOUNDS)))
+    if action == 'merge' and rule['into'] is None:
+        raise ValueError('%s: merge needs the transect to merge into' % where)
+    return rule
+
+
+@lru_cache(maxsize=None)
+def load_data_rules(file_path='dataRules.csv'):
+    """
+    Read and compile the rules config once per process, indexed by line and transect.
+    :return: dict of (line, cruise month and number, or None for rules on every transect of the line): list of
+        rules in file order. The rules are shared between calls, do not change them.
+    """
+    rules = {}
+    for number, (_, row) in enumerate(read_data_rules(file_path).iterrows(), start=1):
+        rule = compile_rule(row, number)
+        for line in row['line'].split():
+            rules.setdefault((line, rule['transect']), []).append(rule)
+    return rules
+
+
+def _selected_rows(rule, rows, times, stations, lons, lats):
+    """The rows of a transect (sorted by time) a profile or region rule applies to"""
+    if rule['action'] == 'drop_region':
+        bounds = rule['bounds']
+        selected = np.ones(len(rows), dtype=bool)
+        for col, values, above in (('lon_min', lons, True), ('lon_max', lons, False),
+                                   ('lat_min', lats, True), ('lat_max', lats, False)):
+            if col in bounds:
+                selected &= values[rows] > bounds[col] if above else values[rows] < bounds[col]
+        return rows[selected]
+
+    # profile numbers as in the transect file, where profiles sharing a TIME are one profile
+    _, number = np.unique(times[rows], return_inverse=True)
+    number = number + 1
+    selected = np.isin(stations[rows], rule['stations'])
+    for first, last in rule['profiles']:
+        selected |= (number >= first) & (number <= (number.max() if last is None else last))
+    return rows[selected]
+
+
+def apply_data_rules(meta, rules, registry=None):
+    """
+    Apply the data rules to the segmented transects of meta in one pass, without changing meta.
+    :param rules: rules of load_data_rules
+    :param registry: line registry of line_config.load_line_registry, the default lines config if None
+    :return: (transect_ids, mask_depths): the transect id of each row after the drops and merges, None for rows
+        that are dropped, and the depth below which each row's TEMP is masked, inf where nothing is masked
+    """
+    registry = load_line_registry() if registry is None else registry
+    transect_ids = meta['transect_id'].to_numpy(dtype=object, copy=True)
+    mask_depths = np.full(len(meta), np.inf)
+    if len(rules) == 0:
+        return transect_ids, mask_depths
+    rule_lines = {line for line, _ in rules}
+
+    times = meta['TIME'].values
+    stations = meta['Institution_unique_identifier'].to_numpy(dtype=str)
+    lats = meta['LATITUDE'].to_numpy(dtype=float)
+    lons = meta['LONGITUDE'].to_numpy(dtype=float)
+    lons = np.where(lons < 0, lons + 360, lons)
+    soop_lines = np.asarray(meta['SOOP_line'], dtype=str)
+
+    rows_by_transect = transect_rows(meta)
+    merges = []
+    for transect, rows in rows_by_transect.items():
+        # the line of a transect is the line of its first profile
+        line = resolve_line(soop_lines[rows[0]], registry)
+        if line not in rule_lines:
+            continue
+        transect_rules = rules.get((line, None), []) + rules.get((line, transect_key(transect)), [])
+        # the profiles that profile rules number, those left by the region drops
+        numbered = rows
+        for rule in sorted(transect_rules, key=lambda rule: ACTION_ORDER.get(rule['action'], len(ACTION_ORDER))):
+            action = rule['action']
+            if action == 'drop_transect':
+                transect_ids[rows] = None
+                print('Entire transect removed: %s (rule %d) %s' % (transect, rule['number'], rule['comment']))
+                break
+            if action == 'merge':
+                merges.append((transect, rule))
+                continue
+            selected = _selected_rows(rule, numbered, times, stations, lons, lats)
+            if len(selected) == 0:
+                continue
+            if action == 'drop_region':
+                numbered = numbered[~np.isin(numbered, selected)]
+            if action == 'mask_below':
+                mask_depths[selected] = np.minimum(mask_depths[selected], rule['depth'])
+                print('Transect %s: %d profiles masked below %g m (rule %d) %s'
+                      % (transect, len(selected), rule['depth'], rule['number'], rule['comment']))
+            else:
+                transect_ids[selected] = None
+                print('Transect %s: %d profiles removed (rule %d) %s'
+                      % (transect, len(selected), rule['number'], rule['comment']))
+
+    for transect, rule in merges:
+        target = transect[:len(transect) - len(transect_key(transect))] + rule['into']
+        rows = rows_by_transect[transect]
+        rows = rows[transect_ids[rows] == transect]
+        if len(rows) == 0 or target not in rows_by_transect or \
+                not np.any(transect_ids[rows_by_transect[target]] == target):
+            print('Transect %s not merged into %s (rule %d): one of them is not there'
+                  % (transect, target, rule['number']))
+            continue
+        transect_ids[rows] = target
+        print('Transect %s merged into %s (rule %d) %s' % (transect, target, rule['number'], rule['comment']))
+    return transect_ids, mask_depths
+
+
+def mask_profiles(temp, v_grid, mask_depths):
+    """Mask in place the TEMP of each row of temp deeper than its mask depth, see apply_data_rules"""
+    rows = np.flatnonzero(np.isfinite(mask_depths))
+    if len(rows) > 0:
+        below = np.asarray(v_grid)[None, :] > mask_depths[rows, None]
+        temp[rows] = np.where(below, np.nan, temp[rows])
+    return temp
@@ -0,0 +1,61 @@
+# Find profiles that are copies of the same XBT drop, e.g. a file found in two THREDDS folders or released again,
+# from the per-profile metadata table alone, so only one copy is read, interpolated and written.
+# Two profiles are copies when they have the same station id (Institution_unique_identifier) and their time and
+# position agree within a tolerance. Profiles are sorted by station then time, so the copies of a drop are
+# consecutive rows and each is compared with the one before it in one vectorized pass.
+# Of each set of copies the newest file (latest mtime) is kept, or the one whose path sorts last when the mtimes
+# are equal or unknown (remote urls).
+import numpy as np
+import pandas as pd
+
+from profile_cache import file_fingerprint
+
+# copies may differ by a corrected time or a rounded position
+TIME_TOLERANCE = 600
+POSITION_TOLERANCE = 0.05
+# station ids that do not identify a drop
+UNKNOWN_STATIONS = ['', 'Unknown']
+
+
+def find_duplicates(meta, time_tolerance=TIME_TOLERANCE, position_tolerance=POSITION_TOLERANCE):
+    """
+    Find the copies of the same drop among the profiles of meta.
+    :param meta: profile metadata table of profile_store, with its 'path' column
+    :param time_tolerance: seconds the TIME of two copies may differ by
+    :param position_tolerance: degrees the LATITUDE and LONGITUDE of two copies may each differ by
+    :return: DataFrame of the profiles to drop, indexed by their row in meta, with their path, station, TIME,
+        LATITUDE and LONGITUDE and the path of the copy that is kept, in path order
+    """
+    stations = meta['Institution_unique_identifier'].to_numpy(dtype=str)
+    times = meta['TIME'].values.astype('datetime64[ns]').astype(np.int64)
+    lats = meta['LATITUDE'].to_numpy(dtype=float)
+    lons = meta['LONGITUDE'].to_numpy(dtype=float)
+    paths = meta['path'].to_numpy(dtype=str)
+
+    # rows of known stations, by station then time
+    rows = np.flatnonzero(~np.isin(stations, UNKNOWN_STATIONS))
+    rows = rows[np.lexsort((times[rows], stations[rows]))]
+    station, time, lat, lon = stations[rows], times[rows], lats[rows], lons[rows]
+    dlon = np.abs(np.diff(lon))
+    same = (station[1:] == station[:-1]) & (np.diff(time) <= time_tolerance * 1e9) & \
+        (np.abs(np.diff(lat)) <= position_tolerance) & (np.minimum(dlon, 360 - dlon) <= position_tolerance)
+    group = np.cumsum(np.r_[True, ~same])
+    in_set = np.r_[same, False] | np.r_[False, same]
+    rows, group = rows[in_set], group[in_set]
+
+    columns = ['path', 'Institution_unique_identifier', 'TIME', 'LATITUDE', 'LONGITUDE']
+    if len(rows) == 0:
+        return pd.DataFrame({col: meta[col].iloc[:0] for col in columns} | {'kept': paths[:0]},
+                            index=pd.Index([], dtype=np.int64))
+
+    # the newest file of each set is kept, ties going to the path that sorts last
+    mtimes = np.array([file_fingerprint(p)[1] for p in paths[rows]], dtype=np.int64)
+    order = np.lexsort((paths[rows], mtimes, group))
+    rows, group = rows[order], group[order]
+    last = np.r_[group[1:] != group[:-1], True]
+    kept = rows[last][np.cumsum(np.r_[0, last[:-1]])]
+
+    duplicates = pd.DataFrame({col: np.asarray(meta[col])[rows[~last]] for col in columns},
+                              index=pd.Index(rows[~last], dtype=np.int64))
+    duplicates['kept'] = paths[kept[~last]]
+    return duplicates.sort_values('path', kind='stable')
@@ -0,0 +1,338 @@
+# grid transect files horizontally onto the per-line lon or lat grids by objective mapping,
+# the Python version of matlab/grid_simple.m
+import os
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.linalg import cho_factor, cho_solve
+
+from utils import HDF5_LOCK
+from line_config import load_line_registry, line_settings
+from bathymetry import open_bathymetry, bathymetry_depths
+
+# small e-folding scale in stations and the noise variances of the large and small scale fits of hinterp_objmap
+EFOLD_SMALL = 2
+NOISE_LARGE = 0.1
+NOISE_SMALL = 0.3  # 0.02 in Roemmich (1983)
+
+EARTH_RADIUS = 6371000
+
+
+def line_grid(line, registry=None):
+    """Return the settings of a line from the lines config (see line_config), checking it has a horizontal grid"""
+    settings = line_settings(line, registry)
+    if settings['grid'] is None:
+        raise ValueError('transect %r has no horizontal grid, add it to the lines config' % line)
+    return settings
+
+
+def distance(lons, lats):
+    """Distances in m between consecutive points on a spherical earth, as gsw_distance at the sea surface"""
+    lons = np.radians(np.asarray(lons, dtype=float))
+    lats = np.radians(np.asarray(lats, dtype=float))
+    dlon = np.diff(lons)
+    dlat = np.diff(lats)
+    a = np.sin(0.5 * dlat) ** 2 + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(0.5 * dlon) ** 2
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def make_unique(arr, epsilon=1e-4):
+    """
+    Make the values of arr unique by adding epsilon times the number of earlier occurrences to repeated values,
+    keeping the order, until no value repeats. NaNs are left as they are.
+    """
+    arr = np.array(arr, dtype=float)
+    while True:
+        finite = arr[~np.isnan(arr)]
+        if len(np.unique(finite)) == len(finite):
+            return arr
+        order = np.argsort(arr, kind='stable')
+        sorted_arr = arr[order]
+        starts = np.r_[True, sorted_arr[1:] != sorted_arr[:-1]]
+        positions = np.arange(len(arr))
+        # number of earlier occurrences of the same value
+        rank = positions - np.maximum.accumulate(np.where(starts, positions, 0))
+        arr[order] = sorted_arr + epsilon * rank
+
+
+def _interp_nan(x, xp, fp):
+    """Linear interpolation like MATLAB interp1, NaN outside the range of xp"""
+    return np.interp(x, xp, fp, left=np.nan, right=np.nan)
+
+
+def _objmap_weights(x1, efold1, cache):
+    """
+    Weights of the objective mapping from stations at x1 (in station units), which is linear in the data:
+    (r, B1, B2) such that mred = r @ z, w1 = B1 @ z and w2 = B2 @ z. Each covariance is factorized once and the
+    weights only depend on the station offsets, so they are cached on them.
+    """
+    key = tuple(x1 - x1[0])
+    if key not in cache:
+        n = len(x1)
+        xn = x1[:, None] - x1[None, :]
+        gaus1 = np.exp(-xn ** 2 / efold1 ** 2)
+        acov1_inv = cho_solve(cho_factor(gaus1 + np.eye(n) * NOISE_LARGE), np.eye(n))
+        # spatial mean with red spectra (Bretherton et al., 1976)
+        r = acov1_inv.sum(axis=0) / acov1_inv.sum()
+        # removes the mean from the data
+        demean = np.eye(n) - r[None, :]
+        b1 = acov1_inv @ demean
+        acov2 = np.exp(-np.abs(xn) / EFOLD_SMALL) + np.eye(n) * NOISE_SMALL
+        b2 = cho_solve(cho_factor(acov2), demean - gaus1 @ b1)
+        cache[key] = r, b1, b2
+    return cache[key]
+
+
+def hinterp_objmap(temp, x, maxp, pr_grid, x_grid, efold1):
+    """
+    Horizontal interpolation at constant depth by objective mapping (Roemmich, 1983), as hinterp_objmap in
+    grid_simple.m: grid points between two stations are mapped from the six stations on both sides, with a large
+    scale Gaussian fit around the red spectrum mean and a small scale exponential fit of its residuals.
+    The fits are linear in the data, so the weights of the stations are solved for once per set of valid stations
+    (one factorization of each covariance, applied to all right-hand sides) and then applied to all depth levels
+    with that set of valid stations in one product.
+
+    :param temp: (n_stations, n_depth) temperatures at the stations x and depths pr_grid
+    :param x: along transect distance of the stations, increasing
+    :param maxp: bottom depth at the stations
+    :param pr_grid: depths of temp
+    :param x_grid: along transect distance of the grid points
+    :param efold1: large e-folding scale in stations
+    :return: (zinterp, maxpinterp) where zinterp is (n_grid, n_depth), NaN below the bottom, and maxpinterp is the
+        bottom depth at the grid points
+
+    Roemmich D., Optimal Estimation Of Hydrographic Station Data and Derived Fields,
+    Journal of Physical Oceanography, 13, 1544-1549, Aug 1983.
+    Credit: GO-SHIP-Easy-Ocean https://github.com/kkats/GO-SHIP-Easy-Ocean
+    """
+    temp = np.asarray(temp, dtype=float)
+    x = np.asarray(x, dtype=float)
+    x_grid = np.asarray(x_grid, dtype=float)
+    n_stations, n_depth = temp.shape
+    zinterp = np.full((len(x_grid), n_depth), np.nan)
+    valid = ~np.isnan(temp)
+    cache = {}
+
+    # station by station
+    for i in range(n_stations - 1):
+        # grids between i and (i+1), and all grids from the last but one station on
+        if i >= n_stations - 2:
+            ih = np.nonzero(x[i] <= x_grid)[0]
+        else:
+            ih = np.nonzero((x[i] <= x_grid) & (x_grid < x[i + 1]))[0]
+        if len(ih) == 0:
+            continue
+        # x_h is measured in station units, NaN beyond the last station as there is no extrapolation
+        x_h = _interp_nan(x_grid[ih], x[i:i + 2], [i, i + 1])
+
+        # six stations on both sides are included
+        irange = np.arange(max(0, i - 6), min(i + 8, n_stations))
+        # group the depth levels by their valid stations
+        bits = 1 << np.arange(len(irange))
+        codes, inverse = np.unique(bits @ valid[irange], return_inverse=True)
+        for p, code in enumerate(codes):
+            if code == 0:
+                continue  # no extrapolation
+            pattern = (code & bits) > 0
+            levels = np.nonzero(inverse == p)[0]
+            x1 = irange[pattern].astype(float)
+            z1 = temp[np.ix_(irange[pattern], levels)]
+
+            r, b1, b2 = _objmap_weights(x1, efold1, cache)
+            # gridding: mean, large scale Gaussian and small scale exponential fits (Roemmich, 1983)
+            xh = x1[None, :] - x_h[:, None]
+            weights = r[None, :] + np.exp(-xh ** 2 / efold1 ** 2) @ b1 + np.exp(-np.abs(xh) / EFOLD_SMALL) @ b2
+            zinterp[np.ix_(ih, levels)] = weights @ z1
+
+    # bottom depth
+    maxpinterp = _interp_nan(x_grid, x, maxp)
+    # mask all (spurious) data below bottom
+    zinterp[np.asarray(pr_grid)[None, :] > maxpinterp[:, None]] = np.nan
+    return zinterp, maxpinterp
+
+
+def gebco_depths(gebco_file, lats, lons):
+    """
+    Bottom depths (positive down) at lats, lons, interpolated bilinearly from a GEBCO netCDF file
+    as matlab/utils/get_gebco_bathy.m does
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    with HDF5_LOCK, xr.open_dataset(gebco_file) as ds:
+        lat_name = 'lat' if 'lat' in ds.coords else 'latitude'
+        lon_name = 'lon' if 'lon' in ds.coords else 'longitude'
+        height_name = 'elevation' if 'elevation' in ds.variables else 'height'
+        if float(ds[lon_name].max()) <= 180:
+            lons = np.where(lons > 180, lons - 360, lons)
+        # read the region around the points only, broadened by 0.1 degree so it encloses all of them
+        region = ds[height_name].sel({lat_name: slice(np.nanmin(lats) - 0.1, np.nanmax(lats) + 0.1),
+                                      lon_name: slice(np.nanmin(lons) - 0.1, np.nanmax(lons) + 0.1)}).load()
+    heights = region.astype(float).interp({lat_name: xr.DataArray(lats, dims='points'),
+                                           lon_name: xr.DataArray(lons, dims='points')})
+    return -heights.values
+
+
+def grid_transect(transect, line, bathymetry=None, registry=None):
+    """
+    Grid one transect horizontally along the lon or lat grid of its line, as grid_simple.m.
+    Profiles are sorted along the line axis, which is made strictly increasing, and the transect is gridded in
+    chunks separated by gaps of more than the line's gaps setting, so there is no interpolation across the gaps.
+
+    :param transect: dict of LATITUDE, LONGITUDE, TIME (n_profiles), DEPTH (n_depth) and TEMP
+        (n_profiles x n_depth), e.g. from read_transect_nc
+    :param line: line whose grid, gaps and e-folding scale are used, see line_config
+    :param bathymetry: bottom depth at each profile (positive down), or None to not mask data below the bottom
+    :param registry: line registry of line_config.load_line_registry, the default lines config if None
+    :return: the transect with the profiles kept, in grid order, and its bottom depths 'bath', plus LAT_grid,
+        LON_grid, TEMP_interp (n_grid x n_depth) and bath_grid, or None if less than 5 profiles are left
+    """
+    settings = line_grid(line, registry)
+    grid = settings['grid']
+    temp = np.asarray(transect['TEMP'], dtype=float)
+    bath = np.full(len(temp), np.nan) if bathymetry is None else np.asarray(bathymetry, dtype=float)
+
+    # remove any profiles with less than 2 data points
+    keep = np.sum(~np.isnan(temp), axis=1) >= 2
+    lats = np.asarray(transect['LATITUDE'], dtype=float)[keep]
+    # ensure LONGITUDE is in 360 degrees
+    lons = np.asarray(transect['LONGITUDE'], dtype=float)[keep]
+    lons = np.where(lons < 0, lons + 360, lons)
+    times = np.asarray(transect['TIME'])[keep]
+    temp = temp[keep]
+    bath = make_unique(bath[keep])
+
+    # sort the profiles along the line and make the axis monotonic
+    if settings['axis'] == 'LONGITUDE':
+        order = np.argsort(lons, kind='stable')
+        lons = make_unique(lons[order])
+        lats = lats[order]
+        ll = lons
+    else:
+        order = np.argsort(lats, kind='stable')
+        lats = make_unique(lats[order])
+        lons = lons[order]
+        ll = lats
+    times, temp, bath = times[order], temp[order], bath[order]
+
+    if len(times) < 5:
+        print('File: has less than 5 profiles')
+        return None
+
+    if settings['axis'] == 'LATITUDE':
+        lat_grid = grid
+        lon_grid = _interp_nan(grid, lats, lons)
+    else:
+        lon_grid = grid
+        lat_grid = _interp_nan(grid, lons, lats)
+    temp_interp = np.full((len(grid), temp.shape[1]), np.nan)
+    bath_grid = np.full(len(grid), np.nan)
+
+    # chunks separated by gaps of at least settings['gaps'] degrees
+    breaks = np.nonzero(np.abs(np.diff(ll)) >= settings['gaps'])[0] + 1
+    chunk_starts = np.r_[0, breaks]
+    chunk_ends = np.r_[breaks, len(ll)]
+
+    # interpolate in chunks, do not interpolate over the gaps
+    for start, end in zip(chunk_starts, chunk_ends):
+        # skip if less than 2 locations in chunk
+        if end - start < 2:
+            continue
+        in_grid = (grid >= ll[start:end].min()) & (grid <= ll[start:end].max())
+        la_grid = lat_grid[in_grid]
+        lo_grid = lon_grid[in_grid]
+        if len(lo_grid) < 2:
+            # grid_simple.m stops gridding the transect here
+            break
+
+        x = np.r_[0, np.cumsum(distance(lons[start:end], lats[start:end]))]
+        x1 = distance([lons[start], lo_grid[0]], [lats[start], la_grid[0]])
+        # as in grid_simple.m, the grid distances after the first point are not offset by x1
+        x_grid = np.r_[x1, np.cumsum(distance(lo_grid, la_grid))]
+
+        temp_interp[in_grid], bath_grid[in_grid] = hinterp_objmap(temp[start:end], make_unique(x), bath[start:end],
+                                                                  transect['DEPTH'], x_grid, settings['efold'])
+
+    gridded = dict(transect)
+    gridded.update({'LATITUDE': lats, 'LONGITUDE': lons, 'TIME': times, 'TEMP': temp, 'bath': bath,
+                    'LAT_grid': lat_grid, 'LON_grid': lon_grid, 'TEMP_interp': temp_interp, 'bath_grid': bath_grid})
+    return gridded
+
+
+def read_transect_nc(filepath):
+    """Read a transect file of transect_vertical_grid into a dict of arrays and its global attributes"""
+    with HDF5_LOCK, xr.open_dataset(filepath) as ds:
+        transect = {'LATITUDE': ds['LATITUDE'].values, 'LONGITUDE': ds['LONGITUDE'].values,
+                    'TIME': ds['TIME'].values, 'DEPTH': ds['DEPTH'].values.astype(float),
+                    'TEMP': ds['TEMP'].values.astype(float)}
+        transect['atts'] = dict(ds.attrs)
+    return transect
+
+
+def write_grid_nc(output_folder, gridded):
+    """Write a gridded transect to <transect_id>.nc in output_folder and return its path"""
+    transect_id = gridded['atts']['transect_id']
+    ds = xr.Dataset(
+        {'TEMP': (('GRID', 'DEPTH'), gridded['TEMP_interp'].astype(np.float32)),
+         'LATITUDE': ('GRID', gridded['LAT_grid']),
+         'LONGITUDE': ('GRID', gridded['LON_grid']),
+         'BOTTOM_DEPTH': ('GRID', gridded['bath_grid'])},
+        coords={'DEPTH': gridded['DEPTH']},
+        attrs={'transect_id': transect_id, 'SOOP_line_label': gridded['atts'].get('SOOP_line_label', ''),
+               'time_mean': pd.DatetimeIndex(gridded['TIME']).mean().strftime('%Y-%m-%dT%H:%M:%SZ'),
+               'num_profiles': len(gridded['TIME'])})
+    netcdf_filepath = Path(output_folder) / f'{transect_id}.nc'
+    with HDF5_LOCK:
+        ds.to_netcdf(netcdf_filepath, encoding={'TEMP': {'zlib': True, 'complevel': 4, '_FillValue': -9999.9}})
+    return netcdf_filepath
+
+
+def grid_transect_files(input_directory, output_directory, line, gebco_file=None, registry=None, tiles_dir=None):
+    """
+    Grid every transect file of input_directory along the grid of line and write the gridded files
+    :param gebco_file: GEBCO netCDF file to mask data below the bottom, read around each transect if tiles_dir is None
+    :param tiles_dir: folder of bathymetry tiles (see bathymetry.py) serving the bottom depths of all transects,
+        converted from gebco_file on first use
+    """
+    registry = load_line_registry() if registry is None else registry
+    line_grid(line, registry)
+    service = open_bathymetry(str(tiles_dir), gebco_file) if tiles_dir is not None else None
+    os.makedirs(output_directory, exist_ok=True)
+    filenames = sorted(f for f in os.listdir(input_directory) if f.endswith('.nc'))
+    for filename in filenames:
+        transect = read_transect_nc(os.path.join(input_directory, filename))
+        trans_id = transect['atts'].get('transect_id', filename)
+        # e.g. PX32 and PX34 transects are both gridded along PX32_34
+        if transect['atts'].get('SOOP_line_label', line) not in line:
+            print('File %s is not on line %s, skipped' % (trans_id, line))
+            continue
+        bathymetry = None
+        if service is not None:
+            bathymetry = bathymetry_depths(service, transect['LATITUDE'], transect['LONGITUDE'])
+        elif gebco_file is not None:
+            bathymetry = gebco_depths(gebco_file, transect['LATITUDE'], transect['LONGITUDE'])
+        gridded = grid_transect(transect, line, bathymetry=bathymetry, registry=registry)
+        if gridded is None:
+            print('File %s not gridded' % trans_id)
+            continue
+        write_grid_nc(output_directory, gridded)
+        print('Horizontal gridding completed: %s' % trans_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Grid transect files horizontally along the grid of their line')
+    parser.add_argument('input_directory', help='folder of transect files written by transect_vertical_grid')
+    parser.add_argument('output_directory', help='folder to write the gridded files to')
+    parser.add_argument('line', help='line whose grid is used, a line of the lines config')
+    parser.add_argument('--gebco', default=os.environ.get('GEBCO_PATH'),
+                        help='GEBCO netCDF file to mask data below the bottom (default: $GEBCO_PATH)')
+    parser.add_argument('--bathymetry-tiles', default=os.environ.get('GEBCO_TILES'),
+                        help='folder of memory mapped bathymetry tiles, converted from --gebco the first time '
+                             '(default: $GEBCO_TILES)')
+    parser.add_argument('--lines-config', default='soopLines.csv',
+                        help='csv file of the per-line settings (default: soopLines.csv)')
+    args = parser.parse_args()
+    grid_transect_files(args.input_directory, args.output_directory, args.line, gebco_file=args.gebco,
+                        registry=load_line_registry(args.lines_config), tiles_dir=args.bathymetry_tiles)
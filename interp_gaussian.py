@@ -1,4 +1,6 @@
 # grid temperature data vertically using Gaussian interpolation
+import heapq
+
 import numpy as np
 from scipy.interpolate import interp1d
 from scipy.ndimage import gaussian_filter1d
@@ -20,7 +22,7 @@ def vinterp_gauss_simple(depths, data, v_grid, half_width=11):
 
     depths = depths[valid]
     data = data[valid]
-    sort_idx = np.argsort(depths)
+    sort_idx = np.argsort(depths, kind='stable')
     depths = depths[sort_idx]
     data = data[sort_idx]
 
@@ -59,4 +61,534 @@ def vinterp_gauss_simple(depths, data, v_grid, half_width=11):
                 zsmooth[1] = mean_shallow
 
 
-    return zsmooth
\ No newline at end of file
+    return zsmooth
+
+def _as_profiles(profiles):
+    """
+    Return profiles as given if they are a padded 2D array, otherwise as a list of 1D arrays
+    """
+    if isinstance(profiles, np.ndarray) and profiles.ndim == 2:
+        return profiles
+    return [p if isinstance(p, np.ndarray) and p.ndim == 1 else np.ravel(p) for p in profiles]
+
+
+def _profiles_dtype(profiles):
+    """Common floating point dtype of a padded array or list of profiles"""
+    if isinstance(profiles, np.ndarray):
+        dtype = profiles.dtype
+    else:
+        dtype = np.result_type(*{p.dtype for p in profiles}) if profiles else np.float64
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.float64
+    return dtype
+
+
+def _stack_profiles(profiles, rows, width, dtype):
+    """Stack the selected profiles into a (len(rows) x width) array padded with NaN"""
+    if isinstance(profiles, np.ndarray):
+        return profiles[rows, :width].astype(dtype, copy=False)
+    stacked = np.full((len(rows), width), np.nan, dtype=dtype)
+    # width is that of the longest profile
+    for i, row in enumerate(rows):
+        p = profiles[row]
+        stacked[i, :len(p)] = p
+    return stacked
+
+
+def vinterp_gauss_batch(depths, data, v_grid, half_width=11, chunk_size=256, window_chunk_size=32):
+    """
+    Batched version of vinterp_gauss_simple for many profiles at once.
+
+    :param depths: ragged sequence of 1D depth arrays, or a NaN padded (n_profiles x n_samples) array
+    :param data: temperatures matching depths, in the same layout
+    :param v_grid: target depth grid
+    :param half_width: smoothing half width in depth units, as for vinterp_gauss_simple
+    :param chunk_size: number of profiles stacked and matched to the depth grids at a time
+    :param window_chunk_size: number of profiles off the depth grids smoothed together in one vectorised step
+    :return: (n_profiles x len(v_grid)) array, row i equal to
+        vinterp_gauss_simple(depths[i], data[i], v_grid, half_width) to floating point rounding
+
+    The Gaussian is only evaluated at the two samples either side of each v_grid depth
+    rather than along the whole profile, which is all the linear interpolation needs.
+    XBT depths come from the fall rate equation at a fixed sampling rate, so most profiles hold the first
+    samples of a few shared depth grids. Those of a grid and spacing are smoothed by one matrix product with the
+    kernel weights at the v_grid depths (see _vinterp_gauss_grid), the others one by one (_vinterp_gauss_chunk).
+    Profiles with fewer than 5 valid samples, or with no positive depth spacing,
+    return a row of NaN.
+    """
+    v_grid = np.asarray(v_grid).flatten()
+    depths = _as_profiles(depths)
+    data = _as_profiles(data)
+
+    # find how far along each profile the data extends, to keep the padding small
+    if isinstance(depths, np.ndarray) and isinstance(data, np.ndarray):
+        if depths.shape != data.shape:
+            raise ValueError('depths and data must have the same shape, got %s and %s'
+                             % (depths.shape, data.shape))
+        valid = ~(np.isnan(depths) | np.isnan(data))
+        extent = depths.shape[1] - np.argmax(valid[:, ::-1], axis=1)
+        extent[~valid.any(axis=1)] = 0
+    else:
+        if len(depths) != len(data):
+            raise ValueError('depths and data must hold the same number of profiles, got %d and %d'
+                             % (len(depths), len(data)))
+        extent = np.array([len(d) for d in depths], dtype=int)
+        if not np.array_equal(extent, [len(t) for t in data]):
+            raise ValueError('depths and data profiles must have matching lengths')
+
+    zsmooth = np.full((len(extent), len(v_grid)), np.nan)
+    depth_dtype = _profiles_dtype(depths)
+    data_dtype = _profiles_dtype(data)
+
+    # process profiles of similar length together, longest first so a depth grid is found from its longest profile
+    order = np.argsort(extent, kind='stable')[::-1]
+    order = order[extent[order] >= 5]
+    grids = []
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        width = extent[chunk].max()
+        chunk_depths = _stack_profiles(depths, chunk, width, depth_dtype)
+        chunk_data = _stack_profiles(data, chunk, width, data_dtype)
+        valid = ~(np.isnan(chunk_depths) | np.isnan(chunk_data))
+        n_valid = valid.sum(axis=1)
+        rest = np.ones(len(chunk), dtype=bool)
+        for grid, on_grid in _match_grids(chunk_depths, n_valid, extent[chunk], grids):
+            if on_grid.all():
+                zsmooth[chunk] = _vinterp_gauss_grid(grid, chunk_data, n_valid, v_grid, half_width)
+            else:
+                zsmooth[chunk[on_grid]] = _vinterp_gauss_grid(grid, chunk_data[on_grid], n_valid[on_grid],
+                                                              v_grid, half_width)
+            rest &= ~on_grid
+        rest = np.flatnonzero(rest)
+        for start in range(0, len(rest), window_chunk_size):
+            rows = rest[start:start + window_chunk_size]
+            width = extent[chunk[rows]].max()
+            zsmooth[chunk[rows]] = _vinterp_gauss_chunk(chunk_depths[rows, :width], chunk_data[rows, :width],
+                                                        v_grid, half_width)
+
+    return zsmooth
+
+
+# a profile becomes a depth grid if at least this many profiles of its chunk hold the first samples of its depths
+MIN_GRID_PROFILES = 8
+
+
+def _on_grid(depths, n_valid, extent, grid):
+    """Rows of NaN padded depths that are the first n_valid depths of grid, with valid data at every one"""
+    width = min(depths.shape[1], len(grid))
+    same = (depths[:, :width] == grid[:width]) | (np.arange(width)[None, :] >= extent[:, None])
+    return same.all(axis=1) & (n_valid == extent) & (extent <= len(grid))
+
+
+def _match_grids(depths, n_valid, extent, grids):
+    """
+    Yield (grid, rows on it) for the rows of a chunk that are on a depth grid of grids, then on new grids taken
+    from the longest rows on none yet, if in depth order and shared by at least MIN_GRID_PROFILES rows. New grids
+    are added to grids
+    """
+    rest = np.ones(len(depths), dtype=bool)
+    for grid in grids:
+        if not rest.any():
+            return
+        on_grid = rest & _on_grid(depths, n_valid, extent, grid['depths'])
+        if on_grid.any():
+            yield grid, on_grid
+            rest &= ~on_grid
+    while rest.sum() >= MIN_GRID_PROFILES:
+        candidate = np.flatnonzero(rest & (n_valid == extent))
+        if len(candidate) == 0:
+            return
+        row = candidate[np.argmax(extent[candidate])]
+        grid_depths = depths[row, :extent[row]].copy()
+        on_grid = rest & _on_grid(depths, n_valid, extent, grid_depths)
+        if on_grid.sum() < MIN_GRID_PROFILES or (np.diff(grid_depths) < 0).any():
+            return
+        grids.append({'depths': grid_depths, 'medians': None, 'plans': {}})
+        yield grids[-1], on_grid
+        rest &= ~on_grid
+
+
+def _prefix_medians(diffs):
+    """
+    The two middle values of the first m diffs for every m, which np.median of them averages when m is even:
+    (lower, upper), both of length len(diffs) + 1 and NaN at m = 0. A running median over two heaps
+    """
+    lower = np.full(len(diffs) + 1, np.nan)
+    upper = np.full(len(diffs) + 1, np.nan)
+    low, high = [], []
+    for m, value in enumerate(diffs.tolist(), start=1):
+        # low holds the smaller half (negated, as a max heap), one more than high when m is odd
+        if low and value > -low[0]:
+            heapq.heappush(high, value)
+        else:
+            heapq.heappush(low, -value)
+        if len(low) > len(high) + 1:
+            heapq.heappush(high, -heapq.heappop(low))
+        elif len(high) > len(low):
+            heapq.heappush(low, -heapq.heappop(high))
+        lower[m] = -low[0]
+        upper[m] = -low[0] if m % 2 == 1 else high[0]
+    return lower.astype(diffs.dtype), upper.astype(diffs.dtype)
+
+
+def _grid_plan(grid_depths, sigma, v_grid, levels_per_block=8):
+    """
+    Weights giving gaussian_filter1d(mode='nearest', sigma) of data on grid_depths at the two samples either side
+    of each v_grid depth inside the grid, as blocks of v_grid levels, each a matrix over the samples it spans.
+    Samples past the end of the grid are the last value of each profile, so only the start is folded as
+    mode='nearest' does
+    """
+    # the kernel of gaussian_filter1d
+    sd = float(sigma)
+    radius = int(4.0 * sd + 0.5)
+    x = np.arange(-radius, radius + 1)
+    phi_x = np.exp(-0.5 / (sd * sd) * x ** 2)
+    phi_x = (phi_x / phi_x.sum())[::-1]
+
+    # interp1d: bracketing samples of the v_grid depths inside the grid
+    hi = np.clip(grid_depths.searchsorted(v_grid), 1, len(grid_depths) - 1)
+    lo = hi - 1
+    levels = np.flatnonzero((v_grid >= grid_depths[0]) & (v_grid <= grid_depths[-1]))
+    blocks = []
+    for start in range(0, len(levels), levels_per_block):
+        block = levels[start:start + levels_per_block]
+        first = max(lo[block].min() - radius, 0)
+        stop = lo[block].max() + radius + 2
+        # one column per bracketing sample, lo and lo + 1 of each level in turn
+        centres = np.stack([lo[block], lo[block] + 1], axis=1).ravel()
+        weights = np.zeros((stop - first, len(centres)))
+        samples = np.maximum(centres[None, :] + x[:, None], 0) - first
+        np.add.at(weights, (samples, np.broadcast_to(np.arange(len(centres)), samples.shape)), phi_x[:, None])
+        blocks.append({'levels': block, 'first': first, 'stop': stop, 'weights': weights,
+                       'x_lo': grid_depths[lo[block]], 'x_hi': grid_depths[hi[block]]})
+    return blocks
+
+
+def _vinterp_gauss_grid(grid, data, n_valid, v_grid, half_width):
+    """
+    _vinterp_gauss_chunk of NaN padded profiles whose depths are the first n_valid depths of a grid of
+    _match_grids, as one matrix product per block of levels of _grid_plan for the profiles of each spacing
+    """
+    grid_depths = grid['depths']
+    n_rows = len(data)
+    zsmooth = np.full((n_rows, len(v_grid)), np.nan)
+
+    # median spacing of the first n_valid depths, as in _vinterp_gauss_chunk
+    if grid['medians'] is None:
+        grid['medians'] = _prefix_medians(np.diff(grid_depths))
+    dd_lo, dd_hi = grid['medians'][0][n_valid - 1], grid['medians'][1][n_valid - 1]
+    dd = np.where((n_valid - 1) % 2 == 1, dd_lo, (dd_lo + dd_hi) / 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = half_width / dd
+    usable = (n_valid >= 5) & np.isfinite(sigma) & (sigma > 0)
+    last_depth = grid_depths[n_valid - 1]
+
+    for value in np.unique(sigma[usable]):
+        rows = np.flatnonzero(usable & (sigma == value))
+        if float(value) not in grid['plans']:
+            grid['plans'][float(value)] = _grid_plan(grid_depths, value, v_grid)
+        blocks = [b for b in grid['plans'][float(value)] if v_grid[b['levels']].min() <= last_depth[rows].max()]
+        if len(blocks) == 0:
+            continue
+        # extend each profile with its last value, i.e. mode='nearest'
+        width = max(b['stop'] for b in blocks)
+        padded = np.empty((len(rows), width))
+        n_copy = min(width, data.shape[1])
+        padded[:, :n_copy] = data[:, :n_copy] if len(rows) == n_rows else data[rows, :n_copy]
+        tail = np.arange(width)[None, :] >= n_valid[rows][:, None]
+        np.copyto(padded, data[rows, n_valid[rows] - 1][:, None], where=tail)
+        for b in blocks:
+            y = padded[:, b['first']:b['stop']] @ b['weights']
+            y_lo = y[:, 0::2].astype(data.dtype)
+            y_hi = y[:, 1::2].astype(data.dtype)
+            # duplicate depths give 0 / 0 as in interp1d
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = (y_hi - y_lo) / (b['x_hi'] - b['x_lo'])
+            interp = slope * (v_grid[b['levels']][None, :] - b['x_lo']) + y_lo
+            in_range = v_grid[b['levels']][None, :] <= last_depth[rows][:, None]
+            if len(rows) == n_rows:
+                zsmooth[:, b['levels']] = np.where(in_range, interp, np.nan)
+            else:
+                zsmooth[rows[:, None], b['levels'][None, :]] = np.where(in_range, interp, np.nan)
+
+    n_shallow = min(max(int(grid_depths.searchsorted(np.nextafter(20, np.inf))), 1), data.shape[1])
+    _fill_surface(zsmooth, grid_depths[None, :n_shallow], data[:, :n_shallow],
+                  np.arange(n_shallow)[None, :] < n_valid[:, None])
+    return zsmooth
+
+
+def _vinterp_gauss_chunk(depths, data, v_grid, half_width):
+    """Smooth and interpolate a chunk of NaN padded profiles"""
+    n_rows, n_samples = depths.shape
+    valid = ~(np.isnan(depths) | np.isnan(data))
+    n_valid = valid.sum(axis=1)
+    zsmooth = np.full((n_rows, len(v_grid)), np.nan)
+
+    # Remove NaNs and sort, moving invalid samples to the end of each row.
+    # Profiles are nearly always gap free and in depth order already, so only reorder the ones that are not
+    extent = n_samples - np.argmax(valid[:, ::-1], axis=1)
+    holes = n_valid < extent
+    if holes.any():
+        depths = depths.copy()
+        data = data.copy()
+        keep_idx = np.argsort(~valid[holes], axis=1, kind='stable')
+        depths[holes] = np.take_along_axis(depths[holes], keep_idx, axis=1)
+        data[holes] = np.take_along_axis(data[holes], keep_idx, axis=1)
+    sorted_valid = np.arange(n_samples)[None, :] < n_valid[:, None]
+    depth_diffs = np.diff(depths, axis=1)
+    depth_diffs[~sorted_valid[:, 1:]] = np.nan
+    unsorted = (depth_diffs < 0).any(axis=1)
+    if unsorted.any():
+        if not holes.any():
+            depths = depths.copy()
+            data = data.copy()
+        sort_idx = np.argsort(np.where(sorted_valid[unsorted], depths[unsorted], np.inf), axis=1, kind='stable')
+        depths[unsorted] = np.take_along_axis(depths[unsorted], sort_idx, axis=1)
+        data[unsorted] = np.take_along_axis(data[unsorted], sort_idx, axis=1)
+        depth_diffs[unsorted] = np.diff(depths[unsorted], axis=1)
+        depth_diffs[~sorted_valid[:, 1:]] = np.nan
+
+    # Estimate grid spacing: median of the valid depth differences
+    diffs = np.sort(depth_diffs, axis=1)
+    rows = np.arange(n_rows)
+    n_diffs = np.maximum(n_valid - 1, 1)
+    dd_lo = diffs[rows, (n_diffs - 1) // 2]
+    dd_hi = diffs[rows, np.minimum(n_diffs // 2, n_samples - 2)]
+    dd = np.where(n_diffs % 2 == 1, dd_lo, (dd_lo + dd_hi) / 2)
+
+    # Convert half_width to samples and to the gaussian_filter1d kernel radius
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = half_width / dd
+    usable = (n_valid >= 5) & np.isfinite(sigma) & (sigma > 0)
+    radius = np.zeros(n_rows, dtype=int)
+    radius[usable] = (4.0 * sigma[usable].astype(float) + 0.5).astype(int)
+
+    # interp1d: bracketing sample indices and the points inside the data range
+    last = np.maximum(n_valid - 1, 1)
+    # the last needle counts the samples at or above 20 m, for the near surface fill
+    needles = np.append(v_grid, np.nextafter(20, np.inf))
+    found = np.zeros((n_rows, len(needles)), dtype=int)
+    for i in np.flatnonzero(usable):
+        found[i] = depths[i, :n_valid[i]].searchsorted(needles)
+    shallow = found[:, -1]
+    hi = np.clip(found[:, :-1], 1, last[:, None])
+    lo = hi - 1
+    in_range = usable[:, None] & (v_grid[None, :] >= depths[:, :1]) & \
+        (v_grid[None, :] <= np.take_along_axis(depths, last[:, None], axis=1))
+
+    # group rows with similar kernel radius so one outlier does not inflate every window
+    todo = np.flatnonzero(usable)
+    todo = todo[np.argsort(radius[todo], kind='stable')]
+    while len(todo) > 0:
+        group = todo[radius[todo] <= 2 * radius[todo[0]] + 8]
+        todo = todo[len(group):]
+        cols = np.flatnonzero(in_range[group].any(axis=0))
+        if len(cols) == 0:
+            continue
+        y_lo, y_hi = _gauss_at(data[group], n_valid[group], sigma[group], radius[group], lo[group][:, cols])
+        y_lo = y_lo.astype(data.dtype)
+        y_hi = y_hi.astype(data.dtype)
+        x_lo = np.take_along_axis(depths[group], lo[group][:, cols], axis=1)
+        x_hi = np.take_along_axis(depths[group], hi[group][:, cols], axis=1)
+        # duplicate depths give 0 / 0 as in interp1d
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (y_hi - y_lo) / (x_hi - x_lo)
+        interp = slope * (v_grid[cols][None, :] - x_lo) + y_lo
+        zsmooth[group[:, None], cols[None, :]] = np.where(in_range[group][:, cols], interp, np.nan)
+
+    # only the first few metres are needed to fill the first two levels
+    n_shallow = max(shallow.max(), 1)
+    _fill_surface(zsmooth, depths[:, :n_shallow], data[:, :n_shallow], sorted_valid[:, :n_shallow])
+    return zsmooth
+
+
+def _fill_surface(zsmooth, depths, data, valid):
+    """
+    If there is NaN in the first or second level of a row of zsmooth, fill it from the shallow data as
+    vinterp_gauss_simple does, in place. depths, data and valid hold the samples of the rows down to 20 m at least,
+    depths may be a single row shared by all
+    """
+    n_non_nan = np.count_nonzero(~np.isnan(zsmooth), axis=1)
+    fill = n_non_nan > 2
+    if not fill.any():
+        return
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_10 = _masked_mean(data, valid & (depths <= 10))
+        mean_20 = _masked_mean(data, valid & (depths <= 20))
+        mean_10_20 = _masked_mean(data, valid & (depths > 10) & (depths <= 20))
+    fill_0 = fill & np.isnan(zsmooth[:, 0])
+    zsmooth[fill_0, 0] = mean_10[fill_0]
+    fill_1 = fill & np.isnan(zsmooth[:, 1])
+    both = fill_1 & np.isnan(zsmooth[:, 0])
+    zsmooth[both, 0] = mean_20[both]
+    zsmooth[both, 1] = mean_20[both]
+    second = fill_1 & ~both
+    zsmooth[second, 1] = mean_10_20[second]
+
+
+def _gauss_at(data, n_valid, sigma, radius, lo):
+    """
+    gaussian_filter1d(mode='nearest') of each row of data, evaluated at samples lo and lo + 1 only
+    """
+    n_rows, n_samples = data.shape
+    max_radius = radius.max()
+    width = 2 * max_radius + 2
+
+    # the same kernels as gaussian_filter1d, zero padded to a common radius and stacked
+    # as two columns so one product gives the smoothed value at both lo and lo + 1
+    x = np.arange(-max_radius, max_radius + 1)
+    sigma2 = (sigma * sigma)[:, None]
+    phi_x = np.exp(-0.5 / sigma2 * x ** 2)
+    phi_x[np.abs(x)[None, :] > radius[:, None]] = 0
+    phi_x = (phi_x / phi_x.sum(axis=1, keepdims=True))[:, ::-1]
+    weights = np.zeros((n_rows, width, 2))
+    weights[:, :-1, 0] = phi_x
+    weights[:, 1:, 1] = phi_x
+
+    # extend each profile with its end values, i.e. mode='nearest'
+    padded = np.empty((n_rows, n_samples + width - 1))
+    padded[:, max_radius:max_radius + n_samples] = data
+    padded[:, :max_radius] = data[:, :1]
+    tail = np.arange(padded.shape[1])[None, :] >= (n_valid + max_radius)[:, None]
+    np.copyto(padded, data[np.arange(n_rows), n_valid - 1][:, None], where=tail)
+
+    # one window per interpolation interval, a few rows at a time so the windows stay in cache
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width, axis=1)
+    y = np.empty(lo.shape + (2,))
+    for start in range(0, n_rows, 8):
+        block = np.arange(start, min(start + 8, n_rows))
+        y[block] = np.matmul(windows[block[:, None], lo[block]], weights[block])
+    return y[:, :, 0], y[:, :, 1]
+
+
+def _masked_mean(data, mask):
+    """Row means of data over mask, NaN where the mask is empty"""
+    return np.where(mask, data, 0).sum(axis=1) / mask.sum(axis=1)
+
+
+def vinterp_gauss_depth(depths, data, v_grid, half_width=11, truncate=4.0):
+    """
+    Gaussian smoothing in depth units, evaluated at the v_grid depths only.
+
+    Each v_grid depth gets the Gaussian weighted mean of the valid samples within truncate * half_width of it,
+    with sigma = half_width metres whatever the sample spacing, so the smoothing width stays the same down an
+    XBT profile whose spacing changes with the fall rate. Depths with no valid sample within half_width (a gap
+    left by QC) or outside the depth range of the samples are NaN, and the first two levels are filled from the
+    shallow data as vinterp_gauss_simple does.
+    """
+    return vinterp_gauss_depth_batch([depths], [data], v_grid, half_width=half_width, truncate=truncate)[0]
+
+
+def vinterp_gauss_depth_batch(depths, data, v_grid, half_width=11, truncate=4.0, chunk_pairs=1 << 18):
+    """
+    Batched version of vinterp_gauss_depth for many profiles at once, in the layouts of vinterp_gauss_batch.
+
+    All samples go into one array sorted by profile then depth, and the window of each (profile, v_grid depth)
+    pair is found by binary search. A sample falls in the windows of the v_grid depths within truncate * half_width
+    of it, about 9 for an 11 m half width and a 10 m grid, so the cost is that many weights per sample whatever the
+    length of the profiles. Prefix sums over the sorted depths would make it one pass, but only for kernels that
+    are sums of powers of depth (boxes, polynomials), not for a Gaussian, and power sums of depths down to 2000 m
+    lose most of their digits to cancellation.
+    Profiles with fewer than 5 valid samples return a row of NaN.
+    :param chunk_pairs: about how many (sample, v_grid depth) weights are held in memory at once
+    :return: (n_profiles x len(v_grid)) array
+    """
+    v_grid = np.asarray(v_grid, dtype=float).flatten()
+    depths = _as_profiles(depths)
+    data = _as_profiles(data)
+    if len(depths) != len(data):
+        raise ValueError('depths and data must hold the same number of profiles, got %d and %d'
+                         % (len(depths), len(data)))
+    n_profiles = len(depths)
+    zsmooth = np.full((n_profiles, len(v_grid)), np.nan)
+    if n_profiles == 0:
+        return zsmooth
+
+    # the valid samples of every profile as flat arrays, by profile then depth
+    lengths = np.array([len(d) for d in depths], dtype=int)
+    if not np.array_equal(lengths, [len(t) for t in data]):
+        raise ValueError('depths and data profiles must have matching lengths')
+    profile = np.repeat(np.arange(n_profiles), lengths)
+    flat_depths = np.concatenate([np.asarray(d, dtype=float) for d in depths])
+    flat_data = np.concatenate([np.asarray(t, dtype=float) for t in data])
+    valid = ~(np.isnan(flat_depths) | np.isnan(flat_data))
+    profile, flat_depths, flat_data = profile[valid], flat_depths[valid], flat_data[valid]
+    # profiles are nearly always in depth order already
+    if ((np.diff(flat_depths) < 0) & (profile[1:] == profile[:-1])).any():
+        order = np.lexsort((flat_depths, profile))
+        profile, flat_depths, flat_data = profile[order], flat_depths[order], flat_data[order]
+    n_valid = np.bincount(profile, minlength=n_profiles)
+    usable = np.flatnonzero(n_valid >= 5)
+    if len(usable) == 0:
+        return zsmooth
+
+    # one sorted key for all profiles: depth, offset by a span per profile larger than any window reaches
+    radius = truncate * half_width
+    top = flat_depths.min()
+    span = flat_depths.max() - top + 2 * (radius + abs(v_grid).max()) + 1
+    keys = flat_depths - top + profile * span
+    start = np.r_[0, np.cumsum(n_valid)[:-1]]
+    first, last = flat_depths[start[usable]], flat_depths[start[usable] + n_valid[usable] - 1]
+
+    targets = (v_grid - top)[None, :] + (usable * span)[:, None]
+    lo = np.searchsorted(keys, targets - radius, side='left').ravel()
+    hi = np.searchsorted(keys, targets + radius, side='right').ravel()
+    near = np.searchsorted(keys, targets + half_width, side='right') - \
+        np.searchsorted(keys, targets - half_width, side='left')
+
+    # Gaussian weighted sums over the ragged windows, each window a contiguous run of samples, a chunk of pairs at
+    # a time. The weights are computed in float32, the precision of the data, and summed in float64
+    depths32 = flat_depths.astype(np.float32)
+    data32 = flat_data.astype(np.float32)
+    grid32 = v_grid.astype(np.float32)
+    counts = hi - lo
+    weighted = np.zeros(len(counts))
+    total = np.zeros(len(counts))
+    bounds = np.searchsorted(np.cumsum(counts), np.arange(1, counts.sum() // chunk_pairs + 1) * chunk_pairs)
+    for begin, end in zip(np.r_[0, bounds + 1], np.r_[bounds + 1, len(counts)]):
+        chunk_counts = counts[begin:end]
+        nonempty = np.flatnonzero(chunk_counts > 0)
+        if len(nonempty) == 0:
+            continue
+        ends = np.cumsum(chunk_counts)
+        sample = np.arange(ends[-1]) + np.repeat(lo[begin:end] - (ends - chunk_counts), chunk_counts)
+        offset = (depths32[sample] - np.repeat(grid32[np.arange(begin, end) % len(v_grid)], chunk_counts)) * \
+            np.float32(1 / half_width)
+        weights = np.exp(np.float32(-0.5) * offset * offset)
+        starts = (ends - chunk_counts)[nonempty]
+        weighted[begin + nonempty] = np.add.reduceat(weights * data32[sample], starts, dtype=float)
+        total[begin + nonempty] = np.add.reduceat(weights, starts, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        smooth = (weighted / total).reshape(len(usable), len(v_grid))
+    inside = (v_grid[None, :] >= first[:, None]) & (v_grid[None, :] <= last[:, None]) & (near > 0)
+    zsmooth[usable] = np.where(inside, smooth, np.nan)
+
+    # if there is Nan in the first to second element, fill from the shallow data as vinterp_gauss_simple does
+    fill = np.count_nonzero(~np.isnan(zsmooth), axis=1) > 2
+    if fill.any():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_10, mean_20, mean_10_20 = (
+                np.bincount(profile[mask], flat_data[mask], minlength=n_profiles) /
+                np.bincount(profile[mask], minlength=n_profiles)
+                for mask in (flat_depths <= 10, flat_depths <= 20, (flat_depths > 10) & (flat_depths <= 20)))
+        fill_0 = fill & np.isnan(zsmooth[:, 0])
+        zsmooth[fill_0, 0] = mean_10[fill_0]
+        fill_1 = fill & np.isnan(zsmooth[:, 1])
+        both = fill_1 & np.isnan(zsmooth[:, 0])
+        zsmooth[both, 0] = mean_20[both]
+        zsmooth[both, 1] = mean_20[both]
+        second = fill_1 & ~both
+        zsmooth[second, 1] = mean_10_20[second]
+    return zsmooth
+
+
+# smoothing methods of vinterp_batch: 'samples' converts half_width to samples at the median spacing of each
+# profile, 'depth' smooths in depth units
+SMOOTHING_METHODS = {'samples': vinterp_gauss_batch, 'depth': vinterp_gauss_depth_batch}
+
+
+def vinterp_batch(depths, data, v_grid, half_width=11, smoothing='samples'):
+    """Smooth and interpolate many profiles onto v_grid with one of SMOOTHING_METHODS"""
+    if smoothing not in SMOOTHING_METHODS:
+        raise ValueError('smoothing must be one of %s, got %r' % (', '.join(SMOOTHING_METHODS), smoothing))
+    return SMOOTHING_METHODS[smoothing](depths, data, v_grid, half_width=half_width)
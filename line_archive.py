@@ -0,0 +1,349 @@
+# Per-line archives of the transects: every transect of a SOOP line appended to one chunked, compressed netCDF4 file,
+# <archive folder>/<line>.nc, so a line is read from one file instead of one file per transect.
+#
+# Layout (a CF contiguous ragged array): the profiles of all transects along the unlimited PROFILE dimension, TIME,
+# LATITUDE, LONGITUDE and TEMP(PROFILE, DEPTH), chunked by ARCHIVE_CHUNK profiles, plus the transect index along
+# the unlimited TRANSECT dimension: transect_id, Cruise_ID, profile_offset and row_size (the transect's profiles are
+# PROFILE[profile_offset:profile_offset + row_size]), its first and last TIME, a digest of its data and whether a
+# later version supersedes it.
+# Transects are appended after the last profile, so the chunks of earlier transects are not rewritten (only the last,
+# partly filled chunk is), and the index entries are written after the profiles, so an interrupted append leaves at
+# worst profiles that no entry points to. A transect appended again with the same data is skipped, with other data
+# it is appended as a new version and its old entry is marked superseded.
+# Variable attributes come from netcdfVars.csv and global attributes from netcdfGlobalAtts.csv as in the per-transect
+# files, the coverage attributes spanning the whole archive and the per-transect ones (transect_id, Cruise_ID) kept
+# in the index instead.
+#
+# usage: python line_archive.py build <folder of transect files> <archive folder>
+#        python line_archive.py list <archive file>
+import hashlib
+import argparse
+from pathlib import Path
+from time import strftime, gmtime
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset, date2num
+from xarray.coding.times import decode_cf_datetime
+
+from utils import HDF5_LOCK
+from write2netcdf import load_schema
+from run_report import count
+
+# profiles per chunk of the profile variables, and transects per chunk of the index
+ARCHIVE_CHUNK = 256
+INDEX_CHUNK = 1024
+ARCHIVE_COMPLEVEL = 4
+# transects of a line buffered by archive_transects before they are appended in one go
+FLUSH_PROFILES = 4 * ARCHIVE_CHUNK
+# per-transect global attributes of the transect files, kept in the index of an archive
+INDEX_ATTRIBUTES = ['transect_id', 'Cruise_ID']
+FILL_VALUE = np.float32(-9999.9)
+
+
+def archive_path(archive_dir, line, product=''):
+    """Archive file of a SOOP line, in the subfolder of a vertical product if there are several"""
+    return Path(archive_dir) / product / f'{line}.nc'
+
+
+def payload_digest(payload):
+    """Digest of the data of a transect payload (see profile_store.transect_payload), to skip unchanged transects"""
+    digest = hashlib.sha1()
+    for key, dtype in (('TIME', 'datetime64[ns]'), ('LATITUDE', float), ('LONGITUDE', float), ('DEPTH', np.float32)):
+        digest.update(np.ascontiguousarray(payload[key], dtype=dtype).tobytes())
+    # NaN as stored, since NaNs of different bit patterns read back the same
+    temp = np.asarray(payload['TEMP'], dtype=np.float32)
+    digest.update(np.ascontiguousarray(np.where(np.isnan(temp), FILL_VALUE, temp)).tobytes())
+    return digest.hexdigest()
+
+
+def create_archive(dataset, depths, complevel=ARCHIVE_COMPLEVEL, globals_file_path='netcdfGlobalAtts.csv',
+                   vars_file_path='netcdfVars.csv'):
+    """Create the dimensions, variables and attributes of an empty archive in an open netCDF4 dataset"""
+    globals_list, var_atts = load_schema(globals_file_path, vars_file_path)
+    compression = {'zlib': complevel > 0, 'complevel': complevel or 4, 'shuffle': complevel > 0}
+    dataset.createDimension('PROFILE', None)
+    dataset.createDimension('DEPTH', len(depths))
+    dataset.createDimension('TRANSECT', None)
+
+    for name in ('TIME', 'LATITUDE', 'LONGITUDE'):
+        dataset.createVariable(name, 'f8', ('PROFILE',), chunksizes=(ARCHIVE_CHUNK,), **compression)
+    dataset.createVariable('TEMP', 'f4', ('PROFILE', 'DEPTH'), fill_value=FILL_VALUE,
+                           chunksizes=(ARCHIVE_CHUNK, len(depths)), **compression)
+    dataset.createVariable('DEPTH', 'f4', ('DEPTH',))
+    for name, atts in var_atts.items():
+        dataset.variables[name].setncatts(atts)
+    dataset.variables['DEPTH'][:] = np.asarray(depths)
+
+    for name in INDEX_ATTRIBUTES + ['digest']:
+        dataset.createVariable(name, str, ('TRANSECT',), chunksizes=(INDEX_CHUNK,))
+    dataset.createVariable('profile_offset', 'i8', ('TRANSECT',), chunksizes=(INDEX_CHUNK,))
+    dataset.createVariable('row_size', 'i4', ('TRANSECT',), chunksizes=(INDEX_CHUNK,))
+    dataset.variables['row_size'].setncatts({'long_name': 'number of profiles of the transect',
+                                             'sample_dimension': 'PROFILE'})
+    dataset.variables['profile_offset'].long_name = 'index of the first profile of the transect'
+    for name in ('time_min', 'time_max'):
+        dataset.createVariable(name, 'f8', ('TRANSECT',), chunksizes=(INDEX_CHUNK,))
+        dataset.variables[name].setncatts({key: var_atts['TIME'][key] for key in ('units', 'calendar')})
+    dataset.createVariable('superseded', 'i1', ('TRANSECT',), chunksizes=(INDEX_CHUNK,))
+    dataset.variables['superseded'].long_name = '1 if a later entry of the same transect_id replaces this one'
+
+    dataset.setncatts({name: 'Unknown' if value is None else value for name, value in globals_list.items()
+                       if name not in INDEX_ATTRIBUTES})
+    dataset.date_created = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
+
+
+def update_coverage(dataset, payloads):
+    """Widen the geospatial and time coverage attributes of an archive to the appended payloads"""
+    attributes = dataset.__dict__
+    extents = {'geospatial_lat': np.concatenate([p['LATITUDE'] for p in payloads]),
+               'geospatial_lon': np.concatenate([p['LONGITUDE'] for p in payloads]),
+               'geospatial_vertical': np.asarray(payloads[0]['DEPTH'], dtype=float)}
+    for name, values in extents.items():
+        low, high = np.nanmin(values), np.nanmax(values)
+        if isinstance(attributes.get(name + '_min'), (int, float, np.number)):
+            low, high = min(low, attributes[name + '_min']), max(high, attributes[name + '_max'])
+        dataset.setncatts({name + '_min': low, name + '_max': high})
+    times = pd.DatetimeIndex(np.concatenate([p['TIME'] for p in payloads]))
+    start, end = times.min().strftime("%Y-%m-%dT%H:%M:%SZ"), times.max().strftime("%Y-%m-%dT%H:%M:%SZ")
+    if attributes.get('time_coverage_start', 'Unknown') != 'Unknown':
+        start, end = min(start, attributes['time_coverage_start']), max(end, attributes['time_coverage_end'])
+    dataset.setncatts({'time_coverage_start': start, 'time_coverage_end': end})
+
+
+def append_transects(path, payloads, complevel=ARCHIVE_COMPLEVEL, globals_file_path='netcdfGlobalAtts.csv',
+                     vars_file_path='netcdfVars.csv'):
+    """
+    Append transects of one line to its archive, creating it if needed, with one write per variable.
+    :param path: archive file, see archive_path
+    :param payloads: list of transect payloads (see profile_store.transect_payload) on the DEPTH of the archive
+    :param complevel: zlib compression level of a new archive, 0 for none
+    :return: (number of transects appended, number skipped as unchanged)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with HDF5_LOCK, Dataset(str(path), 'a' if path.exists() else 'w', format='NETCDF4') as dataset:
+        if len(dataset.dimensions) == 0:
+            create_archive(dataset, payloads[0]['DEPTH'], complevel, globals_file_path, vars_file_path)
+            dataset.SOOP_line_label = str(payloads[0]['SOOP_line'][0])
+            dataset.SOOP_line_description = str(payloads[0]['SOOP_line_description'][0])
+        depths = dataset.variables['DEPTH'][:]
+        n_transects = len(dataset.dimensions['TRANSECT'])
+        ids = dataset.variables['transect_id'][:] if n_transects else np.array([], dtype=object)
+        digests = dataset.variables['digest'][:] if n_transects else np.array([], dtype=object)
+        current = np.flatnonzero(dataset.variables['superseded'][:] == 0) if n_transects else np.array([], dtype=int)
+        current = dict(zip(ids[current], current))
+
+        new, replaced = [], []
+        for payload in payloads:
+            if len(payload['DEPTH']) != len(depths) or not np.allclose(payload['DEPTH'], depths):
+                raise ValueError('transect %s is not on the DEPTH grid of %s' % (payload['transect_id'][0], path))
+            transect, digest = str(payload['transect_id'][0]), payload_digest(payload)
+            if transect in current and digests[current[transect]] == digest:
+                continue
+            if transect in current:
+                replaced.append(current.pop(transect))
+            new.append((payload, digest))
+        if not new:
+            return 0, len(payloads)
+
+        time_atts = dataset.variables['TIME']
+        start = len(dataset.dimensions['PROFILE'])
+        sizes = np.array([len(p['TIME']) for p, _ in new])
+        times = pd.DatetimeIndex(np.concatenate([p['TIME'] for p, _ in new])).to_pydatetime()
+        times = date2num(times, units=time_atts.units, calendar=time_atts.calendar)
+        stop = start + len(times)
+        dataset.variables['TIME'][start:stop] = times
+        dataset.variables['LATITUDE'][start:stop] = np.concatenate([p['LATITUDE'] for p, _ in new])
+        dataset.variables['LONGITUDE'][start:stop] = np.concatenate([p['LONGITUDE'] for p, _ in new])
+        temp = np.concatenate([p['TEMP'] for p, _ in new]).astype(np.float32)
+        dataset.variables['TEMP'][start:stop, :] = np.where(np.isnan(temp), FILL_VALUE, temp)
+
+        # the index last, so the new entries only ever point to profiles that are written
+        entries = slice(n_transects, n_transects + len(new))
+        offsets = start + np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        for name in INDEX_ATTRIBUTES:
+            dataset.variables[name][entries] = np.array([str(p[name][0]) for p, _ in new], dtype=object)
+        dataset.variables['digest'][entries] = np.array([digest for _, digest in new], dtype=object)
+        dataset.variables['profile_offset'][entries] = offsets
+        dataset.variables['row_size'][entries] = sizes
+        dataset.variables['time_min'][entries] = np.minimum.reduceat(times, offsets - start)
+        dataset.variables['time_max'][entries] = np.maximum.reduceat(times, offsets - start)
+        dataset.variables['superseded'][entries] = np.zeros(len(new), dtype=np.int8)
+        for entry in replaced:
+            dataset.variables['superseded'][entry] = 1
+        update_coverage(dataset, [p for p, _ in new])
+    return len(new), len(payloads) - len(new)
+
+
+def archive_transects(payloads, archive_dir, report=None, flush_profiles=FLUSH_PROFILES, **append_options):
+    """
+    Pass the payloads through, appending each transect to the archive of its line on the way (see append_transects).
+    The transects of a line are buffered and appended together once they hold flush_profiles profiles, and the
+    rest when the payloads run out, so appends write whole chunks where they can.
+    :param payloads: iterable of transect payloads, e.g. the one given to write2netcdf.write_transects
+    :param archive_dir: folder of the archives, with a subfolder per vertical product if the payloads name one
+    :param report: run report to count the transects archived and those unchanged in, see run_report
+    :param append_options: complevel, globals_file_path and vars_file_path, see append_transects
+    """
+    buffers = {}
+
+    def flush(key):
+        appended, unchanged = append_transects(archive_path(archive_dir, key[1], key[0]), buffers.pop(key),
+                                               **append_options)
+        if report is not None:
+            count(report, 'transects_archived', appended)
+            count(report, 'transects_archive_unchanged', unchanged)
+
+    for payload in payloads:
+        key = (payload.get('product', ''), str(payload['SOOP_line'][0]))
+        buffers.setdefault(key, []).append(payload)
+        if sum(len(p['TIME']) for p in buffers[key]) >= flush_profiles:
+            flush(key)
+        yield payload
+    for key in list(buffers):
+        flush(key)
+
+
+def read_index(path, superseded=False):
+    """
+    The transect index of an archive as a DataFrame with one row per transect: transect_id, Cruise_ID,
+    profile_offset, row_size, time_min and time_max (as datetimes), digest and superseded
+    :param superseded: also return the entries replaced by a later version of their transect
+    """
+    with HDF5_LOCK, Dataset(str(path)) as dataset:
+        index = read_index_variables(dataset)
+    return index if superseded else index[index['superseded'] == 0].reset_index(drop=True)
+
+
+def read_index_variables(dataset):
+    """The transect index of an open archive, see read_index"""
+    names = INDEX_ATTRIBUTES + ['profile_offset', 'row_size', 'time_min', 'time_max', 'digest', 'superseded']
+    index = pd.DataFrame({name: np.asarray(dataset.variables[name][:]) for name in names})
+    for name in ('time_min', 'time_max'):
+        index[name] = decode_times(dataset.variables[name], index[name].to_numpy())
+    return index
+
+
+def decode_times(variable, values):
+    """datetime64 values of numeric times in the units and calendar of variable"""
+    return np.asarray(decode_cf_datetime(np.asarray(values, dtype=float), variable.units, variable.calendar),
+                      dtype='datetime64[ns]')
+
+
+def read_profiles(dataset, start, stop):
+    """The profiles start to stop of an open archive, as payload arrays, with one read per variable"""
+    profiles = {'TIME': decode_times(dataset.variables['TIME'], dataset.variables['TIME'][start:stop]),
+                'LATITUDE': np.asarray(dataset.variables['LATITUDE'][start:stop]),
+                'LONGITUDE': np.asarray(dataset.variables['LONGITUDE'][start:stop]),
+                'DEPTH': np.asarray(dataset.variables['DEPTH'][:]),
+                'TEMP': dataset.variables['TEMP'][start:stop, :].filled(np.nan).astype(np.float32)}
+    return profiles
+
+
+def read_transect(path, transect_id):
+    """
+    Read one transect from an archive: its index entry, then its profiles in one read per variable.
+    :return: dict of TIME, LATITUDE, LONGITUDE (one value per profile), DEPTH, TEMP (n_profiles x n_depth) and
+        the SOOP_line, Cruise_ID and transect_id of the transect
+    """
+    with HDF5_LOCK, Dataset(str(path)) as dataset:
+        entry = np.flatnonzero((dataset.variables['transect_id'][:] == transect_id)
+                               & (dataset.variables['superseded'][:] == 0))
+        if len(entry) == 0:
+            raise KeyError('transect %s is not in %s' % (transect_id, path))
+        entry = entry[0]
+        offset = int(dataset.variables['profile_offset'][entry])
+        profiles = read_profiles(dataset, offset, offset + int(dataset.variables['row_size'][entry]))
+        profiles.update({'SOOP_line': dataset.SOOP_line_label, 'Cruise_ID': dataset.variables['Cruise_ID'][entry],
+                         'transect_id': transect_id})
+    return profiles
+
+
+def read_window(path, start=None, end=None):
+    """
+    Read the profiles of an archive from start (included) to end (excluded): the current transects overlapping the
+    window are found in the index and the profiles from the first to the last of them are read at once, keeping those
+    of these transects within the window.
+    :param start, end: anything pandas.Timestamp takes, None for no limit
+    :return: dict of TIME, LATITUDE, LONGITUDE and transect_id (one value per profile, in archive order), DEPTH and
+        TEMP (n_profiles x n_depth)
+    """
+    start = pd.Timestamp(start or pd.Timestamp.min).to_datetime64()
+    end = pd.Timestamp(end or pd.Timestamp.max).to_datetime64()
+    with HDF5_LOCK, Dataset(str(path)) as dataset:
+        index = read_index_variables(dataset)
+        index = index[(index['superseded'] == 0) & (index['time_max'] >= start) & (index['time_min'] < end)]
+        if len(index) == 0:
+            first = last = 0
+        else:
+            first = index['profile_offset'].min()
+            last = (index['profile_offset'] + index['row_size']).max()
+        profiles = read_profiles(dataset, first, last)
+    # transect of each profile read, the profiles between them belonging to transects left out or superseded
+    transect = np.full(last - first, None, dtype=object)
+    member = np.zeros(last - first, dtype=bool)
+    for row in index.itertuples():
+        rows = slice(row.profile_offset - first, row.profile_offset - first + row.row_size)
+        transect[rows] = row.transect_id
+        member[rows] = True
+    keep = member & (profiles['TIME'] >= start) & (profiles['TIME'] < end)
+    profiles = {key: values if key == 'DEPTH' else values[keep] for key, values in profiles.items()}
+    profiles['transect_id'] = transect[keep]
+    return profiles
+
+
+def read_transect_file(filepath):
+    """The payload of a transect file written by write2netcdf.write_payload_nc"""
+    with HDF5_LOCK, Dataset(str(filepath)) as dataset:
+        n_profiles = len(dataset.dimensions['TIME'])
+        payload = {'TIME': decode_times(dataset.variables['TIME'], dataset.variables['TIME'][:]),
+                   'LATITUDE': np.asarray(dataset.variables['LATITUDE'][:]),
+                   'LONGITUDE': np.asarray(dataset.variables['LONGITUDE'][:]),
+                   'DEPTH': np.asarray(dataset.variables['DEPTH'][:]),
+                   'TEMP': dataset.variables['TEMP'][:].filled(np.nan).astype(np.float32)}
+        for name, attribute in (('SOOP_line', 'SOOP_line_label'), ('SOOP_line_description', 'SOOP_line_description'),
+                                ('transect_id', 'transect_id'), ('Cruise_ID', 'Cruise_ID')):
+            payload[name] = np.full(n_profiles, getattr(dataset, attribute), dtype=object)
+    return payload
+
+
+def build_archives(transect_dir, archive_dir, **append_options):
+    """
+    Append the transect files of a folder (e.g. the output of a sharded run) to the archives of their lines, in
+    file name order, with the transect files of each subfolder (one per vertical product) going to the same
+    subfolder of archive_dir
+    """
+    transect_dir = Path(transect_dir)
+    folders = [transect_dir] + sorted(p for p in transect_dir.iterdir() if p.is_dir())
+    for folder in folders:
+        files = sorted(folder.glob('*.nc'))
+        if not files:
+            continue
+        product = '' if folder == transect_dir else folder.name
+        payloads = (dict(read_transect_file(f), product=product) for f in files)
+        report = {'counts': {}}
+        for _ in archive_transects(payloads, archive_dir, report=report, **append_options):
+            pass
+        print(f"{folder}: {report['counts']['transects_archived']} transects archived, "
+              f"{report['counts']['transects_archive_unchanged']} unchanged")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-line archives of the transect files')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='append a folder of transect files to the archives of their lines')
+    build.add_argument('transect_dir')
+    build.add_argument('archive_dir')
+    build.add_argument('--complevel', type=int, default=ARCHIVE_COMPLEVEL,
+                       help='zlib compression level of new archives (default: %d)' % ARCHIVE_COMPLEVEL)
+    listing = commands.add_parser('list', help='print the transect index of an archive')
+    listing.add_argument('archive')
+    listing.add_argument('--superseded', action='store_true', help='include the entries of replaced transects')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_archives(args.transect_dir, args.archive_dir, complevel=args.complevel)
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 160):
+            print(read_index(args.archive, superseded=args.superseded).drop(columns='digest'))
@@ -0,0 +1,118 @@
+# Registry of the settings of the SOOP lines, read once per process from soopLines.csv and compiled into arrays:
+# the horizontal grid of each line, its boundary polygon as vertex and edge arrays, the vertical grid and the
+# segmentation rules. Empty cells of a line take the value of the 'default' row, and labels that are not in the
+# config (lines without a grid yet) get the default row.
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from utils import read_lines_config
+
+DEFAULT_LINE = 'default'
+# settings of the vertical stage, shared by all lines of a run as they go into one profile store,
+# so they are only read from the default row
+VERTICAL_SETTINGS = ['max_depth', 'depth_step', 'half_width']
+# settings lines inherit from the default row where their cells are empty
+INHERITED_SETTINGS = ['min_in_polygon', 'cruise_max_days', 'gap_days', 'min_split_fraction', 'merge_window_days']
+
+
+def colon(start, step, stop):
+    """The MATLAB range start:step:stop"""
+    n = int(np.floor((stop - start) / step + 1e-10)) + 1
+    return start + step * np.arange(n)
+
+
+def _number(value):
+    """A config value as an int if it is a whole number, as a float otherwise"""
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _frozen(array):
+    """Make an array of the shared registry read-only"""
+    array.flags.writeable = False
+    return array
+
+
+def compile_line(row, default):
+    """Compile one row of the lines config into its settings dict, filling empty cells from the default row"""
+    settings = {'line': row.name}
+    for col in INHERITED_SETTINGS:
+        settings[col] = _number(default[col] if pd.isna(row[col]) else row[col])
+
+    settings.update({col: _number(default[col]) for col in VERTICAL_SETTINGS})
+    # depth grid from the surface, e.g. 0 to 1800 m every 10 m
+    settings['v_grid'] = _frozen(np.arange(0, settings['max_depth'] + settings['depth_step'],
+                                           settings['depth_step']))
+
+    # horizontal grid along latitude or longitude, chunks split at gaps of more than 'gaps' degrees,
+    # large e-folding scale 'efold' in stations
+    if pd.isna(row['axis']):
+        settings.update({'axis': None, 'grid': None, 'gaps': None, 'efold': None})
+    else:
+        if row['axis'] not in ('LATITUDE', 'LONGITUDE'):
+            raise ValueError("axis of line %s must be LATITUDE or LONGITUDE, got %r" % (row.name, row['axis']))
+        settings.update({'axis': row['axis'], 'grid': _frozen(colon(row['grid_start'], row['grid_step'],
+                                                                    row['grid_stop'])),
+                         'gaps': _number(row['gaps']), 'efold': _number(row['efold'])})
+
+    # boundary polygon as (n, 2) vertices of lon, lat and its edges (x0, y0, x1, y1) from each vertex to the next
+    if pd.isna(row['polygon_lons']):
+        settings.update({'polygon': None, 'polygon_edges': None})
+    else:
+        lons = np.array(row['polygon_lons'].split(), dtype=float)
+        lats = np.array(row['polygon_lats'].split(), dtype=float)
+        if len(lons) != len(lats) or len(lons) < 3:
+            raise ValueError('polygon of line %s needs the same number (3 or more) of lons and lats' % row.name)
+        settings['polygon'] = _frozen(np.column_stack([lons, lats]))
+        settings['polygon_edges'] = tuple(_frozen(a) for a in (lons, lats, np.roll(lons, -1), np.roll(lats, -1)))
+    return settings
+
+
+@lru_cache(maxsize=None)
+def load_line_registry(file_path='soopLines.csv'):
+    """
+    Read and compile the lines config once per process.
+    :return: dict of line label: settings, see compile_line. The registry is shared between calls, do not change it.
+    """
+    config = read_lines_config(file_path).set_index('line')
+    if DEFAULT_LINE not in config.index:
+        raise ValueError("%s needs a '%s' row" % (file_path, DEFAULT_LINE))
+    default = config.loc[DEFAULT_LINE]
+    for line, row in config.iterrows():
+        for col in VERTICAL_SETTINGS:
+            if line != DEFAULT_LINE and not pd.isna(row[col]) and row[col] != default[col]:
+                raise ValueError('%s of line %s differs from the default row: the vertical grid is the same for all '
+                                 'lines, set it in the default row' % (col, line))
+    return {line: compile_line(row, default) for line, row in config.iterrows()}
+
+
+def resolve_line(label, registry):
+    """
+    Registry key of a SOOP_line label: the label itself, else the longest line the label starts with
+    (e.g. PX30-31 is PX30), else the default row
+    """
+    if label in registry:
+        return label
+    prefixes = [line for line in registry if line != DEFAULT_LINE and str(label).startswith(line)]
+    return max(prefixes, key=len) if prefixes else DEFAULT_LINE
+
+
+def line_settings(label, registry=None):
+    """Settings of the line of a SOOP_line label, from the registry of soopLines.csv by default"""
+    registry = load_line_registry() if registry is None else registry
+    return registry[resolve_line(label, registry)]
+
+
+def line_lookup(labels, key, registry=None):
+    """Array of the setting key for each of the SOOP_line labels, resolving each distinct label once"""
+    registry = load_line_registry() if registry is None else registry
+    codes, uniques = pd.factorize(np.asarray(labels, dtype=object), use_na_sentinel=False)
+    values = np.array([line_settings(label, registry)[key] for label in uniques])
+    return values[codes] if len(uniques) > 0 else values
+
+
+def days(values):
+    """Numbers of days as a timedelta64[ns] array"""
+    return pd.to_timedelta(np.asarray(values, dtype=float), unit='D').to_numpy()
@@ -0,0 +1,89 @@
+# Check transects against the boundary polygon of their line, as matlab/utils/check_transect_location.m does,
+# on the per-profile metadata table alone, so off-line transects are dropped before their profiles are assembled
+# and written.
+# All profiles of all transects are tested in one point-in-polygon pass per line, against the polygon edge
+# arrays of the line registry (see line_config).
+import numpy as np
+import pandas as pd
+
+from line_config import load_line_registry, resolve_line
+
+
+def points_in_polygon(lons, lats, edges):
+    """
+    Whether each point is inside the polygon or on its boundary, like MATLAB inpolygon.
+    Crossing number test of all points against all edges at once.
+    :param edges: (x0, y0, x1, y1) arrays of the polygon edges, see line_config.compile_line
+    """
+    x0, y0, x1, y1 = (np.asarray(a)[None, :] for a in edges)
+    px = np.asarray(lons, dtype=float)[:, None]
+    py = np.asarray(lats, dtype=float)[:, None]
+
+    # edges crossed by a ray from the point towards +x
+    straddles = (y0 > py) != (y1 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+    inside = np.count_nonzero(straddles & (px < x_cross), axis=1) % 2 == 1
+
+    # points on an edge count as inside
+    cross = (x1 - x0) * (py - y0) - (y1 - y0) * (px - x0)
+    on_edge = (np.abs(cross) <= 1e-12 * np.maximum(1, np.abs(x1 - x0) + np.abs(y1 - y0))) & \
+        (px >= np.minimum(x0, x1)) & (px <= np.maximum(x0, x1)) & \
+        (py >= np.minimum(y0, y1)) & (py <= np.maximum(y0, y1))
+    return inside | on_edge.any(axis=1)
+
+
+def transect_locations(meta, registry=None):
+    """
+    Fraction of the profiles of each transect inside the polygon of its line.
+    The line of a transect is the SOOP_line of its first profile, longitudes are taken in 0-360 as the
+    polygons are, and profiles with NaN positions are left out.
+    :param registry: line registry of line_config.load_line_registry, the default lines config if None
+    :return: DataFrame indexed by transect_id, in order of first appearance, with the line, n_positions,
+        n_inside, fraction_inside and accepted: fraction_inside of at least min_in_polygon of the line.
+        Transects of lines without a polygon are accepted, transects without any position are not.
+    """
+    registry = load_line_registry() if registry is None else registry
+    # rows without a transect (dropped by the data rules) get -1 and are left out
+    transect, transect_ids = pd.factorize(meta['transect_id'].values)
+    lats = meta['LATITUDE'].to_numpy(dtype=float)
+    lons = meta['LONGITUDE'].to_numpy(dtype=float)
+    lons = np.where(lons < 0, lons + 360, lons)
+
+    in_transect = transect >= 0
+    first_row = pd.Series(np.flatnonzero(in_transect)).groupby(transect[in_transect]).first().values
+    labels = np.asarray(meta['SOOP_line'], dtype=str)[first_row]
+    lines = np.array([resolve_line(label, registry) for label in labels], dtype=object)
+
+    valid = ~np.isnan(lats) & ~np.isnan(lons) & in_transect
+    inside = np.zeros(len(transect), dtype=bool)
+    has_polygon = np.array([registry[line]['polygon_edges'] is not None for line in lines], dtype=bool)
+    row_line = lines[transect] if len(lines) > 0 else np.full(len(transect), None, dtype=object)
+    for line in pd.unique(lines[has_polygon]):
+        rows = np.flatnonzero(valid & (row_line == line))
+        inside[rows] = points_in_polygon(lons[rows], lats[rows], registry[line]['polygon_edges'])
+
+    n_positions = np.bincount(transect[valid], minlength=len(transect_ids))
+    n_inside = np.bincount(transect[inside], minlength=len(transect_ids))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = n_inside / n_positions
+    min_in_polygon = np.array([registry[line]['min_in_polygon'] for line in lines], dtype=float)
+    # a NaN fraction (no position) compares False, as 0/0 does in check_transect_location.m
+    accepted = ~has_polygon | (fraction >= min_in_polygon)
+    return pd.DataFrame({'line': lines, 'n_positions': n_positions, 'n_inside': n_inside,
+                         'fraction_inside': fraction, 'accepted': accepted},
+                        index=pd.Index(transect_ids, name='transect_id'))
+
+
+def rejected_transects(meta, registry=None):
+    """
+    Transects that are not inside the polygon of their line, see transect_locations, printing one line for each.
+    meta is left as it is, since its rows line up with the temperature matrix of the profile store.
+    :return: DataFrame of transect_locations for the rejected transects
+    """
+    locations = transect_locations(meta, registry)
+    rejected = locations[~locations['accepted']]
+    for transect_id, row in rejected.iterrows():
+        print('Transect %s removed: %.0f%% of its profiles are inside the %s polygon'
+              % (transect_id, 100 * np.nan_to_num(row['fraction_inside']), row['line']))
+    return rejected
@@ -0,0 +1,237 @@
+# Local read-through mirror of remote (OPeNDAP) XBT files.
+# Files are downloaded over plain HTTP (the THREDDS file service of an OPeNDAP url) with a timeout and outside
+# utils.HDF5_LOCK, which is only held to decode the downloaded bytes, so threads download in parallel and a hung
+# server stalls neither the other workers nor local reads and writes. Only the variables read_single_file uses are
+# kept, as one small compressed netCDF file per content, named by the hash of the variables and attributes kept, so
+# a file reached through several urls is stored once.
+# Each url has a json alias named by the hash of the url, holding the url, the content it points to, its
+# ETag/Last-Modified and when it was last checked. Entries younger than max_age are used without touching the
+# network, older ones are revalidated with a conditional request and refetched only if the remote file changed.
+# The mirror is kept under a size cap by evicting the least recently used content files (mtime is bumped on every
+# use) and the aliases pointing to them.
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+import requests
+import xarray as xr
+from netCDF4 import Dataset
+
+from utils import hdf5_lock
+
+# variables read by transect_vertical_grid.read_single_file; SOOP_line, Ship and Institution_unique_identifier
+# only exist in some files and carry the line, cruise and station metadata as attributes or values
+MIRROR_VARIABLES = ['DEPTH', 'TEMP', 'TEMP_quality_control', 'LATITUDE', 'LONGITUDE', 'TIME',
+                    'Institution_unique_identifier', 'SOOP_line', 'Ship']
+
+# seconds to wait for the server, when revalidating and downloading
+TIMEOUT = 30
+
+# one requests session per thread, so revalidation reuses connections
+_sessions = threading.local()
+
+
+def _session():
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def alias_path(url, mirror_dir):
+    """Path of the json alias of url"""
+    return Path(mirror_dir) / f'{hashlib.sha1(url.encode()).hexdigest()}.json'
+
+
+def content_path(key, mirror_dir):
+    """Path of the mirrored file of a content key, see content_key"""
+    return Path(mirror_dir) / f'{key}.nc'
+
+
+def read_alias(url, mirror_dir):
+    """The alias of url and the path of the file it points to, (None, None) if the mirror has no copy of url"""
+    meta_path = alias_path(url, mirror_dir)
+    if not meta_path.exists():
+        return None, None
+    entry = json.loads(meta_path.read_text())
+    # entries of mirrors keyed by url have no content key, they are fetched again
+    if 'key' not in entry or not content_path(entry['key'], mirror_dir).exists():
+        return None, None
+    return entry, content_path(entry['key'], mirror_dir)
+
+
+def content_key(subset):
+    """Hash of the variables of a fetched subset: their names, dimensions, types, values and attributes"""
+    digest = hashlib.sha1(json.dumps(subset.attrs, sort_keys=True, default=str).encode())
+    for name in sorted(subset.variables):
+        variable = subset.variables[name]
+        # decoded times keep their units and calendar in the encoding
+        described = [name, variable.dims, str(variable.dtype), variable.attrs,
+                     variable.encoding.get('units'), variable.encoding.get('calendar')]
+        digest.update(json.dumps(described, sort_keys=True, default=str).encode())
+        if variable.dtype.kind == 'O':
+            digest.update(json.dumps(variable.values.tolist(), default=str).encode())
+        else:
+            digest.update(variable.values.tobytes())
+    return digest.hexdigest()
+
+
+def validators_url(url):
+    """Url to check for changes: the small .dds response of an OPeNDAP endpoint, the url itself otherwise"""
+    return url + '.dds' if '/dodsC/' in url else url
+
+
+def remote_validators(url, entry=None, timeout=TIMEOUT):
+    """
+    Conditional GET of validators_url(url).
+    :param entry: mirror metadata with the 'etag' and 'last_modified' of the local copy, if any
+    :return: (changed, etag, last_modified) where changed is False if the server confirmed the local copy
+    """
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    response = _session().get(validators_url(url), headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return False, entry.get('etag'), entry.get('last_modified')
+    response.raise_for_status()
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    # servers that ignore conditional requests still let us compare the validators
+    unchanged = entry is not None and (etag or last_modified) and \
+        (etag, last_modified) == (entry.get('etag'), entry.get('last_modified'))
+    return not unchanged, etag, last_modified
+
+
+def download_url(url):
+    """Url of the whole file: the HTTP file service of a THREDDS OPeNDAP endpoint, the url itself otherwise"""
+    return url.replace('/dodsC/', '/fileServer/', 1)
+
+
+def download(url, timeout=TIMEOUT):
+    """
+    Bytes of the file behind url, without holding utils.HDF5_LOCK.
+    :param timeout: seconds to wait for the server to connect or send data, raises requests.Timeout after that
+    """
+    response = _session().get(download_url(url), timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def nc_dataset(filepath, memory=None):
+    """netCDF4 Dataset of a local file, or of the downloaded bytes in memory of the url filepath"""
+    if memory is None:
+        return Dataset(filepath)
+    # the netCDF library reads a url name over OPeNDAP whatever is in memory
+    return Dataset(filepath.rsplit('/', 1)[-1], memory=memory)
+
+
+def open_netcdf(filepath, memory=None):
+    """
+    xr.open_dataset of a local file, or of the downloaded bytes in memory of the url filepath. Hold
+    utils.HDF5_LOCK while the dataset is open
+    """
+    if memory is None:
+        return xr.open_dataset(filepath)
+    return xr.open_dataset(xr.backends.NetCDF4DataStore(nc_dataset(filepath, memory)))
+
+
+def load_remote(url, timeout=TIMEOUT):
+    """
+    Download url and return its MIRROR_VARIABLES loaded into memory. Only decoding the downloaded bytes holds
+    utils.HDF5_LOCK
+    """
+    data = download(url, timeout=timeout)
+    with hdf5_lock(), open_netcdf(url, memory=data) as ds:
+        return ds[[v for v in MIRROR_VARIABLES if v in ds.variables]].load()
+
+
+def fetch_subset(url, mirror_dir, timeout=TIMEOUT, open_remote=load_remote):
+    """
+    Fetch the MIRROR_VARIABLES of url and write them to the file of their content key, via a temporary file,
+    unless the mirror already holds that content. Only the local write holds utils.HDF5_LOCK
+    :param open_remote: function of url and timeout returning the variables of url loaded into memory
+    :return: the content key
+    """
+    subset = open_remote(url, timeout=timeout)
+    subset = subset[[v for v in MIRROR_VARIABLES if v in subset.variables]]
+    key = content_key(subset)
+    data_path = content_path(key, mirror_dir)
+    if data_path.exists():
+        os.utime(data_path)
+        return key
+    tmp_path = alias_path(url, mirror_dir).with_suffix('.tmp.nc')
+    encoding = {v: {'zlib': True, 'complevel': 4} for v in subset.data_vars if subset[v].dtype.kind in 'fiu'}
+    with hdf5_lock():
+        subset.to_netcdf(tmp_path, encoding=encoding)
+    os.replace(tmp_path, data_path)
+    return key
+
+
+def mirror_file(url, mirror_dir, max_age=None, timeout=TIMEOUT, open_remote=load_remote):
+    """
+    Return the path of a local copy of url holding the variables the pipeline reads, fetching it if needed.
+    :param max_age: seconds a local copy is trusted without revalidation; None to always trust it
+    :param timeout: seconds to wait for the server when revalidating and fetching
+    :param open_remote: function of url and timeout returning the variables of url loaded into memory, see
+        load_remote
+    """
+    Path(mirror_dir).mkdir(parents=True, exist_ok=True)
+    entry, data_path = read_alias(url, mirror_dir)
+    now = time.time()
+
+    if entry is not None and (max_age is None or now - entry['checked'] < max_age):
+        os.utime(data_path)
+        return data_path
+
+    try:
+        changed, etag, last_modified = remote_validators(url, entry, timeout=timeout)
+    except requests.RequestException as e:
+        if entry is not None:
+            print(f'Could not revalidate {url}, using the mirrored copy: {e}')
+            os.utime(data_path)
+            return data_path
+        # no validators, still try to fetch the data itself
+        changed, etag, last_modified = True, None, None
+
+    if changed:
+        key = fetch_subset(url, mirror_dir, timeout=timeout, open_remote=open_remote)
+        data_path = content_path(key, mirror_dir)
+    else:
+        key = entry['key']
+        os.utime(data_path)
+    entry = {'url': url, 'key': key, 'etag': etag, 'last_modified': last_modified, 'checked': now}
+    meta_path = alias_path(url, mirror_dir)
+    tmp_path = meta_path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(entry))
+    os.replace(tmp_path, meta_path)
+    return data_path
+
+
+def evict(mirror_dir, max_bytes):
+    """
+    Delete the least recently used mirrored files until the mirror holds at most max_bytes, and the aliases of the
+    deleted files. Each file counts once however many urls point to it
+    """
+    data_paths = list(Path(mirror_dir).glob('*.nc'))
+    stats = {path: path.stat() for path in data_paths if not path.name.endswith('.tmp.nc')}
+    total = sum(st.st_size for st in stats.values())
+    evicted = set()
+    for path in sorted(stats, key=lambda p: stats[p].st_mtime):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= stats[path].st_size
+        evicted.add(path.stem)
+    if evicted:
+        for meta_path in Path(mirror_dir).glob('*.json'):
+            try:
+                if json.loads(meta_path.read_text()).get('key') in evicted:
+                    meta_path.unlink(missing_ok=True)
+            except (OSError, ValueError):
+                continue
+        print(f"Evicted {len(evicted)} files from the mirror, {total / 1e6:.1f} MB left")
@@ -0,0 +1,275 @@
+# Persistent cache of the interpolated profiles, so reruns only read and interpolate new or changed files.
+#
+# The cache for one set of v_grid/half_width/smoothing/products parameters lives in its own folder:
+#   temps-<n>.f32  all interpolated profiles as one raw float32 (n_slots x n_depth) array, memory mapped to read
+#   index.npz      one entry per source file: path, size, mtime, slot in the temps file and the profile
+#                  metadata, plus the name of the current temps file
+# New profiles are appended to the temps file and the index is rewritten atomically, so an interrupted run
+# leaves at worst some unused slots at the end of the temps file, which pruning removes.
+import os
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+INDEX_FILE = 'index.npz'
+PARAMS_FILE = 'params.json'
+
+# per-profile columns of the load_profiles arrays kept in the index
+META_KEYS = ['LATITUDE', 'LONGITUDE', 'TIME', 'SOOP_line', 'SOOP_line_description', 'Cruise_ID',
+             'Institution_unique_identifier']
+
+
+def is_url(filepath):
+    """True for http(s) urls, e.g. OPeNDAP endpoints"""
+    return filepath.startswith('http://') or filepath.startswith('https://')
+
+
+def cache_folder(cache_dir, v_grid, half_width, smoothing='samples', products=None):
+    """
+    Return the cache folder for these interpolation parameters, creating it if needed
+    :param products: vertical products whose levels the cached TEMP holds side by side (see vertical_products),
+        None for v_grid alone
+    """
+    params = {'v_grid': [float(v) for v in np.asarray(v_grid)], 'half_width': float(half_width)}
+    # the default smoothing and products are left out of the key, so caches made before they could be chosen
+    # stay valid
+    if smoothing != 'samples':
+        params['smoothing'] = smoothing
+    if products is not None:
+        params['products'] = [product['name'] for product in products]
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    folder = Path(cache_dir) / key
+    folder.mkdir(parents=True, exist_ok=True)
+    params_path = folder / PARAMS_FILE
+    if not params_path.exists():
+        params_path.write_text(json.dumps(params))
+    return folder
+
+
+def file_fingerprint(filepath, hash_contents=False):
+    """
+    Return (size, mtime_ns) of a local file, or (size, content hash as an integer) if hash_contents.
+    Remote urls can't be checked cheaply and get (-1, -1), i.e. they are treated as unchanged once cached.
+    """
+    if is_url(filepath):
+        return -1, -1
+    st = os.stat(filepath)
+    if hash_contents:
+        digest = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return st.st_size, int.from_bytes(digest.digest()[:8], 'little', signed=True)
+    return st.st_size, st.st_mtime_ns
+
+
+def read_index(folder):
+    """Read the cache index, returning (index, temps file name). An empty index if there is none yet"""
+    index_path = Path(folder) / INDEX_FILE
+    if not index_path.exists():
+        index = {
+            'path': np.array([], dtype=str),
+            'size': np.array([], dtype=np.int64),
+            'mtime': np.array([], dtype=np.int64),
+            'slot': np.array([], dtype=np.int64),
+            'LATITUDE': np.array([], dtype=float),
+            'LONGITUDE': np.array([], dtype=float),
+            'TIME': np.array([], dtype='datetime64[ns]'),
+        }
+        for key in META_KEYS[3:]:
+            index[key] = np.array([], dtype=str)
+        return index, 'temps-0.f32'
+    with np.load(index_path, allow_pickle=False) as npz:
+        index = {key: npz[key] for key in npz.files if key != 'temps_file'}
+        return index, str(npz['temps_file'])
+
+
+def write_index(folder, index, temps_file):
+    """Write the cache index via a temporary file so a crash never leaves a truncated index"""
+    index_path = Path(folder) / INDEX_FILE
+    tmp_path = index_path.with_suffix('.tmp.npz')
+    np.savez(tmp_path, temps_file=np.array(temps_file), **index)
+    os.replace(tmp_path, index_path)
+
+
+def read_temps(folder, temps_file, n_depth, slots):
+    """Read the rows of the temps file at slots through a memory map"""
+    temps_path = Path(folder) / temps_file
+    if len(slots) == 0 or not temps_path.exists():
+        return np.empty((len(slots), n_depth), dtype=np.float32)
+    n_slots = temps_path.stat().st_size // (4 * n_depth)
+    temps = np.memmap(temps_path, dtype=np.float32, mode='r', shape=(n_slots, n_depth))
+    return np.asarray(temps[np.asarray(slots)])
+
+
+def append_temps(folder, temps_file, temps):
+    """Append rows to the temps file and return the slots they were written to"""
+    temps = np.ascontiguousarray(temps, dtype=np.float32)
+    row_bytes = 4 * temps.shape[1]
+    with open(Path(folder) / temps_file, 'ab') as f:
+        # drop any partial row left by an interrupted write
+        start = f.tell() // row_bytes
+        f.truncate(start * row_bytes)
+        f.write(temps.tobytes())
+    return np.arange(start, start + len(temps))
+
+
+def load_profiles_cached(filepaths, v_grid, cache_dir, half_width=11, hash_contents=False, prune=False,
+                         smoothing='samples', products=None, **load_kwargs):
+    """
+    Cached version of transect_vertical_grid.load_profiles.
+    Files whose path and fingerprint are in the cache are not opened, the rest are read and interpolated
+    with load_profiles and added to the cache.
+    :param cache_dir: folder holding the cache, shared between runs
+    :param hash_contents: fingerprint local files by a hash of their contents rather than size and mtime
+    :param prune: drop cache entries for files that are not in filepaths and compact the temps file
+    :param smoothing: vertical smoothing method, each has a cache of its own
+    :param products: vertical products, each set has a cache of its own, v_grid is then their product_depths
+    :param load_kwargs: passed to load_profiles (backend, max_workers, files_per_task)
+    :return: (profiles, changed) where profiles is as returned by load_profiles, with a 'fingerprint'
+        entry added, and changed is the set of paths that were (re)processed this run.
+        Files that gave no profile are not cached and are read again on the next run
+    """
+    # imported here as transect_vertical_grid imports this module
+    from transect_vertical_grid import load_profiles
+
+    folder = cache_folder(cache_dir, v_grid, half_width, smoothing, products)
+    n_depth = len(v_grid)
+    index, temps_file = read_index(folder)
+
+    paths = np.asarray(filepaths, dtype=str)
+    fingerprints = np.array([file_fingerprint(f, hash_contents) for f in filepaths], dtype=np.int64).reshape(-1, 2)
+    current = pd.DataFrame({'path': paths,
+                            'size': fingerprints[:, 0], 'mtime': fingerprints[:, 1]})
+    cached = pd.DataFrame({'path': index['path'], 'size': index['size'], 'mtime': index['mtime']})
+    todo = ~current.merge(cached, on=['path', 'size', 'mtime'], how='left', indicator=True)['_merge'].eq('both').values
+    changed = set(paths[todo])
+    print(f"Profile cache: {(~todo).sum()} files cached, {todo.sum()} to process")
+
+    if todo.any():
+        todo_paths = paths[todo]
+        new = load_profiles(list(todo_paths), v_grid, half_width=half_width, smoothing=smoothing,
+                            products=products, **load_kwargs)
+        slots = append_temps(folder, temps_file, new['TEMP'])
+
+        # files that gave no profile are not cached, as a read error may be transient, and are read again next run
+        row = pd.Series(np.flatnonzero(todo), index=paths[todo]).reindex(new['path']).values
+        additions = {
+            'path': new['path'],
+            'size': current['size'].values[row],
+            'mtime': current['mtime'].values[row],
+            'slot': slots,
+        }
+        for key in META_KEYS:
+            additions[key] = new[key]
+
+        # replace the entries of the reprocessed paths
+        keep = ~np.isin(index['path'], todo_paths)
+        index = {key: np.concatenate([index[key][keep], additions[key]]) for key in index}
+
+    old_temps_file = temps_file
+    if prune:
+        index, temps_file = prune_index(folder, index, temps_file, n_depth, keep_paths=paths,
+                                        hash_contents=hash_contents)
+    write_index(folder, index, temps_file)
+    if temps_file != old_temps_file:
+        os.remove(Path(folder) / old_temps_file)
+
+    # assemble the profiles of filepaths, in order, from the index and the temps file
+    entry = pd.Series(np.arange(len(index['path'])), index=index['path']).reindex(paths).dropna().values.astype(int)
+    profiles = {'TEMP': read_temps(folder, temps_file, n_depth, index['slot'][entry])}
+    for key in META_KEYS + ['path']:
+        profiles[key] = index[key][entry]
+    profiles['fingerprint'] = np.char.add(np.char.add(index['size'][entry].astype(str), '-'),
+                                          index['mtime'][entry].astype(str))
+    return profiles, changed
+
+
+def prune_index(folder, index, temps_file, n_depth, keep_paths=None, hash_contents=False):
+    """
+    Drop stale entries and copy the slots still in use to a new, compact temps file.
+    :param keep_paths: paths to keep, by default those local files that still exist with the cached fingerprint
+    :param hash_contents: the cache was built with content hash fingerprints
+    :return: (index, temps_file) for the caller to write with write_index before removing the old temps file
+    """
+    if keep_paths is None:
+        keep = np.array([is_url(path) or (os.path.exists(path) and
+                                          file_fingerprint(path, hash_contents) == (size, mtime))
+                         for path, size, mtime in zip(index['path'], index['size'], index['mtime'])], dtype=bool)
+    else:
+        keep = np.isin(index['path'], np.asarray(keep_paths, dtype=str))
+    index = {key: values[keep] for key, values in index.items()}
+
+    temps = read_temps(folder, temps_file, n_depth, index['slot'])
+    generation = int(temps_file.split('-')[1].split('.')[0]) + 1
+    new_temps_file = f'temps-{generation}.f32'
+    temps.tofile(Path(folder) / new_temps_file)
+    index['slot'] = np.arange(len(index['slot']))
+    print(f"Profile cache pruned to {len(index['path'])} files")
+    return index, new_temps_file
+
+
+def prune_cache(cache_dir, v_grid, half_width=11, hash_contents=False, smoothing='samples', products=None):
+    """Drop cache entries for files that no longer exist or have changed, and compact the cache"""
+    folder = cache_folder(cache_dir, v_grid, half_width, smoothing, products)
+    index, temps_file = read_index(folder)
+    index, new_temps_file = prune_index(folder, index, temps_file, len(v_grid), hash_contents=hash_contents)
+    write_index(folder, index, new_temps_file)
+    if (Path(folder) / temps_file).exists():
+        os.remove(Path(folder) / temps_file)
+
+
+def run_key(**params):
+    """
+    Short hash of the run parameters that shape the written files, e.g. v_grid, smoothing and the writer options.
+    Arrays are keyed by their values and the vertical products by their names
+    """
+    def plain(value):
+        if isinstance(value, dict):
+            return {str(k): plain(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [plain(v) for v in value]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+    if params.get('products') is not None:
+        params['products'] = [product['name'] for product in params['products']]
+    return hashlib.sha1(json.dumps(plain(params), sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def transect_digests(meta, rows_by_transect, row_tags=None, params_key=''):
+    """
+    Return a dict of transect_id: digest of its member files and their fingerprints
+    :param row_tags: optional string per row added to its key, e.g. the masks of the data rules
+    :param params_key: run_key of the run parameters, so every transect is rewritten when they change
+    """
+    keys = (meta['path'].astype(str) + '|' + meta['fingerprint'].astype(str)).values
+    if row_tags is not None:
+        keys = keys + np.asarray(row_tags, dtype=object)
+    return {transect: hashlib.sha1('\n'.join([params_key] + sorted(keys[rows])).encode()).hexdigest()
+            for transect, rows in rows_by_transect.items()}
+
+
+def manifest_path(cache_dir, output_directory):
+    """Path of the manifest of the transects written to output_directory"""
+    key = hashlib.sha1(str(Path(output_directory).resolve()).encode()).hexdigest()[:16]
+    return Path(cache_dir) / f'manifest_{key}.json'
+
+
+def read_manifest(path):
+    """Read a transect manifest of transect_id: digest, empty if there is none"""
+    path = Path(path)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def write_manifest(path, digests):
+    """Write a transect manifest via a temporary file"""
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(digests, indent=0, sort_keys=True))
+    os.replace(tmp_path, path)
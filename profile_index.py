@@ -0,0 +1,149 @@
+# Persistent index of the profile metadata of the input files, so a run can select the files of some lines, a time
+# range or a region without listing, crawling or opening the rest.
+#
+# The index is one SQLite file with a row per source file: the input (folder or THREDDS catalogs) it was indexed
+# from, its path or url and fingerprint, and the metadata of its profile as scanned by
+# transect_vertical_grid.scan_single_file. It is updated incrementally: only new or changed files are scanned,
+# and files no longer in the input are dropped. Remote urls can't be fingerprinted cheaply and are indexed once.
+import sqlite3
+from pathlib import Path
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from line_config import load_line_registry, resolve_line
+from profile_cache import file_fingerprint
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS profiles (
+        source TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, mtime INTEGER,
+        station TEXT, soop_line TEXT, soop_line_description TEXT, cruise_id TEXT,
+        time INTEGER, lat REAL, lon REAL, lon360 REAL,
+        PRIMARY KEY (source, path))""",
+    "CREATE INDEX IF NOT EXISTS profiles_line_time ON profiles (source, soop_line, time)",
+    "CREATE INDEX IF NOT EXISTS profiles_time ON profiles (source, time)",
+    "CREATE INDEX IF NOT EXISTS profiles_lat ON profiles (source, lat)",
+]
+# index columns and the load_profiles entries they hold
+COLUMNS = {'station': 'Institution_unique_identifier', 'soop_line': 'SOOP_line',
+           'soop_line_description': 'SOOP_line_description', 'cruise_id': 'Cruise_ID', 'time': 'TIME',
+           'lat': 'LATITUDE', 'lon': 'LONGITUDE'}
+
+
+def open_index(index_path):
+    """Open the index, creating it if needed"""
+    Path(index_path).parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(index_path))
+    for statement in SCHEMA:
+        con.execute(statement)
+    return con
+
+
+def source_key(input_directories):
+    """The source the files of a run are indexed under: its input folder or THREDDS catalogs"""
+    return ' '.join(str(d) for d in input_directories)
+
+
+def has_source(index_path, source):
+    """True if the index exists and holds files of source"""
+    if not Path(index_path).exists():
+        return False
+    with closing(open_index(index_path)) as con:
+        return con.execute('SELECT 1 FROM profiles WHERE source = ? LIMIT 1', (source,)).fetchone() is not None
+
+
+def update_index(index_path, source, filepaths, hash_contents=False, prune=True, **load_options):
+    """
+    Bring the index of source up to date with filepaths, scanning only new or changed files.
+    :param filepaths: all files or urls of the source, e.g. a folder listing or a THREDDS crawl
+    :param hash_contents: fingerprint local files by a hash of their contents rather than size and mtime
+    :param prune: drop the files of source that are not in filepaths
+    :param load_options: passed to load_profiles (backend, max_workers, files_per_task, mirror options)
+    :return: number of files scanned
+    """
+    # imported here as transect_vertical_grid imports this module
+    from transect_vertical_grid import load_profiles
+
+    paths = np.asarray(list(filepaths), dtype=str)
+    fingerprints = np.array([file_fingerprint(f, hash_contents) for f in paths], dtype=np.int64).reshape(-1, 2)
+    current = pd.DataFrame({'path': paths, 'size': fingerprints[:, 0], 'mtime': fingerprints[:, 1]})
+    # one transaction, committed when the update completes
+    with closing(open_index(index_path)) as con, con:
+        indexed = pd.read_sql_query('SELECT path, size, mtime FROM profiles WHERE source = ?', con, params=(source,))
+        todo = ~current.merge(indexed, on=['path', 'size', 'mtime'], how='left',
+                              indicator=True)['_merge'].eq('both').values
+        print(f"Profile index: {(~todo).sum()} files indexed, {todo.sum()} to scan")
+
+        if todo.any():
+            scanned = load_profiles(list(paths[todo]), None, metadata_only=True, **load_options)
+            row = pd.Series(np.flatnonzero(todo), index=paths[todo]).reindex(scanned['path']).values
+            lons = scanned['LONGITUDE']
+            rows = pd.DataFrame({'source': source, 'path': scanned['path'],
+                                 'size': current['size'].values[row], 'mtime': current['mtime'].values[row],
+                                 **{col: scanned[key] for col, key in COLUMNS.items()},
+                                 'lon360': np.where(lons < 0, lons + 360, lons)})
+            rows['time'] = rows['time'].values.astype('datetime64[ns]').astype(np.int64)
+            # files that could not be scanned are left out, to be scanned again on the next update
+            con.executemany('DELETE FROM profiles WHERE source = ? AND path = ?',
+                            [(source, path) for path in paths[todo]])
+            con.executemany('INSERT INTO profiles (%s) VALUES (%s)' % (', '.join(rows.columns),
+                                                                        ', '.join('?' * len(rows.columns))),
+                            rows.astype(object).where(rows.notna(), None).itertuples(index=False, name=None))
+
+        if prune:
+            gone = np.setdiff1d(indexed['path'].to_numpy(dtype=str), paths)
+            con.executemany('DELETE FROM profiles WHERE source = ? AND path = ?', [(source, path) for path in gone])
+            if len(gone) > 0:
+                print(f"Profile index: {len(gone)} files no longer in the input removed")
+    return int(todo.sum())
+
+
+def select_profiles(index_path, source, lines=None, time_range=None, bbox=None, registry=None):
+    """
+    Select the indexed files of source by line, time and region.
+    :param lines: lines to keep, matched as the line settings are, e.g. PX30 selects PX30-31 files
+    :param time_range: (start, end) of TIME, start included and end excluded, either may be None
+    :param bbox: (lon_min, lat_min, lon_max, lat_max), longitudes in -180/180 or 0/360. A lon_min east of lon_max
+        crosses the 180 meridian (in -180/180) or the 0 meridian (in 0/360)
+    :return: the profile metadata of the selected files as load_profiles returns it with metadata_only, in path
+        order, with a 'path' entry
+    """
+    where, params = ['source = ?'], [source]
+    with closing(open_index(index_path)) as con:
+        if lines is not None:
+            registry = load_line_registry() if registry is None else registry
+            labels = [label for (label,) in con.execute('SELECT DISTINCT soop_line FROM profiles WHERE source = ?',
+                                                        (source,))
+                      if label in lines or resolve_line(label, registry) in lines]
+            where.append('soop_line IN (%s)' % ', '.join('?' * len(labels)) if labels else '0')
+            params += labels
+        if time_range is not None:
+            start, end = time_range
+            if start is not None:
+                where.append('time >= ?')
+                params.append(pd.Timestamp(start).as_unit('ns').value)
+            if end is not None:
+                where.append('time < ?')
+                params.append(pd.Timestamp(end).as_unit('ns').value)
+        if bbox is not None:
+            lon_min, lat_min, lon_max, lat_max = (float(b) for b in bbox)
+            where.append('lat >= ? AND lat <= ?')
+            params += [lat_min, lat_max]
+            # longitudes compared in 0/360
+            if (lon_max - lon_min) < 360:
+                lon_min, lon_max = lon_min % 360, lon_max % 360
+                where.append('(lon360 >= ? %s lon360 <= ?)' % ('AND' if lon_min <= lon_max else 'OR'))
+                params += [lon_min, lon_max]
+        columns = ', '.join(['path'] + list(COLUMNS))
+        rows = pd.read_sql_query('SELECT %s FROM profiles WHERE %s ORDER BY path' % (columns, ' AND '.join(where)),
+                                 con, params=params)
+
+    profiles = {key: rows[col].to_numpy(dtype=str) for col, key in COLUMNS.items()
+                if key not in ('TIME', 'LATITUDE', 'LONGITUDE')}
+    profiles['TIME'] = rows['time'].to_numpy(dtype=np.int64).astype('datetime64[ns]')
+    profiles['LATITUDE'] = rows['lat'].to_numpy(dtype=float)
+    profiles['LONGITUDE'] = rows['lon'].to_numpy(dtype=float)
+    profiles['path'] = rows['path'].to_numpy(dtype=str)
+    print(f"Profile index: {len(rows)} files selected")
+    return profiles
@@ -0,0 +1,130 @@
+# Columnar store of the interpolated profiles: one per-profile metadata table plus one
+# contiguous (n_profiles x n_depth) float32 temperature matrix whose rows line up with the table.
+# Transects are handled as arrays of profile (row) indices into the store.
+import numpy as np
+import pandas as pd
+
+from vertical_products import product_columns
+
+# per-profile columns, in the order the writer expects them
+META_COLUMNS = ['LATITUDE', 'LONGITUDE', 'TIME', 'SOOP_line', 'SOOP_line_description', 'Cruise_ID',
+                'Institution_unique_identifier']
+CATEGORY_COLUMNS = ['SOOP_line', 'SOOP_line_description', 'Cruise_ID']
+
+
+def build_profile_store(profiles):
+    """
+    Build the profile store from the arrays returned by load_profiles.
+    :param profiles: dict with a 'TEMP' (n_profiles x n_depth) matrix and one array per META_COLUMNS entry.
+        Any other per-profile entries (e.g. 'path') are kept as extra columns after META_COLUMNS
+    :return: (meta, temp) where meta is a DataFrame with one row per profile, sorted by TIME,
+        and temp is the float32 temperature matrix with row i belonging to meta row i, None if profiles has
+        no TEMP (a metadata scan)
+    """
+    order = np.argsort(profiles['TIME'], kind='stable')
+    columns = META_COLUMNS + [col for col in profiles if col not in META_COLUMNS and col != 'TEMP']
+    meta = pd.DataFrame({col: profiles[col][order] for col in columns})
+    meta['TIME'] = pd.to_datetime(meta['TIME'])
+    # Use categorical dtype for repeated strings - reduces memory and speeds up operations
+    for col in CATEGORY_COLUMNS:
+        meta[col] = meta[col].astype('category')
+    if 'TEMP' not in profiles:
+        return meta, None
+    temp = np.ascontiguousarray(profiles['TEMP'][order], dtype=np.float32)
+    return meta, temp
+
+
+def transect_rows(meta):
+    """Return a dict of transect_id: array of profile rows, in order of first appearance"""
+    return meta.groupby('transect_id', sort=False, observed=True).indices
+
+
+def stream_groups(meta, rows_by_transect, max_rows):
+    """
+    Split the transects to write into groups of at most max_rows profiles for a streamed run, taking the transects
+    by SOOP line, then cruise, then time of their first profile, so a group holds whole cruises of one line where
+    they fit. Transects are never split: one of more than max_rows profiles is a group of its own.
+    :param rows_by_transect: dict of transect_id: array of profile rows, see transect_rows
+    :return: list of dicts of transect_id: rows
+    """
+    transects = list(rows_by_transect)
+    if not transects:
+        return []
+    # meta is sorted by TIME, so the first row of a transect is its first profile
+    first = np.array([rows_by_transect[t].min() for t in transects])
+    sizes = np.array([len(rows_by_transect[t]) for t in transects])
+    order = np.lexsort((first, meta['Cruise_ID'].to_numpy(dtype=str)[first],
+                        meta['SOOP_line'].to_numpy(dtype=str)[first]))
+    groups, group, n_rows = [], {}, 0
+    for i in order:
+        if group and n_rows + sizes[i] > max_rows:
+            groups.append(group)
+            group, n_rows = {}, 0
+        group[transects[i]] = rows_by_transect[transects[i]]
+        n_rows += sizes[i]
+    groups.append(group)
+    return groups
+
+
+def transect_payload(meta, temp, rows, v_grid):
+    """
+    Assemble the arrays the writer needs for one transect from its profile rows.
+    Profiles sharing a TIME are averaged into one and profiles with no valid data are left out,
+    as the pivot_table of the long format table used to do.
+    :return: dict with one array per META_COLUMNS entry and 'transect_id' (one value per output profile,
+        TIME sorted), 'DEPTH' (v_grid) and 'TEMP' (n_profiles x n_depth)
+    """
+    rows = np.asarray(rows)
+    rows = rows[np.argsort(meta['TIME'].values[rows], kind='stable')]
+    times = meta['TIME'].values[rows]
+    temps = temp[rows]
+
+    unique_times, first, inverse = np.unique(times, return_index=True, return_inverse=True)
+    if len(unique_times) < len(rows):
+        valid = ~np.isnan(temps)
+        sums = np.zeros((len(unique_times), temps.shape[1]))
+        counts = np.zeros((len(unique_times), temps.shape[1]))
+        np.add.at(sums, inverse, np.where(valid, temps, 0))
+        np.add.at(counts, inverse, valid)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temps = (sums / counts).astype(np.float32)
+    keep = ~np.all(np.isnan(temps), axis=1)
+
+    selected = rows[first[keep]]
+    payload = {col: np.asarray(meta[col])[selected] for col in META_COLUMNS + ['transect_id']}
+    payload['TIME'] = unique_times[keep]
+    payload['DEPTH'] = np.asarray(v_grid)
+    payload['TEMP'] = np.ascontiguousarray(temps[keep], dtype=np.float32)
+    return payload
+
+
+def transect_payloads(meta, temp, rows, v_grid, products=None):
+    """
+    The payloads of one transect, see transect_payload: one on v_grid, or one per vertical product when products
+    are given (see vertical_products), from the columns of temp holding its levels. When there are several
+    products each payload has a 'product' entry naming the folder it is written to.
+    """
+    if products is None:
+        yield transect_payload(meta, temp, rows, v_grid)
+        return
+    for product, columns in product_columns(products):
+        payload = transect_payload(meta, temp[:, columns], rows, product['depths'])
+        if len(products) > 1:
+            payload['product'] = product['name']
+        yield payload
+
+
+def payload_frames(payload):
+    """
+    Return the transect payload as the (metadata_df, data_df) frames write2netcdf.write_vert_grid_nc takes:
+    metadata_df has one row per output profile and data_df is TEMP indexed by DEPTH with one column per profile
+    """
+    metadata_df = pd.DataFrame({col: payload[col] for col in META_COLUMNS + ['transect_id']})
+    data_df = pd.DataFrame(payload['TEMP'].T, index=pd.Index(payload['DEPTH'], name='DEPTH'),
+                           columns=pd.Index(payload['TIME'], name='TIME'))
+    return metadata_df, data_df
+
+
+def transect_frames(meta, temp, rows, v_grid):
+    """Assemble the writer input frames for one transect from its profile rows, see transect_payload"""
+    return payload_frames(transect_payload(meta, temp, rows, v_grid))
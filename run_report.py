@@ -0,0 +1,269 @@
+# Instrumentation of a gridding run and its JSON report: the wall time and peak resident memory of each stage, the
+# read time and outcome of every file read (a latency histogram per pass, the slowest files and the errors), counts of
+# what each stage kept and removed, and the slowest transects to write.
+#
+# A report is a dict made by new_report and filled in as the run goes: stage() times a block, count() adds to a
+# counter and load_profiles adds the file records when given the report. stage() also runs a profiler around
+# the stage the report was made for (cProfile, or pyinstrument if it is installed), so any stage can be profiled
+# from the command line.
+# File read times are wall times in the worker less the waits for the HDF5 lock (see utils.HDF5_LOCK), which with the
+# thread backend depend on what the other workers hold it for: each file record has the lock wait and the time the
+# lock was held as columns of their own, and the worker totals add them up per pass ('read_lock_wait', 'read_locked').
+# The per-stage times are wall times of the whole run.
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+# bins of the per-file read time histogram, s
+LATENCY_EDGES = [0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, np.inf]
+PROFILERS = ['cprofile', 'pyinstrument']
+SLOWEST = 10
+# seconds between samples of the resident memory
+RSS_INTERVAL = 0.01
+
+
+def rss_bytes():
+    """Resident memory of this process, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def rss_peak(interval=RSS_INTERVAL):
+    """Sample the resident memory in a thread while the block runs, yielding a dict that gets 'start' and 'peak'"""
+    result = {'start': rss_bytes(), 'peak': rss_bytes()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            rss = rss_bytes()
+            if rss is not None and rss > result['peak']:
+                result['peak'] = rss
+    sampler = threading.Thread(target=sample, daemon=True)
+    if result['start'] is not None:
+        sampler.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        if sampler.is_alive():
+            sampler.join()
+        end = rss_bytes()
+        if end is not None:
+            result['peak'] = max(result['peak'], end)
+
+
+def new_report(profile_stage=None, profiler='cprofile', profile_output=None, slowest=SLOWEST):
+    """
+    An empty run report.
+    :param profile_stage: name of the stage to run under the profiler, None for none
+    :param profiler: 'cprofile', or 'pyinstrument' for a sampling profiler (needs the pyinstrument package)
+    :param profile_output: file to save the profile to, <stage>.prof (cProfile) or <stage>.html (pyinstrument) if
+        None
+    :param slowest: number of slowest files and transects to report
+    """
+    if profiler not in PROFILERS:
+        raise ValueError('profiler must be one of %s, got %r' % (', '.join(PROFILERS), profiler))
+    return {'started': time.time(), 'stages': {}, 'counts': {}, 'file_log': [], 'worker_seconds': {},
+            'transects': None,
+            'profile': {'stage': profile_stage, 'profiler': profiler, 'output': profile_output},
+            'slowest': slowest}
+
+
+def count(report, key, n=1):
+    """Add n to a counter of the report"""
+    report['counts'][key] = report['counts'].get(key, 0) + int(n)
+
+
+def add_file_records(report, run_pass, records, interpolate_seconds=0.0):
+    """
+    Add the file records of a load_profiles call to the report, see transect_vertical_grid.process_file_batch,
+    with the time its workers spent reading ('scan' or 'read'), waiting for and holding the HDF5 lock while reading
+    ('<pass>_lock_wait', '<pass>_locked') and interpolating
+    """
+    report['file_log'].extend((run_pass,) + tuple(record) for record in records)
+    worker_seconds = report['worker_seconds']
+    for key, column in ((run_pass, 1), (run_pass + '_lock_wait', 2), (run_pass + '_locked', 3)):
+        worker_seconds[key] = worker_seconds.get(key, 0.0) + sum(record[column] for record in records)
+    if run_pass == 'read':
+        worker_seconds['interpolate'] = worker_seconds.get('interpolate', 0.0) + interpolate_seconds
+
+
+@contextlib.contextmanager
+def _cprofile(output):
+    """cProfile the block, in the calling thread and in the threads it starts (e.g. the thread backend workers)"""
+    profiles = [cProfile.Profile()]
+
+    def start_thread_profile(frame, event, arg):
+        # first call in a new thread: hand over to a profiler of its own
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        profile.enable()
+    threading.setprofile(start_thread_profile)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(output)
+        stats.stream = sys.stdout
+        stats.sort_stats('cumulative').print_stats(20)
+
+
+@contextlib.contextmanager
+def _pyinstrument(output):
+    """Profile the block with the pyinstrument sampling profiler"""
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        raise ImportError('the pyinstrument profiler needs the pyinstrument package: pip install pyinstrument')
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        with open(output, 'w') as f:
+            f.write(profiler.output_html())
+        print(profiler.output_text())
+
+
+@contextlib.contextmanager
+def stage(report, name):
+    """
+    Time a stage of the run and sample its peak resident memory, adding to the totals of name if it runs more
+    than once, under the profiler if it is the stage the report profiles
+    """
+    settings = report['profile']
+    if settings['stage'] == name:
+        output = settings['output'] or '%s.%s' % (name, 'prof' if settings['profiler'] == 'cprofile' else 'html')
+        profiled = (_cprofile if settings['profiler'] == 'cprofile' else _pyinstrument)(output)
+        print(f"Profiling stage {name} with {settings['profiler']} into {output}")
+    else:
+        profiled = contextlib.nullcontext()
+    t0 = time.perf_counter()
+    with rss_peak() as rss:
+        try:
+            with profiled:
+                yield
+        finally:
+            seconds = time.perf_counter() - t0
+            entry = report['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss_mb': None})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+    if rss['peak'] is not None:
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'] or 0, rss['peak'] / 1e6)
+
+
+def file_table(report):
+    """
+    Records of every file read as a DataFrame of pass ('scan' or 'read'), path, seconds (without the HDF5 lock waits),
+    lock_wait_seconds, locked_seconds, status ('ok', 'no_valid_data' or 'error') and error
+    """
+    # typed columns even without any record, e.g. a cached run that reads no file
+    return pd.DataFrame(report['file_log'], columns=['pass', 'path', 'seconds', 'lock_wait_seconds', 'locked_seconds',
+                                                     'status', 'error']).astype(
+        {'seconds': float, 'lock_wait_seconds': float, 'locked_seconds': float})
+
+
+def latency_histogram(seconds):
+    """Histogram and percentiles of file read times, in ms"""
+    seconds = np.asarray(seconds, dtype=float)
+    counts, _ = np.histogram(seconds, bins=LATENCY_EDGES)
+    summary = {'edges_ms': [e * 1000 if np.isfinite(e) else None for e in LATENCY_EDGES],
+               'counts': counts.tolist()}
+    if len(seconds) > 0:
+        summary.update({'%s_ms' % name: float(np.percentile(seconds, q) * 1000)
+                        for name, q in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))})
+        summary['total_s'] = float(seconds.sum())
+    return summary
+
+
+def summarize(report):
+    """The report as a dict of plain values for JSON, with the counts of the file records and the write metrics"""
+    files = file_table(report)
+    counts = dict(report['counts'])
+    for run_pass in ('scan', 'read'):
+        records = files[files['pass'] == run_pass]
+        if len(records) > 0:
+            counts['files_%s' % ('scanned' if run_pass == 'scan' else 'read')] = len(records)
+    counts['files_rejected_qc'] = int(((files['pass'] == 'read') & (files['status'] == 'no_valid_data')).sum())
+    counts['files_failed'] = int((files['status'] == 'error').sum())
+    metrics = report['transects']
+    if metrics is not None:
+        counts['transects_written'] = int(metrics['transect_id'].nunique())
+        if (metrics['product'] != '').any():
+            # one file per transect and vertical product, profiles_written counts them in every product
+            counts['files_written'] = len(metrics)
+        counts['profiles_written'] = int(metrics['n_profiles'].sum())
+        counts['bytes_written'] = int(metrics['bytes'].sum())
+
+    slowest_files = files.nlargest(report['slowest'], 'seconds')
+    summary = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(report['started'])),
+        'wall_seconds': time.time() - report['started'],
+        'stages': report['stages'],
+        'worker_seconds': report['worker_seconds'],
+        'counts': counts,
+        'file_latency': {run_pass: latency_histogram(files.loc[files['pass'] == run_pass, 'seconds'])
+                         for run_pass in ('scan', 'read') if (files['pass'] == run_pass).any()},
+        'slowest_files': [{'pass': r.pass_, 'path': r.path, 'seconds': r.seconds,
+                           'lock_wait_seconds': r.lock_wait_seconds, 'locked_seconds': r.locked_seconds,
+                           'status': r.status}
+                          for r in slowest_files.rename(columns={'pass': 'pass_'}).itertuples()],
+        'errors': [{'pass': r.pass_, 'path': r.path, 'error': r.error}
+                   for r in files[files['status'] == 'error'].rename(columns={'pass': 'pass_'}).itertuples()],
+        'slowest_transects': [],
+    }
+    if metrics is not None and len(metrics) > 0:
+        total = metrics['assemble_seconds'].fillna(0) + metrics['write_seconds']
+        slowest = metrics.assign(seconds=total).nlargest(report['slowest'], 'seconds')
+        summary['slowest_transects'] = [
+            {'transect_id': r.transect_id, 'product': r.product, 'n_profiles': int(r.n_profiles),
+             'assemble_seconds': r.assemble_seconds, 'write_seconds': r.write_seconds, 'bytes': int(r.bytes)}
+            for r in slowest.itertuples()]
+    summary['profile'] = report['profile']
+    return summary
+
+
+def print_summary(summary):
+    """Print the stage times and the counts of a summarized report"""
+    print(f"Run finished in {summary['wall_seconds']:.1f} s")
+    for name, entry in summary['stages'].items():
+        peak = '' if entry['peak_rss_mb'] is None else f", peak RSS {entry['peak_rss_mb']:.0f} MB"
+        print(f"  {name}: {entry['seconds']:.2f} s{peak}")
+    if summary['worker_seconds']:
+        print('  in the workers: ' + ', '.join(f"{name} {seconds:.2f} s"
+                                               for name, seconds in summary['worker_seconds'].items()))
+    print('  ' + ', '.join(f"{key} {value}" for key, value in summary['counts'].items()))
+    for run_pass, latency in summary['file_latency'].items():
+        if 'p50_ms' in latency:
+            print(f"  file {run_pass} time: median {latency['p50_ms']:.1f} ms, 90% {latency['p90_ms']:.1f} ms, "
+                  f"max {latency['max_ms']:.1f} ms")
+    for error in summary['errors'][:SLOWEST]:
+        print(f"  failed to {error['pass']} {error['path']}: {error['error']}")
+
+
+def write_report(summary, path):
+    """Write a summarized report as JSON, atomically"""
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(summary, f, indent=1, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+    os.replace(tmp_path, path)
@@ -0,0 +1,349 @@
+# Split the profiles into transects, working on the per-profile metadata table of profile_store (sorted by TIME).
+# Every step is a groupby/cumsum pass over all profiles at once rather than a loop of full table masks per
+# cruise or transect, and gives the same transect ids as the per-transect loops it replaces.
+import numpy as np
+import pandas as pd
+
+from utils import make_transect_ids
+from line_config import line_lookup, days
+
+# The rules are set per line in the lines config (see line_config), by default:
+# a cruise covering more than cruise_max_days (20) is split where consecutive profiles are more than gap_days (10)
+# apart, direction changes are ignored if the first one comes before min_split_fraction (0.25) of the transect,
+# and transects with the same direction are combined if together they cover less than merge_window_days (15).
+
+
+def split_cruises(meta, counters, registry=None):
+    """
+    First separation of transects: one per Cruise_ID, split at gaps of more than gap_days between profiles
+    for cruises covering more than cruise_max_days, both set by the line of the cruise.
+    Ids are allocated in order of first appearance of the cruise, then of the segment.
+    :param counters: id counters for utils.make_transect_ids, updated in place
+    :param registry: line registry of line_config.load_line_registry, the default lines config if None
+    :return: array of transect ids, one per row of meta
+    """
+    cruise, _ = pd.factorize(np.asarray(meta['Cruise_ID'], dtype=object))
+    times = meta['TIME'].values
+    soop_lines = np.asarray(meta['SOOP_line'], dtype=str)
+
+    # unique dates of each cruise, in cruise then time order
+    dates = pd.DataFrame({'cruise': cruise, 'TIME': times}).drop_duplicates()
+    dates = dates.sort_values(['cruise', 'TIME'], kind='stable')
+    date_cruise = dates['cruise'].values
+    date_times = dates['TIME'].values
+
+    # the SOOP_line of a cruise is that of its first profile
+    first_row = pd.Series(np.arange(len(cruise))).groupby(cruise).first().values
+    gap_days = days(line_lookup(soop_lines[first_row], 'gap_days', registry))
+    cruise_max_days = days(line_lookup(soop_lines[first_row], 'cruise_max_days', registry))
+
+    first = np.r_[True, date_cruise[1:] != date_cruise[:-1]]
+    by_cruise = dates.groupby('cruise', sort=False)['TIME']
+    span = (by_cruise.transform('max') - by_cruise.transform('min')).values
+    gap = np.r_[False, np.diff(date_times) > gap_days[date_cruise[1:]]] & ~first
+    breaks = first | (gap & (span > cruise_max_days[date_cruise]))
+    segment = np.cumsum(breaks) - 1
+
+    segment_ids = make_transect_ids(soop_lines[first_row[date_cruise[breaks]]], date_times[breaks], counters)
+
+    row_segment = pd.DataFrame({'cruise': cruise, 'TIME': times}).merge(
+        pd.DataFrame({'cruise': date_cruise, 'TIME': date_times, 'segment': segment}),
+        on=['cruise', 'TIME'], how='left')['segment'].values
+    return segment_ids[row_segment]
+
+
+def _group_range(values, group):
+    """Peak to peak of values per group, NaN for groups holding a NaN"""
+    by_group = pd.Series(values).groupby(group)
+    value_range = (by_group.max() - by_group.min()).to_numpy(copy=True)
+    value_range[pd.Series(np.isnan(values)).groupby(group).any().values] = np.nan
+    return value_range
+
+
+def _direction_signs(transect, times, values, n_transects):
+    """
+    Signs of the changes between the unique (TIME, value) pairs of each transect, as the transect loop took them
+    from transect_df[['TIME', value]].drop_duplicates().
+    :return: (group, sign, time) for each unique pair, the sign being of the difference to the next pair
+        within the transect (NaN on its last pair), plus the number of unique pairs per transect
+    """
+    pairs = pd.DataFrame({'transect': transect, 'TIME': times, 'value': values})
+    pairs = pairs[~pairs.duplicated()]
+    pairs = pairs.iloc[np.argsort(pairs['transect'].values, kind='stable')]
+    group = pairs['transect'].values
+    value = pairs['value'].values
+    sign = np.full(len(pairs), np.nan)
+    same = group[1:] == group[:-1]
+    sign[:-1][same] = np.sign(np.diff(value))[same]
+    counts = np.bincount(group, minlength=n_transects)
+    return group, sign, pairs['TIME'].values, counts
+
+
+def split_directions(meta, transect_ids, counters, registry=None):
+    """
+    Split transects where the ship changes direction, in latitude or longitude whichever has the larger range.
+    Single-step reversals are ignored, and so are all changes of a transect whose first change comes before
+    the min_split_fraction of its line. Profiles from a change on get a new transect id.
+    :param transect_ids: array of transect ids from split_cruises
+    :param counters: id counters for utils.make_transect_ids, updated in place
+    :param registry: line registry of line_config.load_line_registry, the default lines config if None
+    :return: (array of transect ids, one per row of meta, list of transects whose changes were ignored)
+    """
+    transect, uniques = pd.factorize(transect_ids)
+    times = meta['TIME'].values
+    lats = meta['LATITUDE'].values
+    lons = meta['LONGITUDE'].values
+    n_transects = len(uniques)
+
+    # pick latitude or longitude per transect, a NaN range (as np.ptp gives with any NaN) compares False
+    lat_range = _group_range(lats, transect)
+    lon_range = _group_range(lons, transect)
+    use_lat = lat_range >= lon_range
+
+    lat_group, lat_sign, lat_times, lat_counts = _direction_signs(transect, times, lats, n_transects)
+    lon_group, lon_sign, _, _ = _direction_signs(transect, times, lons, n_transects)
+    lat_start = np.r_[0, np.cumsum(lat_counts)[:-1]]
+
+    # one sign per difference, i.e. all pairs but the last of each transect
+    keep_lat = use_lat[lat_group] & np.r_[lat_group[1:] == lat_group[:-1], False]
+    keep_lon = ~use_lat[lon_group] & np.r_[lon_group[1:] == lon_group[:-1], False]
+    group = np.concatenate([lat_group[keep_lat], lon_group[keep_lon]])
+    order = np.argsort(group, kind='stable')
+    group = group[order]
+    s = pd.Series(np.concatenate([lat_sign[keep_lat], lon_sign[keep_lon]])[order])
+    if len(s) == 0:
+        return np.asarray(transect_ids, dtype=str), []
+
+    # treat zeros as NaN and propagate the nearest non-zero sign
+    s[s == 0] = np.nan
+    s = s.groupby(group).ffill().groupby(group).bfill()
+    # mask single-element spikes: neighbors equal and center is different (and none are NaN)
+    before = s.groupby(group).shift(1)
+    after = s.groupby(group).shift(-1)
+    spike_mask = s.notna() & before.notna() & after.notna() & (before == after) & (s != before)
+    s[spike_mask] = np.nan
+    s = s.groupby(group).ffill().groupby(group).bfill().values.copy()
+
+    # change values at ends of s if they are different from their only neighbor
+    n_signs = np.bincount(group, minlength=n_transects)
+    first_sign = np.r_[0, np.cumsum(n_signs)[:-1]]
+    start = first_sign[n_signs > 1]
+    end = start + n_signs[n_signs > 1] - 1
+    fix = s[start] != s[start + 1]
+    s[start[fix]] = s[start[fix] + 1]
+    fix = s[end] != s[end - 1]
+    s[end[fix]] = s[end[fix] - 1]
+
+    # positions where the sign changes, NaN comparing as a change
+    change = np.flatnonzero((s[1:] != s[:-1]) & (group[1:] == group[:-1]))
+    change_group = group[change]
+    position = change - first_sign[change_group]
+
+    # changes are ignored for the whole transect if its first one is too early
+    soop_lines = np.asarray(meta['SOOP_line'], dtype=str)
+    first_row = pd.Series(np.arange(len(transect))).groupby(transect).first().values
+    min_split_fraction = line_lookup(soop_lines[first_row], 'min_split_fraction', registry)
+    first_change = np.r_[True, change_group[1:] != change_group[:-1]][:len(change_group)]
+    too_early = (n_signs[change_group] - position) / n_signs[change_group] > 1 - min_split_fraction[change_group]
+    ignored = np.unique(change_group[first_change & too_early])
+    split = ~np.isin(change_group, ignored)
+    change_group = change_group[split]
+    position = position[split]
+
+    # the time of a change is read from the unique (TIME, LATITUDE) pairs, whichever coordinate gave the sign;
+    # clip to the last pair should the longitude sequence be the longer one
+    pair = lat_start[change_group] + np.minimum(position + 1, lat_counts[change_group] - 1)
+    change_times = lat_times[pair]
+
+    new_ids = make_transect_ids(soop_lines[first_row[change_group]], change_times, counters)
+
+    # each profile takes the id of the last change of its transect at or before its time
+    changes = pd.DataFrame({'TIME': change_times, 'transect': change_group, 'new_id': new_ids})
+    changes = changes.sort_values('TIME', kind='stable')
+    rows = pd.DataFrame({'TIME': times, 'transect': transect, 'row': np.arange(len(transect))})
+    matched = pd.merge_asof(rows, changes, on='TIME', by='transect', direction='backward')
+    matched = matched.sort_values('row')
+    new_transect_ids = np.asarray(transect_ids, dtype=object).copy()
+    has_change = matched['new_id'].notna().values
+    new_transect_ids[has_change] = matched['new_id'].values[has_change]
+    return new_transect_ids.astype(str), list(uniques[ignored])
+
+
+def segment_transects(meta, counters=None, registry=None):
+    """
+    Assign transect ids to the profiles in meta (one row per profile, sorted by TIME):
+    split by cruise and time gaps, then by changes of direction.
+    :param counters: id counters for utils.make_transect_ids, updated in place
+    :param registry: line registry of line_config.load_line_registry, the default lines config if None
+    :return: array of transect ids, one per row of meta
+    """
+    counters = {} if counters is None else counters
+    if len(meta) == 0:
+        return np.array([], dtype=str)
+    transect_ids = split_cruises(meta, counters, registry)
+    transect_ids, ignored = split_directions(meta, transect_ids, counters, registry)
+    for transect in ignored:
+        print('Ignoring direction changes for transect: %s due to high frequency of changes' % transect)
+    return transect_ids
+
+
+def transect_summaries(meta):
+    """
+    One row per transect, in order of first appearance: start and end time, direction ('N', 'S', 'E' or 'W',
+    along latitude or longitude whichever has the larger range), and the summaries used to test whether
+    two transects together are monotonic in position: first and last LATITUDE/LONGITUDE, whether each is
+    non-decreasing or non-increasing in time, and whether the summaries can be trusted (see combine_transects).
+    """
+    transect, uniques = pd.factorize(meta['transect_id'].values)
+    times = meta['TIME'].values
+    frame = pd.DataFrame({'transect': transect, 'TIME': times,
+                          'LATITUDE': meta['LATITUDE'].values, 'LONGITUDE': meta['LONGITUDE'].values})
+    by_transect = frame.groupby('transect')
+    # first and last skip NaN, as the groupby summary of the transect loop did
+    summary = by_transect.agg(start_time=('TIME', 'min'), end_time=('TIME', 'max'),
+                              lat_min=('LATITUDE', 'min'), lat_max=('LATITUDE', 'max'),
+                              lat_first=('LATITUDE', 'first'), lat_last=('LATITUDE', 'last'),
+                              lon_min=('LONGITUDE', 'min'), lon_max=('LONGITUDE', 'max'),
+                              lon_first=('LONGITUDE', 'first'), lon_last=('LONGITUDE', 'last'))
+    summary.index = uniques
+
+    lat_range = summary['lat_max'] - summary['lat_min']
+    lon_range = summary['lon_max'] - summary['lon_min']
+    along_lat = (lat_range >= lon_range).values
+    lat_dir = np.where((summary['lat_last'] - summary['lat_first']).values > 0, 'N', 'S')
+    lon_dir = np.where((summary['lon_last'] - summary['lon_first']).values > 0, 'E', 'W')
+    summary['direction'] = np.where(along_lat, lat_dir, lon_dir)
+
+    # monotonicity of each coordinate in time order, with the rows of each transect together (meta is sorted by TIME)
+    order = np.argsort(transect, kind='stable')
+    group = transect[order]
+    times = times[order]
+    lats = frame['LATITUDE'].values[order]
+    lons = frame['LONGITUDE'].values[order]
+    same = np.r_[False, group[1:] == group[:-1]]
+    for values, name in [(lats, 'lat'), (lons, 'lon')]:
+        step = np.r_[0.0, np.diff(values)]
+        summary[name + '_increasing'] = pd.Series(~same | (step >= 0)).groupby(group).all().values
+        summary[name + '_decreasing'] = pd.Series(~same | (step <= 0)).groupby(group).all().values
+
+    # the summaries hold only if the time order of the profiles is unambiguous and there are no NaN positions:
+    # profiles sharing a TIME but not their position, or NaN positions, need the full test
+    tied = same & np.r_[False, times[1:] == times[:-1]]
+    moved = np.r_[False, (lats[1:] != lats[:-1]) | (lons[1:] != lons[:-1])]
+    has_nan = np.isnan(lats) | np.isnan(lons)
+    summary['has_nan'] = pd.Series(has_nan).groupby(group).any().values
+    summary['exact'] = ~pd.Series(tied & moved).groupby(group).any().values & ~summary['has_nan'].values
+    return summary
+
+
+def _monotonic_full(meta_a, meta_b):
+    """Whether two transects together are monotonic in LATITUDE or LONGITUDE, as the all-pairs loop tested it"""
+    transect_a_df = meta_a.sort_values(by='TIME')
+    transect_b_df = meta_b.sort_values(by='TIME')
+    combined_lats = pd.concat(
+        [transect_a_df[['TIME', 'LATITUDE']], transect_b_df[['TIME', 'LATITUDE']]]).sort_values(by='TIME')
+    combined_lons = pd.concat(
+        [transect_a_df[['TIME', 'LONGITUDE']], transect_b_df[['TIME', 'LONGITUDE']]]).sort_values(by='TIME')
+    lat_monotonic = combined_lats['LATITUDE'].is_monotonic_increasing or combined_lats[
+        'LATITUDE'].is_monotonic_decreasing
+    lon_monotonic = combined_lons['LONGITUDE'].is_monotonic_increasing or combined_lons[
+        'LONGITUDE'].is_monotonic_decreasing
+    return lat_monotonic or lon_monotonic
+
+
+def _monotonic_arrays(times_a, positions_a, times_b, positions_b):
+    """
+    _monotonic_full on arrays, for transects without NaN positions: positions are (n, 2) arrays of
+    LATITUDE, LONGITUDE. The sorts are the same (unstable) quicksorts sort_values does, so profiles sharing
+    a TIME end up in the same order.
+    """
+    sort_a = np.argsort(times_a, kind='quicksort')
+    sort_b = np.argsort(times_b, kind='quicksort')
+    times = np.concatenate([times_a[sort_a], times_b[sort_b]])
+    positions = np.concatenate([positions_a[sort_a], positions_b[sort_b]])
+    step = np.diff(positions[np.argsort(times, kind='quicksort')], axis=0)
+    return bool(np.any(np.all(step >= 0, axis=0) | np.all(step <= 0, axis=0)))
+
+
+def _monotonic_summary(a, b):
+    """Monotonic test of _monotonic_full from the summaries of two transects with b entirely after a in time"""
+    for name in ['lat', 'lon']:
+        if a[name + '_increasing'] and b[name + '_increasing'] and a[name + '_last'] <= b[name + '_first']:
+            return True
+        if a[name + '_decreasing'] and b[name + '_decreasing'] and a[name + '_last'] >= b[name + '_first']:
+            return True
+    return False
+
+
+def combine_transects(meta, window_days=None, registry=None):
+    """
+    Combine transects with the same direction that together cover less than window_days and are monotonic in
+    latitude or longitude. window_days is the merge_window_days of the line of the absorbing transect unless given. Transects are taken in order of first appearance, and each absorbs in turn the later
+    or earlier transects that still fit in its (growing) time window; the absorbed ones take its id.
+    Candidates are found by a sweep over transects of the same direction sorted by start time, so only those
+    starting within window_days of a transect are tested, and the monotonic test uses per-transect summaries
+    unless the two transects overlap in time or their summaries are not exact, when the profiles are compared.
+    :return: array of transect ids, one per row of meta
+    """
+    summary = transect_summaries(meta)
+    transects = summary.index.values
+    n_transects = len(transects)
+    starts = summary['start_time'].values
+    ends = summary['end_time'].values
+    if window_days is None:
+        first_row = pd.Series(np.arange(len(meta))).groupby(pd.factorize(meta['transect_id'].values)[0]).first()
+        window_days = line_lookup(np.asarray(meta['SOOP_line'], dtype=str)[first_row.values], 'merge_window_days',
+                                  registry)
+    windows = days(np.broadcast_to(window_days, n_transects))
+    records = summary.to_dict('index')
+    rows_by_transect = None
+
+    # candidates of a transect: same direction and starting less than window_days either side of it, since
+    # the combined span can only grow as transects are absorbed
+    candidates = [None] * n_transects
+    for direction, members in pd.Series(np.arange(n_transects)).groupby(summary['direction'].values):
+        members = members.values[np.argsort(starts[members.values], kind='stable')]
+        member_starts = starts[members]
+        lo = np.searchsorted(member_starts, ends[members] - windows[members], side='right')
+        hi = np.searchsorted(member_starts, starts[members] + windows[members], side='left')
+        for member, i, j in zip(members, lo, hi):
+            candidates[member] = np.sort(members[i:j])
+
+    new_ids = transects.astype(object).copy()
+    processed = np.zeros(n_transects, dtype=bool)
+    for a in range(n_transects):
+        if processed[a]:
+            continue
+        start_a, end_a = starts[a], ends[a]
+        combined = [a]
+        for b in candidates[a]:
+            if b == a or processed[b]:
+                continue
+            if max(end_a, ends[b]) - min(start_a, starts[b]) >= windows[a]:
+                continue
+            record_a, record_b = records[transects[a]], records[transects[b]]
+            if record_a['exact'] and record_b['exact'] and (ends[a] < starts[b] or ends[b] < starts[a]):
+                first, second = (record_a, record_b) if ends[a] < starts[b] else (record_b, record_a)
+                monotonic = _monotonic_summary(first, second)
+            else:
+                if rows_by_transect is None:
+                    rows_by_transect = meta.groupby('transect_id', sort=False).indices
+                    times = meta['TIME'].values
+                    positions = meta[['LATITUDE', 'LONGITUDE']].to_numpy(dtype=float)
+                rows_a, rows_b = rows_by_transect[transects[a]], rows_by_transect[transects[b]]
+                if record_a['has_nan'] or record_b['has_nan']:
+                    monotonic = _monotonic_full(meta.iloc[rows_a], meta.iloc[rows_b])
+                else:
+                    monotonic = _monotonic_arrays(times[rows_a], positions[rows_a], times[rows_b], positions[rows_b])
+            if not monotonic:
+                continue
+            combined.append(b)
+            processed[b] = True
+            start_a, end_a = min(start_a, starts[b]), max(end_a, ends[b])
+
+        if len(combined) > 1:
+            new_ids[combined] = transects[a]
+            processed[a] = True
+
+    transect, _ = pd.factorize(meta['transect_id'].values)
+    return new_ids[transect].astype(str)
@@ -0,0 +1,308 @@
+# Split one gridding run over several nodes, or local processes, sharing a filesystem, with the same output as a
+# single run.
+#
+# Shards work in a common folder. Shard i of n removes what a previous run of shard i left there, scans the metadata of
+# every n-th input file and saves it as metadata/metadata-<i>.npz, tagged with a digest of the input listing that covers
+# the size and modification time of every local file, so a metadata file of a run over other or since changed files is
+# never taken for this run's. Once every shard's metadata is there, each shard builds the profile store from all of it
+# in path order, as a single run does, so every shard plans the same transects under the same ids: duplicates,
+# segmentation, combining (which can join transects of different cruises), the data rules and the location filter all
+# run on the whole metadata. Each shard then reads TEMP for, and writes, only its part of the plan: the transects of the
+# SOOP lines, or the years, it is given. It writes them into shard-<i>/ with a manifest of the files and their checksums
+# plus a digest of the plan. The merge checks that the manifests of all shards are there, agree on the plan and cover it
+# once without clashing ids, then moves the files into the output folder.
+#
+# usage: python sharding.py run <input> <output> --shards 4 [--shard-by line] [transect_vertical_grid.py options]
+#        python sharding.py merge <shard folder> <output>
+# or run transect_vertical_grid.py <input> <shard folder> --shard 1/4 on each node, then merge.
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from profile_cache import is_url
+
+SHARD_BY = ['line', 'year']
+METADATA_FOLDER = 'metadata'
+MANIFEST_FILE = 'manifest.json'
+# seconds between checks for the metadata of the other shards
+POLL_INTERVAL = 1.0
+
+
+def parse_shard(text):
+    """Shard 'I/N' (I from 1) as (index from 0, number of shards)"""
+    index, n_shards = (int(part) for part in text.split('/'))
+    if not 1 <= index <= n_shards:
+        raise ValueError('shard must be I/N with 1 <= I <= N, got %r' % text)
+    return index - 1, n_shards
+
+
+def shard_folder(work_directory, index):
+    """Folder shard index (from 0) writes its transects and manifest to"""
+    return Path(work_directory) / ('shard-%d' % (index + 1))
+
+
+def metadata_path(work_directory, index):
+    """File shard index (from 0) saves its scanned metadata to"""
+    return Path(work_directory) / METADATA_FOLDER / ('metadata-%d.npz' % (index + 1))
+
+
+def file_fingerprint(filepath):
+    """Size and modification time of a local file, '' for a url or a file that is gone"""
+    if is_url(filepath):
+        return ''
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return ''
+    return '%d|%d' % (stat.st_size, stat.st_mtime_ns)
+
+
+def listing_digest(filepaths):
+    """
+    Digest of the input listing and the fingerprints of its files, so shards only take the metadata of shards that
+    listed the same, unchanged, files
+    """
+    digest = hashlib.sha1()
+    for filepath in filepaths:
+        digest.update(('%s|%s\n' % (filepath, file_fingerprint(filepath))).encode())
+    return digest.hexdigest()
+
+
+def _read_metadata(path, digest, n_shards):
+    """The profile arrays of a metadata file of this run, None if it is missing or from another run"""
+    if not path.exists():
+        return None
+    with np.load(path, allow_pickle=False) as npz:
+        if str(npz['listing']) != digest or int(npz['n_shards']) != n_shards:
+            return None
+        return {key: npz[key] for key in npz.files if key not in ('listing', 'n_shards')}
+
+
+def scan_shard(filepaths, work_directory, shard, timeout=None, **load_options):
+    """
+    Scan the metadata of this shard's part of filepaths (every n-th file), save it for the other shards and
+    wait for theirs.
+    :param filepaths: every input file, listed the same way by every shard
+    :param shard: (index from 0, number of shards)
+    :param timeout: seconds to wait for the other shards, None for no limit
+    :param load_options: passed to load_profiles
+    :return: the scanned profiles of all shards as load_profiles returns them with metadata_only, in path order
+    """
+    # imported here as transect_vertical_grid imports this module
+    from transect_vertical_grid import load_profiles
+
+    index, n_shards = shard
+    path = metadata_path(work_directory, index)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    digest = listing_digest(filepaths)
+    profiles = load_profiles(filepaths[index::n_shards], None, metadata_only=True, **load_options)
+    tmp_path = path.with_suffix('.tmp.npz')
+    np.savez(tmp_path, listing=np.array(digest), n_shards=np.array(n_shards), **profiles)
+    os.replace(tmp_path, path)
+
+    parts = {index: profiles}
+    start = time.monotonic()
+    while len(parts) < n_shards:
+        for other in range(n_shards):
+            if other not in parts:
+                part = _read_metadata(metadata_path(work_directory, other), digest, n_shards)
+                if part is not None:
+                    parts[other] = part
+        if len(parts) < n_shards:
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError('no metadata from shards %s after %d s' % (
+                    ', '.join(str(other + 1) for other in range(n_shards) if other not in parts), timeout))
+            time.sleep(POLL_INTERVAL)
+    print(f"Shard {index + 1} of {n_shards}: metadata of {sum(len(p['path']) for p in parts.values())} files from "
+          f"{n_shards} shards")
+    profiles = {key: np.concatenate([parts[other][key] for other in range(n_shards)]) for key in profiles}
+    order = np.argsort(profiles['path'], kind='stable')
+    return {key: values[order] for key, values in profiles.items()}
+
+
+def plan_digest(meta, rows_by_transect, mask_depths=None):
+    """Digest of the transects to write, their member files and masks, equal on every shard of a run"""
+    paths = meta['path'].to_numpy(dtype=str)
+    masks = np.full(len(meta), np.nan) if mask_depths is None else np.asarray(mask_depths, dtype=float)
+    digest = hashlib.sha1()
+    for transect in sorted(rows_by_transect):
+        rows = np.sort(rows_by_transect[transect])
+        digest.update(('%s:%s\n' % (transect, ','.join('%s|%r' % (paths[r], masks[r]) for r in rows))).encode())
+    return digest.hexdigest()
+
+
+def shard_keys(meta, rows_by_transect, shard_by):
+    """Partition key of each transect: the SOOP line or the year of its first profile"""
+    if shard_by not in SHARD_BY:
+        raise ValueError('shard_by must be one of %s, got %r' % (', '.join(SHARD_BY), shard_by))
+    # meta is sorted by TIME, so the first row of a transect is its first profile
+    first = np.array([rows.min() for rows in rows_by_transect.values()], dtype=np.int64)
+    if shard_by == 'line':
+        keys = meta['SOOP_line'].to_numpy(dtype=str)[first]
+    else:
+        keys = meta['TIME'].dt.year.to_numpy()[first].astype(str)
+    return dict(zip(rows_by_transect, keys))
+
+
+def assign_keys(sizes, n_shards):
+    """
+    Give each partition key to a shard, balancing the profiles per shard: the largest keys first, each to the shard
+    with the fewest profiles so far (the lowest numbered on ties), the same on every shard.
+    :param sizes: dict of key: number of profiles
+    :return: dict of key: shard index from 0
+    """
+    loads = np.zeros(n_shards, dtype=np.int64)
+    assignment = {}
+    for key in sorted(sizes, key=lambda k: (-sizes[k], k)):
+        assignment[key] = int(np.argmin(loads))
+        loads[assignment[key]] += sizes[key]
+    return assignment
+
+
+def shard_transects(meta, rows_by_transect, shard, shard_by='line'):
+    """The transects of rows_by_transect this shard writes, as a dict of transect_id: rows"""
+    index, n_shards = shard
+    keys = shard_keys(meta, rows_by_transect, shard_by)
+    sizes = {}
+    for transect, rows in rows_by_transect.items():
+        sizes[keys[transect]] = sizes.get(keys[transect], 0) + len(rows)
+    assignment = assign_keys(sizes, n_shards)
+    return {transect: rows for transect, rows in rows_by_transect.items() if assignment[keys[transect]] == index}
+
+
+def file_sha256(path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_shard_manifest(work_directory, shard, shard_by, plan, n_planned, transects, subfolders=('',)):
+    """
+    Write the manifest of a finished shard, via a temporary file: the run's plan digest and number of transects,
+    and the files, sizes and checksums of each transect the shard wrote
+    :param transects: transect ids written by the shard
+    :param subfolders: subfolders of the shard folder a file of each transect is written to, one per vertical
+        product of the run (see vertical_products), '' for the shard folder itself
+    """
+    index, n_shards = shard
+    folder = shard_folder(work_directory, index)
+    files = {}
+    for transect in sorted(transects):
+        files[transect] = []
+        for subfolder in subfolders:
+            path = folder / subfolder / (transect + '.nc')
+            files[transect].append({'file': str(path.relative_to(folder)), 'bytes': path.stat().st_size,
+                                    'sha256': file_sha256(path)})
+    manifest = {'shard': index + 1, 'n_shards': n_shards, 'shard_by': shard_by, 'plan': plan,
+                'n_planned': n_planned, 'transects': files}
+    tmp_path = folder / (MANIFEST_FILE + '.tmp')
+    tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp_path, folder / MANIFEST_FILE)
+
+
+def clear_shard_manifest(work_directory, index):
+    """
+    Remove the manifest and the metadata file of a previous run of shard index, so neither a merge nor the other
+    shards can take them for this run's
+    """
+    for path in (shard_folder(work_directory, index) / MANIFEST_FILE, metadata_path(work_directory, index)):
+        if path.exists():
+            os.remove(path)
+
+
+def merge_shards(work_directory, output_directory):
+    """
+    Move the transects written by the shards of a run into output_directory, after checking that every shard
+    finished, all planned the same transects and together wrote each of them once, with the checksum in their
+    manifest.
+    :return: dict of transect_id: shard number (from 1)
+    """
+    manifests = sorted(Path(work_directory).glob('shard-*/' + MANIFEST_FILE))
+    if not manifests:
+        raise ValueError('no shard manifests in %s' % work_directory)
+    manifests = [json.loads(path.read_text()) for path in manifests]
+    n_shards = manifests[0]['n_shards']
+    shards = sorted(m['shard'] for m in manifests)
+    if shards != list(range(1, n_shards + 1)) or any(m['n_shards'] != n_shards for m in manifests):
+        raise ValueError('expected the manifests of shards 1 to %d, found %s' % (n_shards, shards))
+    if len({m['plan'] for m in manifests}) > 1:
+        raise ValueError('the shards planned different transects, their inputs or settings differ')
+
+    owner = {}
+    for manifest in manifests:
+        for transect in manifest['transects']:
+            if transect in owner:
+                raise ValueError('transect %s written by shards %d and %d' % (transect, owner[transect],
+                                                                             manifest['shard']))
+            owner[transect] = manifest['shard']
+    if len(owner) != manifests[0]['n_planned']:
+        raise ValueError('the shards wrote %d transects of the %d planned' % (len(owner), manifests[0]['n_planned']))
+
+    os.makedirs(output_directory, exist_ok=True)
+    for manifest in manifests:
+        folder = shard_folder(work_directory, manifest['shard'] - 1)
+        for transect, entries in manifest['transects'].items():
+            for entry in entries:
+                source = folder / entry['file']
+                if file_sha256(source) != entry['sha256']:
+                    raise ValueError('%s does not match the checksum in its manifest' % source)
+                target = os.path.join(output_directory, entry['file'])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(str(source), target)
+    print(f"Merged {len(owner)} transects of {n_shards} shards into {output_directory}")
+    return owner
+
+
+def run_local(input_directory, output_directory, n_shards, shard_by='line', work_directory=None, options=()):
+    """
+    Run the shards of a run as local processes of transect_vertical_grid.py, then merge them into output_directory.
+    :param work_directory: folder shared by the shards, <output_directory>/shards if None; removed after the merge
+    :param options: further transect_vertical_grid.py command line options
+    """
+    work_directory = Path(work_directory or Path(output_directory) / 'shards')
+    script = Path(__file__).resolve().parent / 'transect_vertical_grid.py'
+    processes = [subprocess.Popen([sys.executable, str(script), input_directory, str(work_directory),
+                                   '--shard', '%d/%d' % (index + 1, n_shards), '--shard-by', shard_by, *options])
+                 for index in range(n_shards)]
+    failed = [index + 1 for index, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError('shards %s failed' % ', '.join(str(index) for index in failed))
+    owner = merge_shards(work_directory, output_directory)
+    shutil.rmtree(work_directory)
+    return owner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a gridding as several shards and merge their output')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the shards as local processes, then merge them')
+    run.add_argument('input_directory', help='local folder of .nc files or a THREDDS catalog url')
+    run.add_argument('output_folder', help='folder to write the transect netCDF files to')
+    run.add_argument('--shards', type=int, required=True, help='number of shards')
+    run.add_argument('--shard-by', choices=SHARD_BY, default='line',
+                     help='split the transects to write by SOOP line or by year (default: line)')
+    run.add_argument('--work-dir', default=None,
+                     help='folder shared by the shards (default: <output_folder>/shards, removed after the merge)')
+    merge = commands.add_parser('merge', help='merge the output of finished shards')
+    merge.add_argument('work_dir', help='folder the shards wrote to')
+    merge.add_argument('output_folder', help='folder to move the transect netCDF files to')
+    # the other options of a run are handed to every shard
+    args, options = parser.parse_known_args()
+    if args.command == 'merge':
+        if options:
+            parser.error('unrecognized arguments: %s' % ' '.join(options))
+        merge_shards(args.work_dir, args.output_folder)
+    else:
+        run_local(args.input_directory, args.output_folder, args.shards, shard_by=args.shard_by,
+                  work_directory=args.work_dir, options=options)
@@ -0,0 +1,34 @@
+# The data rules of dataRules.csv against the profiles matlab/remove_bad_data.m removes and masks.
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from data_rules import load_data_rules, apply_data_rules
+from line_config import load_line_registry
+
+
+def px34_transect(n_profiles=70, n_east=3):
+    """Metadata of transect PX34-200802-1, its first n_east profiles east of 173E and south of 41S"""
+    lons = np.linspace(172.5, 151.5, n_profiles)
+    lats = np.linspace(-40.5, -34.0, n_profiles)
+    lons[:n_east] = 174.0
+    lats[:n_east] = -41.3
+    return pd.DataFrame({'transect_id': 'PX34-200802-1', 'SOOP_line': 'PX34',
+                         'TIME': pd.date_range('2008-02-01', periods=n_profiles, freq='2h'),
+                         'LATITUDE': lats, 'LONGITUDE': lons,
+                         'Institution_unique_identifier': [str(88000 + i) for i in range(n_profiles)]})
+
+
+def test_px34_masks_count_profiles_after_the_region_drop():
+    # remove_bad_data.m drops the profiles east of 173E and south of 41S, then sets TEMP(:, 59) and
+    # TEMP(DEPTH > 270, 2) of what is left to NaN: profiles 62 and 5 of the transect as segmented
+    meta = px34_transect()
+    transect_ids, mask_depths = apply_data_rules(meta, load_data_rules('dataRules.csv'), load_line_registry())
+
+    assert list(np.flatnonzero(pd.isna(transect_ids))) == [0, 1, 2]
+    assert list(np.flatnonzero(np.isfinite(mask_depths))) == [4, 61]
+    assert mask_depths[61] == 0
+    assert mask_depths[4] == 270
@@ -0,0 +1,171 @@
+# The local mirror of remote files (opendap_mirror) against an http.server stand-in for a THREDDS server: the .dds
+# of the OPeNDAP url answers revalidation with the ETag of the file, the file service sends the file.
+import os
+import sys
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+import numpy as np
+import pytest
+import requests
+import xarray as xr
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from opendap_mirror import mirror_file, load_remote, evict, alias_path
+from utils import HDF5_LOCK
+
+
+class ThreddsStandIn(BaseHTTPRequestHandler):
+    # file name under dodsC/ and fileServer/ -> (bytes, ETag), set by the tests
+    files = {}
+    hang = threading.Event()
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        if 'hang' in self.path:
+            self.hang.wait(10)
+            return
+        name = self.path.split('/', 3)[-1].removesuffix('.dds')
+        if name not in self.files:
+            self.send_error(404)
+            return
+        body, etag = self.files[name]
+        if self.path.endswith('.dds'):
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = b'Dataset {} ' + name.encode() + b';'
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ThreddsStandIn.files = {}
+    ThreddsStandIn.requests_seen = []
+    ThreddsStandIn.hang.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ThreddsStandIn)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}/thredds'
+    ThreddsStandIn.hang.set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def xbt_file(tmp_path, temp_offset=0.0, n_depths=200):
+    """Bytes of a small XBT-like netCDF file"""
+    depths = np.arange(1, n_depths + 1, dtype=np.float32)
+    ds = xr.Dataset({'TEMP': ('DEPTH', (20 - depths / 100 + temp_offset).astype(np.float32)),
+                     'TEMP_quality_control': ('DEPTH', np.ones(n_depths, dtype=np.int8)),
+                     'LATITUDE': ((), -34.0), 'LONGITUDE': ((), 151.5), 'TIME': ((), np.datetime64('2010-01-05')),
+                     'PSAL': ('DEPTH', np.zeros(n_depths))},
+                    coords={'DEPTH': depths}, attrs={'XBT_line': 'PX30'})
+    path = tmp_path / f'source-{temp_offset}-{n_depths}.nc'
+    ds.to_netcdf(path)
+    return path.read_bytes()
+
+
+def counting(calls):
+    """open_remote hook that records the urls it fetches"""
+    def open_remote(url, timeout):
+        calls.append(url)
+        return load_remote(url, timeout=timeout)
+    return open_remote
+
+
+def test_unchanged_file_is_revalidated_with_a_304(server, tmp_path):
+    ThreddsStandIn.files['a.nc'] = (xbt_file(tmp_path), '"v1"')
+    calls = []
+    url = f'{server}/dodsC/a.nc'
+    first = mirror_file(url, tmp_path / 'mirror', max_age=0, open_remote=counting(calls))
+    second = mirror_file(url, tmp_path / 'mirror', max_age=0, open_remote=counting(calls))
+
+    assert first == second
+    assert calls == [url]
+    # the file came from the file service, the second call only asked for the .dds
+    assert ThreddsStandIn.requests_seen == ['/thredds/dodsC/a.nc.dds', '/thredds/fileServer/a.nc',
+                                            '/thredds/dodsC/a.nc.dds']
+    with xr.open_dataset(first) as ds:
+        assert 'PSAL' not in ds.variables
+        assert ds['TEMP'].values[0] == np.float32(20 - 0.01)
+
+
+def test_changed_etag_fetches_again(server, tmp_path):
+    ThreddsStandIn.files['a.nc'] = (xbt_file(tmp_path), '"v1"')
+    calls = []
+    url = f'{server}/dodsC/a.nc'
+    first = mirror_file(url, tmp_path / 'mirror', max_age=0, open_remote=counting(calls))
+    ThreddsStandIn.files['a.nc'] = (xbt_file(tmp_path, temp_offset=1), '"v2"')
+    second = mirror_file(url, tmp_path / 'mirror', max_age=0, open_remote=counting(calls))
+
+    assert calls == [url, url]
+    assert first != second
+    with xr.open_dataset(second) as ds:
+        assert ds['TEMP'].values[0] == np.float32(21 - 0.01)
+    assert json.loads(alias_path(url, tmp_path / 'mirror').read_text())['etag'] == '"v2"'
+
+
+def test_urls_of_the_same_file_share_one_copy(server, tmp_path):
+    body = xbt_file(tmp_path)
+    ThreddsStandIn.files['a.nc'] = (body, '"v1"')
+    ThreddsStandIn.files['b.nc'] = (body, '"v1"')
+    paths = [mirror_file(f'{server}/dodsC/{name}', tmp_path / 'mirror') for name in ('a.nc', 'b.nc')]
+
+    assert paths[0] == paths[1]
+    assert len(list((tmp_path / 'mirror').glob('*.nc'))) == 1
+    assert len(list((tmp_path / 'mirror').glob('*.json'))) == 2
+
+
+def test_least_recently_used_files_are_evicted(server, tmp_path):
+    urls = []
+    for i in range(3):
+        ThreddsStandIn.files[f'{i}.nc'] = (xbt_file(tmp_path, temp_offset=i), f'"{i}"')
+        urls.append(f'{server}/dodsC/{i}.nc')
+    paths = [mirror_file(url, tmp_path / 'mirror') for url in urls]
+    # use 0 again after 1 and 2, so 1 is the least recently used
+    for path, age in zip(paths, [1, 3, 2]):
+        os.utime(path, (time.time() - age, time.time() - age))
+    size = paths[0].stat().st_size
+    evict(tmp_path / 'mirror', 2 * size + size // 2)
+
+    assert [path.exists() for path in paths] == [True, False, True]
+    assert not alias_path(urls[1], tmp_path / 'mirror').exists()
+    calls = []
+    mirror_file(urls[1], tmp_path / 'mirror', open_remote=counting(calls))
+    assert calls == [urls[1]]
+
+
+def test_hung_server_times_out_without_holding_the_lock(server, tmp_path):
+    errors = []
+
+    def fetch():
+        try:
+            mirror_file(f'{server}/dodsC/hang.nc', tmp_path / 'mirror', timeout=1)
+        except requests.Timeout as e:
+            errors.append(e)
+
+    t0 = time.perf_counter()
+    thread = threading.Thread(target=fetch)
+    thread.start()
+    time.sleep(0.3)
+    # local netCDF reads and writes go on while the download waits
+    assert HDF5_LOCK.acquire(timeout=0.5)
+    HDF5_LOCK.release()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    assert time.perf_counter() - t0 < 5
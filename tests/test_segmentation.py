@@ -0,0 +1,220 @@
+# The transect ids of segmentation against the per-cruise, per-transect and all-pairs loops it replaced, kept below
+# as the reference, on seeded random cruises with time gaps, zigzags, profiles sharing a TIME and flat positions.
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+import segmentation
+from segmentation import segment_transects, combine_transects
+from line_config import load_line_registry
+from utils import make_transect_id
+
+LINES = ['PX30', 'IX28', 'PX34', 'IX01']
+# hours between consecutive profiles of a cruise: 0 gives profiles sharing a TIME, 12 days a gap
+STEP_HOURS = [4, 6, 24, 12 * 24, 0]
+STEP_P = [.4, .3, .2, .05, .05]
+
+
+def random_meta(seed, n_cruises=30):
+    """Per-profile metadata of n_cruises random cruises, sorted by TIME as profile_store keeps it"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for cruise in range(n_cruises):
+        line = LINES[rng.integers(0, len(LINES))]
+        n = int(rng.integers(1, 60))
+        start = np.datetime64('2005-01-01') + np.timedelta64(int(rng.integers(0, 200 * 86400)), 's')
+        hours = rng.choice(STEP_HOURS, size=n, p=STEP_P)
+        # mostly one way with some steps back, and longitude wandering or barely moving
+        lats = np.cumsum(rng.choice([-1, 1], size=n, p=[.2, .8]) * rng.random(n)) - 30
+        lons = np.cumsum(rng.choice([-1, 1, 0], size=n, p=[.2, .6, .2]) * rng.random(n) * rng.choice([0.1, 3])) + 150
+        if rng.random() < .2:
+            # flat stretches: consecutive profiles at the same latitude
+            lats = np.round(lats)
+        frames.append(pd.DataFrame({'LATITUDE': lats, 'LONGITUDE': lons,
+                                    'TIME': start + np.cumsum(hours).astype('timedelta64[h]'),
+                                    'SOOP_line': line, 'Cruise_ID': 'C%03d' % cruise,
+                                    'Institution_unique_identifier': [str(i) for i in range(n)]}))
+    meta = pd.concat(frames, ignore_index=True)
+    meta['TIME'] = meta['TIME'].astype('datetime64[ns]')
+    meta = meta.iloc[np.argsort(meta['TIME'].values, kind='stable')].reset_index(drop=True)
+    for col in ['SOOP_line', 'Cruise_ID']:
+        meta[col] = meta[col].astype('category')
+    return meta
+
+
+def split_transects_loop(meta):
+    """
+    The transect split of transect_vertical_grid before segmentation: one transect per cruise, split at gaps of
+    more than 10 days for cruises covering more than 20 days, then at each change of direction.
+    :return: array of transect ids, one per row of meta, and the transects whose direction changes were ignored
+    """
+    meta = meta.copy()
+    meta['transect_id'] = ''
+    counters = {}
+    for cruise_id in meta['Cruise_ID'].unique():
+        cruise_mask = meta['Cruise_ID'] == cruise_id
+        cruise_df = meta.loc[cruise_mask]
+        soop_line = cruise_df['SOOP_line'].iloc[0]
+        unique_dates = np.sort(cruise_df['TIME'].unique())
+        if unique_dates.size == 0:
+            continue
+        if max(unique_dates) - min(unique_dates) > pd.Timedelta(days=20):
+            gap_indices = np.where(np.diff(unique_dates) > pd.Timedelta(days=10))[0]
+            if len(gap_indices) > 0:
+                bounds = [0] + list(gap_indices + 1) + [len(unique_dates)]
+                for lo, hi in zip(bounds[:-1], bounds[1:]):
+                    sub_dates = unique_dates[lo:hi]
+                    transect_id = make_transect_id(soop_line, sub_dates[0], counters)
+                    meta.loc[cruise_mask & meta['TIME'].isin(sub_dates), 'transect_id'] = transect_id
+                continue
+        meta.loc[cruise_mask, 'transect_id'] = make_transect_id(soop_line, unique_dates[0], counters)
+
+    ignored = []
+    unique_transects = meta['transect_id'].unique()
+    transect_metas = {transect: meta[meta['transect_id'] == transect].copy() for transect in unique_transects}
+    for transect in unique_transects:
+        transect_df = transect_metas[transect]
+        transect_mask = meta['transect_id'] == transect
+        unique_lats = transect_df[['TIME', 'LATITUDE']].drop_duplicates()
+        unique_lons = transect_df[['TIME', 'LONGITUDE']].drop_duplicates()
+        if np.ptp(unique_lats['LATITUDE'].values) >= np.ptp(unique_lons['LONGITUDE'].values):
+            s = np.sign(np.diff(unique_lats['LATITUDE'].values)).astype(float)
+        else:
+            s = np.sign(np.diff(unique_lons['LONGITUDE'].values)).astype(float)
+        # zeros take the nearest sign, then single spikes between two equal signs are removed
+        s[s == 0] = np.nan
+        s = pd.Series(s).ffill().bfill()
+        spike_mask = (s.notna() & s.shift(1).notna() & s.shift(-1).notna()
+                      & (s.shift(1) == s.shift(-1)) & (s != s.shift(1)))
+        s[spike_mask] = np.nan
+        s = s.ffill().bfill().values.copy()
+        if len(s) > 1:
+            if s[0] != s[1]:
+                s[0] = s[1]
+            if s[-1] != s[-2]:
+                s[-1] = s[-2]
+
+        for direction in np.where(np.diff(s) != 0)[0]:
+            if (len(s) - direction) / len(s) > 0.75:
+                ignored.append(transect)
+                break
+            # the time of the change is looked up in the latitudes, whichever coordinate gave the signs
+            change_time = unique_lats['TIME'].values[direction + 1]
+            new_transect_id = make_transect_id(transect_df['SOOP_line'].iloc[0], change_time, counters)
+            meta.loc[transect_mask & (meta['TIME'] >= change_time), 'transect_id'] = new_transect_id
+    return meta['transect_id'].values.astype(str), ignored
+
+
+def combine_transects_loop(meta):
+    """
+    The transect combine of transect_vertical_grid before segmentation: each transect in turn absorbs every later
+    or earlier one with the same direction if the two together are monotonic in latitude or longitude and cover
+    less than 15 days.
+    :return: array of transect ids, one per row of meta
+    """
+    meta = meta.copy()
+    unique_transects = meta['transect_id'].unique()
+    transect_metas = {transect: meta[meta['transect_id'] == transect].copy() for transect in unique_transects}
+    transect_summary = meta.groupby('transect_id').agg({'TIME': ['min', 'max'],
+                                                        'LATITUDE': ['min', 'max', 'first', 'last'],
+                                                        'LONGITUDE': ['min', 'max', 'first', 'last']})
+    transect_info = {}
+    for transect in unique_transects:
+        summary = transect_summary.loc[transect]
+        lat_range = summary[('LATITUDE', 'max')] - summary[('LATITUDE', 'min')]
+        lon_range = summary[('LONGITUDE', 'max')] - summary[('LONGITUDE', 'min')]
+        if lat_range >= lon_range:
+            direction = 'N' if summary[('LATITUDE', 'last')] - summary[('LATITUDE', 'first')] > 0 else 'S'
+        else:
+            direction = 'E' if summary[('LONGITUDE', 'last')] - summary[('LONGITUDE', 'first')] > 0 else 'W'
+        transect_info[transect] = {'start_time': summary[('TIME', 'min')], 'end_time': summary[('TIME', 'max')],
+                                   'direction': direction}
+
+    processed_transects = set()
+    for transect_a in unique_transects:
+        if transect_a in processed_transects:
+            continue
+        info_a = transect_info[transect_a]
+        combined_transect = [transect_a]
+        for transect_b in unique_transects:
+            if transect_b == transect_a or transect_b in processed_transects:
+                continue
+            info_b = transect_info[transect_b]
+            if info_a['direction'] != info_b['direction']:
+                continue
+            combined_duration = (max(info_a['end_time'], info_b['end_time'])
+                                 - min(info_a['start_time'], info_b['start_time'])).days
+            transect_a_df = transect_metas[transect_a].sort_values(by='TIME')
+            transect_b_df = transect_metas[transect_b].sort_values(by='TIME')
+            combined_lats = pd.concat([transect_a_df[['TIME', 'LATITUDE']],
+                                       transect_b_df[['TIME', 'LATITUDE']]]).sort_values(by='TIME')['LATITUDE']
+            combined_lons = pd.concat([transect_a_df[['TIME', 'LONGITUDE']],
+                                       transect_b_df[['TIME', 'LONGITUDE']]]).sort_values(by='TIME')['LONGITUDE']
+            lat_monotonic = combined_lats.is_monotonic_increasing or combined_lats.is_monotonic_decreasing
+            lon_monotonic = combined_lons.is_monotonic_increasing or combined_lons.is_monotonic_decreasing
+            if not lat_monotonic and not lon_monotonic:
+                continue
+            if combined_duration < 15:
+                combined_transect.append(transect_b)
+                processed_transects.add(transect_b)
+                info_a['start_time'] = min(info_a['start_time'], info_b['start_time'])
+                info_a['end_time'] = max(info_a['end_time'], info_b['end_time'])
+
+        if len(combined_transect) > 1:
+            for t in combined_transect:
+                meta.loc[meta['transect_id'] == t, 'transect_id'] = transect_a
+            processed_transects.add(transect_a)
+    return meta['transect_id'].values.astype(str)
+
+
+@pytest.fixture(scope='module')
+def registry():
+    return load_line_registry(str(REPO / 'soopLines.csv'))
+
+
+@pytest.mark.parametrize('seed', range(12))
+def test_segment_transects_matches_the_loops(seed, registry, capsys):
+    meta = random_meta(seed)
+    expected, ignored = split_transects_loop(meta)
+    capsys.readouterr()
+    transect_ids = segment_transects(meta, registry=registry)
+
+    assert np.array_equal(transect_ids, expected)
+    messages = capsys.readouterr().out.splitlines()
+    assert sorted(messages) == sorted('Ignoring direction changes for transect: %s due to high frequency of changes'
+                                      % transect for transect in ignored)
+
+
+def counting(function, calls):
+    """function, appending its name to calls on each call"""
+    def wrapper(*args):
+        calls.append(function.__name__)
+        return function(*args)
+    return wrapper
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_combine_transects_matches_the_all_pairs_loop(seed, registry, monkeypatch):
+    # fewer cruises, as the all-pairs loop is quadratic in the number of transects
+    meta = random_meta(seed, n_cruises=15)
+    meta['transect_id'] = segment_transects(meta, registry=registry)
+    # NaN positions in some transects, which only the profile by profile test of pandas handles
+    rng = np.random.default_rng(seed)
+    nan_rows = rng.choice(len(meta), size=len(meta) // 50, replace=False)
+    meta.loc[nan_rows[::2], 'LATITUDE'] = np.nan
+    meta.loc[nan_rows[1::2], 'LONGITUDE'] = np.nan
+    calls = []
+    for name in ['_monotonic_full', '_monotonic_arrays', '_monotonic_summary']:
+        monkeypatch.setattr(segmentation, name, counting(getattr(segmentation, name), calls))
+    transect_ids = combine_transects(meta, registry=registry)
+
+    assert np.array_equal(transect_ids, combine_transects_loop(meta))
+    assert len(np.unique(transect_ids)) < meta['transect_id'].nunique()
+    # transects overlapping in time or sharing a TIME at different positions, and those with NaN positions,
+    # take the fallbacks to the profiles rather than the summaries
+    assert {'_monotonic_full', '_monotonic_arrays', '_monotonic_summary'} <= set(calls)
@@ -0,0 +1,143 @@
+# Crawl THREDDS catalogs for XBT netCDF files.
+# Catalogs are read as catalog.xml (not the html pages), catalogRef entries are followed to any depth and up to
+# max_concurrency catalogs are fetched at a time over one pooled requests session. The OPeNDAP (dodsC) url of each
+# file is built from the catalog's OPENDAP service base and the dataset urlPath.
+import queue
+import asyncio
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+THREDDS_NS = '{http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0}'
+XLINK_NS = '{http://www.w3.org/1999/xlink}'
+
+
+def catalog_xml_url(url):
+    """Return the catalog.xml url of a THREDDS catalog given as its catalog.html page or folder"""
+    if url.endswith('.html'):
+        return url[:-len('.html')] + '.xml'
+    if url.endswith('/'):
+        return url + 'catalog.xml'
+    return url
+
+
+def make_session(pool_size=8, retries=3):
+    """Return a requests session keeping up to pool_size connections open per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parse_catalog(xml_text, catalog_url):
+    """
+    Parse a THREDDS catalog.xml.
+    :return: (file_urls, catalog_urls) where file_urls are the OPeNDAP urls of the .nc datasets, leaving out
+        'TEST' files, and catalog_urls are the absolute urls of the catalogRef entries
+    """
+    root = ET.fromstring(xml_text)
+
+    # OPeNDAP service base, e.g. /thredds/dodsC/, possibly nested in a compound service
+    opendap_base = None
+    for service in root.iter(THREDDS_NS + 'service'):
+        if service.get('serviceType', '').upper() == 'OPENDAP':
+            opendap_base = urljoin(catalog_url, service.get('base', ''))
+            break
+
+    file_urls = []
+    for dataset in root.iter(THREDDS_NS + 'dataset'):
+        url_path = dataset.get('urlPath')
+        name = dataset.get('name', '')
+        if url_path is None or not url_path.endswith('.nc') or 'TEST' in url_path.rsplit('/', 1)[-1]:
+            continue
+        if opendap_base is not None:
+            file_urls.append(opendap_base + url_path.lstrip('/'))
+        else:
+            # no service listed, assume the usual catalog -> dodsC layout next to this catalog
+            file_url = urljoin(catalog_url, name or url_path.rsplit('/', 1)[-1])
+            file_urls.append(file_url.replace('/catalog/', '/dodsC/'))
+
+    catalog_urls = []
+    for ref in root.iter(THREDDS_NS + 'catalogRef'):
+        href = ref.get(XLINK_NS + 'href')
+        if href:
+            catalog_urls.append(catalog_xml_url(urljoin(catalog_url, href)))
+    return file_urls, catalog_urls
+
+
+async def crawl_catalogs(root_urls, session, max_concurrency=8, on_file=None, timeout=60):
+    """
+    Crawl THREDDS catalogs from root_urls to any depth.
+    Each catalog is fetched once, in a worker thread of the session's connection pool, with at most max_concurrency
+    requests in flight.
+    :param on_file: called with each file url as soon as its catalog is parsed
+    :return: sorted list of all file urls found
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    seen = set()
+    file_urls = []
+
+    async def visit(url):
+        async with semaphore:
+            try:
+                response = await asyncio.to_thread(session.get, url, timeout=timeout)
+                response.raise_for_status()
+                files, catalogs = parse_catalog(response.content, url)
+            except (requests.RequestException, ET.ParseError) as e:
+                print(f'Error reading catalog {url}: {e}')
+                return
+        for file_url in files:
+            file_urls.append(file_url)
+            if on_file is not None:
+                on_file(file_url)
+        sub_catalogs = [c for c in catalogs if c not in seen and urlsplit(c).netloc == urlsplit(url).netloc]
+        seen.update(sub_catalogs)
+        await asyncio.gather(*(visit(c) for c in sub_catalogs))
+
+    roots = [catalog_xml_url(url) for url in dict.fromkeys(root_urls)]
+    seen.update(roots)
+    await asyncio.gather(*(visit(url) for url in roots))
+    return sorted(set(file_urls))
+
+
+def crawl_thredds(root_urls, max_concurrency=8):
+    """Return the sorted OPeNDAP urls of all .nc files under the THREDDS catalogs root_urls"""
+    with make_session(pool_size=max_concurrency) as session:
+        return asyncio.run(crawl_catalogs(root_urls, session, max_concurrency=max_concurrency))
+
+
+def iter_thredds_files(root_urls, max_concurrency=8):
+    """
+    Yield the OPeNDAP urls of the .nc files under the THREDDS catalogs root_urls as they are found,
+    so processing can start while the crawl goes on. Urls come in discovery order, not sorted.
+    """
+    found = queue.Queue()
+    done = object()
+    errors = []
+
+    def run():
+        try:
+            with make_session(pool_size=max_concurrency) as session:
+                asyncio.run(crawl_catalogs(root_urls, session, max_concurrency=max_concurrency, on_file=found.put))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            found.put(done)
+
+    crawler = threading.Thread(target=run, daemon=True)
+    crawler.start()
+    seen = set()
+    while True:
+        file_url = found.get()
+        if file_url is done:
+            break
+        if file_url not in seen:
+            seen.add(file_url)
+            yield file_url
+    crawler.join()
+    if errors:
+        raise errors[0]
@@ -1,457 +1,826 @@
 # read in all netcdf files in the XBT transect, extract TEMP, DEPTH, LAT, LON, TIME, SOOP_line information.
 # remove any bad data where TEMP_quality_control != 1, 2 or 5
-# bin the data to 10 m vertical intervals using the bin_data_10m function from bin_data_10m.py
+# smooth the data onto the vertical grid, and/or bin it into vertical intervals with bin_data_10m.py, see
+# vertical_products.py
 # output a single netcdf file with the cleaned and binned data, including the following variables:
 # DEPTH (binned depth intervals), TEMP (binned temperatures), LAT, LON, TIME, SOOP_line
 # include appropriate attributes for each variable and for the global file
 
 import os
-import sys
+import time
+import argparse
+import multiprocessing
 import numpy as np
-import xarray as xr
 import pandas as pd
-from write2netcdf import write_vert_grid_nc
-import requests
-from bs4 import BeautifulSoup
-from interp_gaussian import vinterp_gauss_simple
-from utils import make_transect_id
+from netCDF4 import chartostring
+from xarray.coding.times import decode_cf_datetime
+from write2netcdf import write_transects, print_write_metrics
+from interp_gaussian import vinterp_gauss_simple, vinterp_gauss_depth, vinterp_batch, SMOOTHING_METHODS
+from vertical_products import vertical_products, product_depths, grid_products, VERTICAL_METHODS
+from segmentation import segment_transects, combine_transects
+from utils import hdf5_lock, lock_times
+from line_config import load_line_registry, DEFAULT_LINE
+from location_filter import rejected_transects
+from duplicates import find_duplicates, TIME_TOLERANCE, POSITION_TOLERANCE
+from data_rules import load_data_rules, apply_data_rules, mask_profiles
+from profile_store import build_profile_store, transect_rows, transect_payloads, stream_groups
+from profile_cache import (is_url, load_profiles_cached, run_key, transect_digests, manifest_path, read_manifest,
+                           write_manifest)
+from profile_index import source_key, has_source, update_index, select_profiles
+from sharding import (scan_shard, plan_digest, shard_transects, shard_folder, write_shard_manifest,
+                      clear_shard_manifest, parse_shard, SHARD_BY)
+from run_report import (new_report, stage, count, add_file_records, summarize, print_summary, write_report,
+                        PROFILERS)
+from line_archive import archive_transects
+from thredds_crawler import crawl_thredds, iter_thredds_files
+from opendap_mirror import mirror_file, evict, download, nc_dataset, open_netcdf
 # Import for parallel processing
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
 
+# copies of the TEMP of a group held at once while a streamed run loads it: the worker results, their
+# concatenation and the group matrix
+STREAM_TEMP_COPIES = 3
 
-# Extract file processing into separate function for parallelization
-def process_single_file(filepath, v_grid):
-    """Process a single netCDF file and return extracted data"""
+
+# Extract file reading into separate function for parallelization
+def read_single_file(filepath, log=None):
+    """
+    Read a single netCDF file and return the QC'd profile and its metadata, without interpolating.
+    :param log: dict that gets the 'status' ('no_valid_data' or 'error') and 'error' of a file that gives no profile
+    """
     try:
-        ds = xr.open_dataset(filepath)
-
-        # Extract variables
-        depths = ds['DEPTH'].values
-        temperatures = ds['TEMP'].values.flatten()
-        temp_quality_control = ds['TEMP_quality_control'].values.flatten()
-        lat = np.asarray(ds['LATITUDE'].values).squeeze().item()
-        lon = np.asarray(ds['LONGITUDE'].values).squeeze().item()
-        time = np.asarray(ds['TIME'].values).squeeze().item()
-
-        if 'XBT_uniqueid' in ds.attrs:
-            station_number = ds.attrs.get('XBT_uniqueid', 'Unknown')
-        else:
-            station_number = ds['Institution_unique_identifier'].values.item().decode('utf-8')
-
-        # SOOP_line could be 'XBT_line' in global attributes or in SOOP_line variable attributes
-        if 'XBT_line' in ds.attrs:
-            soop_line = ds.attrs.get('XBT_line', 'Unknown')
-            soop_line_description = ds.attrs.get('XBT_line_description', 'No description available')
-        else:
-            soop_line = ds['SOOP_line'].attrs.get('SOOP_line_label', 'Unknown')
-            soop_line_description = ds['SOOP_line'].attrs.get('SOOP_line_description', 'No description available')
-
-        # Cruise_ID could be in Ship attributes or global attributes as 'XBT_cruise_id'
-        if 'XBT_cruise_ID' in ds.attrs:
-            cruise_id = ds.attrs.get('XBT_cruise_ID', 'Unknown')
-        else:
-            cruise_id = ds['Ship'].attrs.get('Cruise_ID', 'Unknown')
-
-        # Remove bad data where TEMP_quality_control is not 0, 1, 2, or 5 and where temperatures are less than -5 or greater than 40
-        valid_mask = np.isin(temp_quality_control, [0, 1, 2, 5]) & (temperatures >= -5) & (temperatures <= 40)
-        depths = depths[valid_mask]
-        temperatures = temperatures[valid_mask]
-
-        # if there is no valid data, return None
-        if len(temperatures) == 0:
-            print('No valid temperature data in file: %s' % filepath)
-            return None
+        # remote files are downloaded first, outside the lock and bounded by opendap_mirror.TIMEOUT. Then open, read
+        # and close files one thread at a time (see utils.HDF5_LOCK), closing here rather than leaving it to garbage
+        # collection in whichever thread runs it
+        data = download(filepath) if is_url(filepath) else None
+        with hdf5_lock(), open_netcdf(filepath, memory=data) as ds:
+            # Extract variables
+            depths = ds['DEPTH'].values
+            temperatures = ds['TEMP'].values.flatten()
+            temp_quality_control = ds['TEMP_quality_control'].values.flatten()
+            lat = np.asarray(ds['LATITUDE'].values).squeeze().item()
+            lon = np.asarray(ds['LONGITUDE'].values).squeeze().item()
+            time = np.asarray(ds['TIME'].values).squeeze().item()
+
+            if 'XBT_uniqueid' in ds.attrs:
+                station_number = ds.attrs.get('XBT_uniqueid', 'Unknown')
+            else:
+                station_number = ds['Institution_unique_identifier'].values.item().decode('utf-8')
 
-        # return interpolated gaussian smoothed data on with 10m intervals from 0 to 1800m
-        interp_temps = vinterp_gauss_simple(depths, temperatures, v_grid, half_width=11)
-
-        # Return structured data instead of appending to lists
-        return {
-            'depths': v_grid.copy(),
-            'temps': interp_temps,
-            'lat': lat,
-            'lon': lon,
-            'time': time,
-            'soop_line': soop_line,
-            'soop_line_description': soop_line_description,
-            'cruise_id': cruise_id,
-            'station_number': station_number
-        }
+            # SOOP_line could be 'XBT_line' in global attributes or in SOOP_line variable attributes
+            if 'XBT_line' in ds.attrs:
+                soop_line = ds.attrs.get('XBT_line', 'Unknown')
+                soop_line_description = ds.attrs.get('XBT_line_description', 'No description available')
+            else:
+                soop_line = ds['SOOP_line'].attrs.get('SOOP_line_label', 'Unknown')
+                soop_line_description = ds['SOOP_line'].attrs.get('SOOP_line_description', 'No description available')
+
+            # Cruise_ID could be in Ship attributes or global attributes as 'XBT_cruise_id'
+            if 'XBT_cruise_ID' in ds.attrs:
+                cruise_id = ds.attrs.get('XBT_cruise_ID', 'Unknown')
+            else:
+                cruise_id = ds['Ship'].attrs.get('Cruise_ID', 'Unknown')
+
+            # Remove bad data where TEMP_quality_control is not 0, 1, 2, or 5 and where temperatures are less than -5 or greater than 40
+            valid_mask = np.isin(temp_quality_control, [0, 1, 2, 5]) & (temperatures >= -5) & (temperatures <= 40)
+            depths = depths[valid_mask]
+            temperatures = temperatures[valid_mask]
+
+            # if there is no valid data, return None
+            if len(temperatures) == 0:
+                print('No valid temperature data in file: %s' % filepath)
+                if log is not None:
+                    log['status'] = 'no_valid_data'
+                return None
+
+            return {
+                'depths': depths,
+                'temps': temperatures,
+                'lat': lat,
+                'lon': lon,
+                'time': time,
+                'soop_line': soop_line,
+                'soop_line_description': soop_line_description,
+                'cruise_id': cruise_id,
+                'station_number': station_number
+            }
     except Exception as e:
-        print(f'Error processing file {filepath}: {e}')
+        print(f'Error processing file {filepath}: {type(e).__name__}: {e}')
+        if log is not None:
+            log.update(status='error', error=f'{type(e).__name__}: {e}')
         return None
 
 
-def clean_and_bin_transect(input_directories, output_directory):
-    # Pre-define v_grid outside of loop for reuse
-    max_depth = 1800
-    v_grid = np.arange(0, max_depth + 10, 10)
+def _text(value):
+    """A netCDF text value as str, whether it comes as a char array, bytes or str"""
+    value = np.ma.getdata(value)
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'S' and value.dtype.itemsize == 1 and value.ndim > 0:
+        value = chartostring(value)
+    value = np.asarray(value).squeeze().item()
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
 
-    # Check if input_directory is a URL (THREDDS) or local path
-    is_url = input_directories[0].startswith('http://') or input_directories[0].startswith('https://')
-
-    # check if this is a url or a local directory
-    if is_url:
-        file_urls = []
-        # cycle over the list of input directories
-        for input_directory in input_directories:
-            # if url, download all netcdf files to a temporary directory
-            response = requests.get(input_directory)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            links = soup.find_all('a')
-            for link in links:
-                href = link.get('href')
-                if href and href.endswith('.nc') and 'TEST' not in href:
-                    # remove the ''catalog.html?dataset=' part if it exists
-                    if 'catalog.html?dataset=' in href:
-                        href = href.split('catalog.html?dataset=')[-1]
-                    # construct the full file url
-                    file_url = input_directory.rsplit('/', 1)[0] + '/' + href.rsplit('/', 1)[-1]
-                    # replace '/catalog/' with '/dodsC/' to get the direct access url
-                    file_url = file_url.replace('/catalog/', '/dodsC/').replace('.html', '')
-                    file_urls.append(file_url)
-        filenames = file_urls
-    else:
-        # Loop through all netCDF files in the input directory where name does not contain 'TEST' and ends with .nc
-        filenames = [f for f in os.listdir(input_directories[0]) if f.endswith('.nc') and 'TEST' not in f]
-    # sort filenames alphabetically
-    filenames.sort()
 
-    # Parallel file processing with ThreadPoolExecutor
-    print(f"Processing {len(filenames)} files in parallel...")
-    file_results = []
-
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        # Submit all file processing tasks
-        future_to_file = {
-            executor.submit(process_single_file,
-                            filename if is_url else os.path.join(input_directories[0], filename),
-                            v_grid): filename
-            for filename in filenames
-        }
-
-        # Collect results as they complete
-        for future in as_completed(future_to_file):
-            result = future.result()
-            if result is not None:
-                file_results.append(result)
-
-    print(f"Successfully processed {len(file_results)} files")
-
-    # Build DataFrame from records more efficiently
-    records = []
-    for result in file_results:
-        n_depths = len(result['depths'])
-        for i in range(n_depths):
-            records.append({
-                'DEPTH': result['depths'][i],
-                'TEMP': result['temps'][i],
-                'LATITUDE': result['lat'],
-                'LONGITUDE': result['lon'],
-                'TIME': result['time'],
-                'SOOP_line': result['soop_line'],
-                'SOOP_line_description': result['soop_line_description'],
-                'Cruise_ID': result['cruise_id'],
-                'Institution_unique_identifier': result['station_number']
-            })
-
-    df = pd.DataFrame.from_records(records)
-
-    # Convert TIME to datetime once - major performance improvement
-    df['TIME'] = pd.to_datetime(df['TIME'])
-
-    # Use categorical dtype for repeated strings - reduces memory and speeds up operations
-    df['SOOP_line'] = df['SOOP_line'].astype('category')
-    df['SOOP_line_description'] = df['SOOP_line_description'].astype('category')
-    df['Cruise_ID'] = df['Cruise_ID'].astype('category')
-
-    # sort df by TIME and DEPTH and reset index
-    df = df.sort_values(by=['TIME', 'DEPTH']).reset_index(drop=True)
-
-    # add a 'transect_id' column to df initialized to empty strings
-    df['transect_id'] = ''
-
-    # Initialize set once and update incrementally
-    existing_transect_ids = set()
-
-    # do an initial separation of transects based on Cruise_ID
-    unique_cruise_ids = df['Cruise_ID'].unique()
-    for cruise_id in unique_cruise_ids:
-        cruise_mask = df['Cruise_ID'] == cruise_id
-        cruise_df = df.loc[cruise_mask]
-        soop_line = cruise_df['SOOP_line'].iloc[0]
-        # No need to convert TIME again, already datetime
-        unique_dates = np.sort(cruise_df['TIME'].unique())
-        if unique_dates.size == 0:
-            continue
-        # ensure that the total cruise does not cover more than 20 days
-        if max(unique_dates) - min(unique_dates) > pd.Timedelta(days=20):
-            # separate where the date changes by more than 5 days
-            date_diffs = np.diff(unique_dates)
-            gap_indices = np.where(date_diffs > pd.Timedelta(days=10))[0]
-            sub_dates = []
-            sub_dates_end = []
-            if len(gap_indices) > 0:
-                for i in range(len(gap_indices)):
-                    if i == 0:
-                        sub_dates = unique_dates[:gap_indices[i] + 1]
-                    else:
-                        sub_dates = unique_dates[gap_indices[i - 1] + 1:gap_indices[i] + 1]
-                    # if this is the last gap, include all remaining dates
-                    if i == len(gap_indices) - 1:
-                        sub_dates_end = unique_dates[gap_indices[i] + 1:]
-                    else:
-                        # leave sub_dates_end as an empty list until possibly overwritten
-                        pass
-                    # Use and update existing_transect_ids set
-                    transect_id = make_transect_id(soop_line, sub_dates[0], existing_transect_ids)
-                    existing_transect_ids.add(transect_id)
-                    # No need to convert TIME, use direct comparison
-                    sub_cruise_mask = cruise_mask & df['TIME'].isin(sub_dates)
-                    df.loc[sub_cruise_mask, 'transect_id'] = transect_id
-                # handle the last segment after the last gap
-                if len(sub_dates_end) > 0:
-                    # Use and update existing_transect_ids set
-                    transect_id = make_transect_id(soop_line, sub_dates_end[0], existing_transect_ids)
-                    existing_transect_ids.add(transect_id)
-                    # No need to convert TIME
-                    sub_cruise_mask = cruise_mask & df['TIME'].isin(sub_dates_end)
-                    df.loc[sub_cruise_mask, 'transect_id'] = transect_id
-                continue
-        if len(unique_dates) == 0:
-            continue
-        # Use and update existing_transect_ids set
-        transect_id = make_transect_id(soop_line, unique_dates[0], existing_transect_ids)
-        existing_transect_ids.add(transect_id)
-        df.loc[cruise_mask, 'transect_id'] = transect_id
-
-    # re-calculate unique transects
-    unique_transects = df['transect_id'].unique()
-
-    # Cache transect dataframes to avoid repeated filtering
-    print("Caching transect dataframes...")
-    transect_dfs = {transect: df[df['transect_id'] == transect].copy()
-                    for transect in unique_transects}
-
-    # review each transect, checking for change in direction of lat or lon
-    for transect in unique_transects:
-        # Use cached dataframe
-        transect_df = transect_dfs[transect]
-        transect_mask = df['transect_id'] == transect
-
-        # get unique latitudes and longitudes in order of time
-        unique_lats = transect_df[['TIME', 'LATITUDE']].drop_duplicates()
-        unique_lons = transect_df[['TIME', 'LONGITUDE']].drop_duplicates()
-
-        # work on only lat or lon, whichever has the larger range
-        lat_diff = np.diff(unique_lats['LATITUDE'].values)
-        lon_diff = np.diff(unique_lons['LONGITUDE'].values)
-        # Use numpy ptp (peak-to-peak) for cleaner range calculation
-        lat_range = np.ptp(unique_lats['LATITUDE'].values)
-        lon_range = np.ptp(unique_lons['LONGITUDE'].values)
-
-        if lat_range >= lon_range:
-            # compute sign, treat zeros as NaN, forward/back-fill to propagate nearest non-zero sign
-            s = np.sign(lat_diff).astype(float)
-        else:
-            s = np.sign(lon_diff).astype(float)
-
-        # set zeros to NaN
-        s[s == 0] = np.nan
-        s = pd.Series(s).ffill().bfill().values
-
-        # where there are single positive or negative values surrounded by opposite sign, set to NaN
-        s = pd.Series(s)
-        # mask single-element spikes: neighbors equal and center is different (and none are NaN)
-        spike_mask = (
-                s.notna()
-                & s.shift(1).notna()
-                & s.shift(-1).notna()
-                & (s.shift(1) == s.shift(-1))
-                & (s != s.shift(1))
-        )
-        s[spike_mask] = np.nan
-        s = pd.Series(s).ffill().bfill().values
-
-        # change values at ends of s if they are different from their only neighbor
-        if len(s) > 1:
-            if s[0] != s[1]:
-                s[0] = s[1]
-            if s[-1] != s[-2]:
-                s[-1] = s[-2]
-
-        # indices where sign changes between consecutive (non-zero) differences
-        direction_changes = np.where(np.diff(s) != 0)[0]
-        if len(direction_changes) > 0:
-            # if there are direction changes, split the transect at each change
-            for direction in direction_changes:
-                # if the percentage of direction changes to total points is > 0.5, then ignore direction changes
-                if (len(s) - direction) / len(s) > 0.75:
-                    print('Ignoring direction changes for transect: %s due to high frequency of changes' % transect)
-                    break
-                change_index = direction + 1  # +1 to get the index after the change
-                change_time = unique_lats['TIME'].values[change_index]
-                # Use the SOOP_line from the transect_df to ensure variable is available in this scope
-                soop_line_local = transect_df['SOOP_line'].iloc[0] if 'SOOP_line' in transect_df.columns else transect.split('-')[0]
-                # Use and update existing_transect_ids set
-                new_transect_id = make_transect_id(soop_line_local, change_time, existing_transect_ids)
-                existing_transect_ids.add(new_transect_id)
-                df.loc[transect_mask & (df['TIME'] >= change_time), 'transect_id'] = new_transect_id
-
-    # Update transect_dfs cache after splitting
-    unique_transects = df['transect_id'].unique()
-    transect_dfs = {transect: df[df['transect_id'] == transect].copy()
-                    for transect in unique_transects}
-
-    # Build transect_info using groupby for better performance
-    print("Building transect info...")
-    transect_summary = df.groupby('transect_id').agg({
-        'TIME': ['min', 'max'],
-        'LATITUDE': ['min', 'max', 'first', 'last'],
-        'LONGITUDE': ['min', 'max', 'first', 'last']
-    })
-
-    transect_info = {}
-    for transect in unique_transects:
-        summary = transect_summary.loc[transect]
-        time_min = summary[('TIME', 'min')]
-        time_max = summary[('TIME', 'max')]
-        lat_range = summary[('LATITUDE', 'max')] - summary[('LATITUDE', 'min')]
-        lon_range = summary[('LONGITUDE', 'max')] - summary[('LONGITUDE', 'min')]
-
-        # assign direction based on overall change in lat or lon
-        if lat_range >= lon_range:
-            if summary[('LATITUDE', 'last')] - summary[('LATITUDE', 'first')] > 0:
-                direction = 'N'
+def scan_single_file(filepath, log=None):
+    """
+    Read only the position, time, line, cruise and station of a netCDF file, as read_single_file does, without
+    decoding the file or reading its TEMP and QC. Returns the metadata entries of read_single_file
+    :param log: dict that gets the 'status' and 'error' of a file that can't be scanned, see read_single_file
+    """
+    try:
+        # remote files are downloaded outside the lock, as in read_single_file
+        data = download(filepath) if is_url(filepath) else None
+        with hdf5_lock(), nc_dataset(filepath, memory=data) as nc:
+            global_atts = nc.__dict__
+            lat = float(np.ma.filled(np.ma.asarray(nc['LATITUDE'][:], dtype=float), np.nan).squeeze())
+            lon = float(np.ma.filled(np.ma.asarray(nc['LONGITUDE'][:], dtype=float), np.nan).squeeze())
+            # TIME is decoded per batch of files, see scan_times
+            time_var = nc['TIME']
+            time = float(np.ma.getdata(time_var[:]).squeeze())
+            time_units = (time_var.units, getattr(time_var, 'calendar', None))
+
+            if 'XBT_uniqueid' in global_atts:
+                station_number = global_atts.get('XBT_uniqueid', 'Unknown')
             else:
-                direction = 'S'
-        else:
-            if summary[('LONGITUDE', 'last')] - summary[('LONGITUDE', 'first')] > 0:
-                direction = 'E'
+                station_number = _text(nc['Institution_unique_identifier'][:])
+
+            if 'XBT_line' in global_atts:
+                soop_line = global_atts.get('XBT_line', 'Unknown')
+                soop_line_description = global_atts.get('XBT_line_description', 'No description available')
             else:
-                direction = 'W'
+                soop_line = nc['SOOP_line'].__dict__.get('SOOP_line_label', 'Unknown')
+                soop_line_description = nc['SOOP_line'].__dict__.get('SOOP_line_description',
+                                                                     'No description available')
 
-        # assign information to transect_info dictionary
-        transect_info[transect] = {
-            'start_time': time_min,
-            'end_time': time_max,
-            'duration_days': time_max - time_min,
-            'direction': direction
-        }
+            if 'XBT_cruise_ID' in global_atts:
+                cruise_id = global_atts.get('XBT_cruise_ID', 'Unknown')
+            else:
+                cruise_id = nc['Ship'].__dict__.get('Cruise_ID', 'Unknown')
+
+            return {
+                'lat': lat,
+                'lon': lon,
+                'time': time,
+                'time_units': time_units,
+                'soop_line': soop_line,
+                'soop_line_description': soop_line_description,
+                'cruise_id': cruise_id,
+                'station_number': station_number
+            }
+    except Exception as e:
+        print(f'Error scanning file {filepath}: {type(e).__name__}: {e}')
+        if log is not None:
+            log.update(status='error', error=f'{type(e).__name__}: {e}')
+        return None
 
-    # now combine transects with same direction and combined duration < 15 days
-    print("Combining transects...")
-    processed_transects = set()
-    for transect_a in unique_transects:
-        if transect_a in processed_transects:
-            continue
-        info_a = transect_info[transect_a]
-        combined_transect = [transect_a]
-        for transect_b in unique_transects:
-            if transect_b == transect_a or transect_b in processed_transects:
-                continue
-            info_b = transect_info[transect_b]
-            if info_a['direction'] == info_b['direction']:
-                combined_duration = (max(info_a['end_time'], info_b['end_time']) - min(info_a['start_time'],
-                                                                                       info_b['start_time'])).days
-
-                # Use cached dataframes
-                transect_a_df = transect_dfs[transect_a].sort_values(by='TIME')
-                transect_b_df = transect_dfs[transect_b].sort_values(by='TIME')
-
-                combined_lats = pd.concat(
-                    [transect_a_df[['TIME', 'LATITUDE']], transect_b_df[['TIME', 'LATITUDE']]]).sort_values(by='TIME')
-                combined_lons = pd.concat(
-                    [transect_a_df[['TIME', 'LONGITUDE']], transect_b_df[['TIME', 'LONGITUDE']]]).sort_values(by='TIME')
-                lat_monotonic = combined_lats['LATITUDE'].is_monotonic_increasing or combined_lats[
-                    'LATITUDE'].is_monotonic_decreasing
-                lon_monotonic = combined_lons['LONGITUDE'].is_monotonic_increasing or combined_lons[
-                    'LONGITUDE'].is_monotonic_decreasing
-
-                if not lat_monotonic and not lon_monotonic:
-                    continue
-                if combined_duration < 15:
-                    combined_transect.append(transect_b)
-                    processed_transects.add(transect_b)
-                    # update info_a to reflect the combined transect
-                    info_a['start_time'] = min(info_a['start_time'], info_b['start_time'])
-                    info_a['end_time'] = max(info_a['end_time'], info_b['end_time'])
-                    info_a['duration_days'] = combined_duration
-
-        if len(combined_transect) > 1:
-            new_transect_id = combined_transect[0]
-            for t in combined_transect:
-                df.loc[df['transect_id'] == t, 'transect_id'] = new_transect_id
-            processed_transects.add(transect_a)
-
-    unique_transects = df['transect_id'].unique()
 
-    # for each unique transect, write out the data to a netcdf file
-    print(f"Writing {len(unique_transects)} transects to netCDF files...")
-    for transect in unique_transects:
-        transect_mask = df['transect_id'] == transect
+def scan_times(raw_results):
+    """
+    TIME of the results of scan_single_file as datetime64[ns], decoded as xarray decodes it (so times match those
+    of read_single_file) in one call per units and calendar
+    """
+    times = np.empty(len(raw_results), dtype='datetime64[ns]')
+    units = [r['time_units'] for r in raw_results]
+    for key in set(units):
+        same = [i for i, u in enumerate(units) if u == key]
+        times[same] = decode_cf_datetime(np.array([raw_results[i]['time'] for i in same]), *key)
+    return times
+
+
+def process_single_file(filepath, v_grid, half_width=11, smoothing='samples', products=None):
+    """
+    Process a single netCDF file and return extracted data
+    :param smoothing: 'samples' or 'depth', see interp_gaussian.SMOOTHING_METHODS
+    :param products: vertical products (see vertical_products), e.g. bin averages at several widths, to return side
+        by side instead of the Gaussian smoothed profile on v_grid
+    """
+    result = read_single_file(filepath)
+    if result is None:
+        return None
+    try:
+        if products is not None:
+            result['temps'] = grid_products([result['depths']], [result['temps']], products, half_width=half_width,
+                                            smoothing=smoothing)[0]
+            result['depths'] = product_depths(products)
+            return result
+        # return interpolated gaussian smoothed data on with 10m intervals from 0 to 1800m
+        vinterp = vinterp_gauss_depth if smoothing == 'depth' else vinterp_gauss_simple
+        result['temps'] = vinterp(result['depths'], result['temps'], v_grid, half_width=half_width)
+        result['depths'] = v_grid.copy()
+        return result
+    except Exception as e:
+        print(f'Error processing file {filepath}: {e}')
+        return None
+
 
-        # create a matrix of DEPTH vs TEMP for that transect where rows are DEPTH and columns are station numbers
-        # Avoid redundant sorting and filtering
-        transect_df = df.loc[transect_mask].sort_values(by=['TIME', 'DEPTH'])
-        pivot_df = transect_df.pivot_table(index='DEPTH', columns='TIME', values='TEMP')
-        # keep entire grid of DEPTH from 0 to 1800m in 10m intervals
-        pivot_df = pivot_df.reindex(v_grid)
+def read_file(filepath, mirror_dir=None, mirror_max_age=None, metadata_only=False, log=None):
+    """
+    read_single_file, or scan_single_file with metadata_only, going through the local mirror in mirror_dir for urls
+    if it is given. A scan then stores the file it downloads, so reading TEMP afterwards is local
+    :param log: dict that gets the status and error of a file that gives no result, see read_single_file
+    """
+    if mirror_dir is not None and is_url(filepath):
+        try:
+            filepath = str(mirror_file(filepath, mirror_dir, max_age=mirror_max_age))
+        except Exception as e:
+            print(f'Error mirroring file {filepath}: {type(e).__name__}: {e}')
+            if log is not None:
+                log.update(status='error', error=f'mirroring: {type(e).__name__}: {e}')
+            return None
+    return scan_single_file(filepath, log) if metadata_only else read_single_file(filepath, log)
+
+
+def process_file_batch(filepaths, v_grid, half_width=11, mirror_dir=None, mirror_max_age=None, metadata_only=False,
+                       smoothing='samples', products=None):
+    """
+    Read a batch of netCDF files and interpolate their profiles onto v_grid in one pass.
+    Returns compact arrays rather than one dict per file, so results are cheap to send between processes:
+    TEMP is (n_profiles x len(v_grid)) and the other entries hold one value per profile.
+    :param mirror_dir: folder of the local mirror of remote files, see opendap_mirror.mirror_file
+    :param mirror_max_age: seconds a mirrored file is used without checking the server, None to always use it
+    :param metadata_only: only scan the position, time, line, cruise and station of each file (scan_single_file),
+        the result then has no TEMP
+    :param smoothing: vertical smoothing method, see interp_gaussian.SMOOTHING_METHODS
+    :param products: vertical products (see vertical_products) whose levels TEMP holds side by side, v_grid is then
+        their product_depths. None for the Gaussian smoothed profiles on v_grid
+    :return: dict of the arrays, plus 'files', a record (path, seconds, lock_wait_seconds, locked_seconds, status,
+        error) of the read of each file, and 'interpolate_seconds'. seconds is the read time without the waits for
+        utils.HDF5_LOCK, locked_seconds the part of it spent holding the lock
+    """
+    raw_results = []
+    files = []
+    for f in filepaths:
+        log = {'status': 'ok', 'error': None}
+        # waits for the HDF5 lock are taken out of the read time, they depend on the other workers
+        t0 = time.perf_counter()
+        before = dict(lock_times())
+        r = read_file(f, mirror_dir, mirror_max_age, metadata_only, log)
+        lock_wait = lock_times()['wait'] - before['wait']
+        files.append((f, time.perf_counter() - t0 - lock_wait, lock_wait, lock_times()['held'] - before['held'],
+                      log['status'], log['error']))
+        if r is not None:
+            raw_results.append((f, r))
+    paths = [f for f, _ in raw_results]
+    raw_results = [r for _, r in raw_results]
+    result = {}
+    t0 = time.perf_counter()
+    if not metadata_only and len(raw_results) > 0 and products is not None:
+        result['TEMP'] = grid_products([r['depths'] for r in raw_results], [r['temps'] for r in raw_results],
+                                       products, half_width=half_width, smoothing=smoothing).astype(np.float32)
+    elif not metadata_only and len(raw_results) > 0:
+        result['TEMP'] = vinterp_batch([r['depths'] for r in raw_results], [r['temps'] for r in raw_results],
+                                       v_grid, half_width=half_width, smoothing=smoothing).astype(np.float32)
+    elif not metadata_only:
+        result['TEMP'] = np.empty((0, len(v_grid)), dtype=np.float32)
+    return {
+        'files': files,
+        'interpolate_seconds': time.perf_counter() - t0,
+        **result,
+        'LATITUDE': np.array([r['lat'] for r in raw_results], dtype=float),
+        'LONGITUDE': np.array([r['lon'] for r in raw_results], dtype=float),
+        'TIME': scan_times(raw_results) if metadata_only else np.array([r['time'] for r in raw_results],
+                                                                       dtype='datetime64[ns]'),
+        'SOOP_line': np.array([r['soop_line'] for r in raw_results], dtype=str),
+        'SOOP_line_description': np.array([r['soop_line_description'] for r in raw_results], dtype=str),
+        'Cruise_ID': np.array([r['cruise_id'] for r in raw_results], dtype=str),
+        'Institution_unique_identifier': np.array([r['station_number'] for r in raw_results], dtype=str),
+        'path': np.array(paths, dtype=str)
+    }
+
+
+def file_executor(backend='thread', max_workers=None, mp_context=None):
+    """
+    Executor for reading and interpolating batches of files, see load_profiles.
+    :param mp_context: multiprocessing context of the process backend, e.g. forkserver to start worker processes
+        safely while other threads of this process run
+    """
+    if backend == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers or 4)
+    elif backend == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=mp_context)
+    raise ValueError("backend must be 'thread' or 'process', got %r" % backend)
+
+
+def load_profiles(filepaths, v_grid, backend='thread', max_workers=None, files_per_task=64, mirror_dir=None,
+                  mirror_max_age=None, mirror_max_bytes=2e9, half_width=11, metadata_only=False, report=None,
+                  executor=None, smoothing='samples', products=None):
+    """
+    Read and interpolate all files, returning the concatenated arrays of process_file_batch
+    in the order of filepaths.
+    :param filepaths: list of files or urls, or any iterable of them such as the generator of
+        thredds_crawler.iter_thredds_files, in which case batches are submitted as soon as they fill up
+    :param backend: 'thread' for a ThreadPoolExecutor, whose workers download remote files in parallel but decode
+        netCDF one at a time (utils.HDF5_LOCK), or 'process' for a ProcessPoolExecutor, which also gets past the GIL
+        and the lock
+    :param max_workers: number of workers, defaults to 4 threads or one process per CPU
+    :param files_per_task: number of files each worker reads and interpolates per task
+    :param mirror_dir: folder of a local mirror that remote files are read through, None to read them directly
+    :param mirror_max_age: seconds a mirrored file is used without checking the server, None to always use it
+    :param mirror_max_bytes: size the mirror is cut back to, least recently used files first, after loading
+    :param half_width: half width in m of the vertical Gaussian smoothing
+    :param smoothing: 'samples' to smooth over the samples at the median spacing of each profile, 'depth' to smooth
+        in depth units, see interp_gaussian.SMOOTHING_METHODS
+    :param products: vertical products to grid the profiles onto side by side, v_grid being their product_depths,
+        see vertical_products. None for the Gaussian smoothed profiles on v_grid
+    :param metadata_only: only scan the metadata of the files, see process_file_batch
+    :param report: run report (see run_report.new_report) to add the read time and outcome of each file and the
+        interpolation time to
+    :param executor: executor of file_executor to run the batches on, kept open for the next call; None to start
+        one of backend and max_workers for this call
+    """
+    batch_options = {'half_width': half_width, 'mirror_dir': mirror_dir, 'mirror_max_age': mirror_max_age,
+                     'metadata_only': metadata_only, 'smoothing': smoothing, 'products': products}
+    futures = []
+    with file_executor(backend, max_workers) if executor is None else nullcontext(executor) as executor:
+        batch = []
+        for filepath in filepaths:
+            batch.append(filepath)
+            if len(batch) == files_per_task:
+                futures.append(executor.submit(process_file_batch, batch, v_grid, **batch_options))
+                batch = []
+        if len(batch) > 0:
+            futures.append(executor.submit(process_file_batch, batch, v_grid, **batch_options))
+        results = [future.result() for future in futures]
+    if mirror_dir is not None:
+        evict(mirror_dir, mirror_max_bytes)
+
+    if len(results) == 0:
+        results = [process_file_batch([], v_grid, metadata_only=metadata_only)]
+    files = [record for r in results for record in r.pop('files')]
+    interpolate_seconds = sum(r.pop('interpolate_seconds') for r in results)
+    if report is not None:
+        add_file_records(report, 'scan' if metadata_only else 'read', files, interpolate_seconds)
+    return {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+
+
+def list_input_files(input_directories, crawl_concurrency=8):
+    """All input files: the .nc files of a local folder in name order, or the urls of a crawl of THREDDS catalogs"""
+    if is_url(input_directories[0]):
+        return crawl_thredds(input_directories, max_concurrency=crawl_concurrency)
+    # Loop through all netCDF files in the input directory where name does not contain 'TEST' and ends with .nc
+    filenames = [f for f in os.listdir(input_directories[0]) if f.endswith('.nc') and 'TEST' not in f]
+    # sort filenames alphabetically
+    filenames.sort()
+    return [os.path.join(input_directories[0], f) for f in filenames]
+
+
+def load_row_temps(meta, rows, v_grid, **load_options):
+    """
+    Read and interpolate the files of the given profile rows only.
+    :param meta: profile metadata table of the scan, with its 'path' column
+    :param rows: rows of meta whose TEMP is needed
+    :param load_options: passed to load_profiles
+    :return: (rows, temp) the sorted unique rows and their temperature matrix, row i of temp belonging to rows[i],
+        NaN in the rows of files that gave no valid data
+    """
+    rows = np.unique(np.asarray(rows, dtype=np.int64))
+    paths = meta['path'].to_numpy(dtype=str)[rows]
+    temp = np.full((len(rows), len(v_grid)), np.nan, dtype=np.float32)
+    loaded = load_profiles(list(paths), v_grid, **load_options)
+    temp[pd.Series(np.arange(len(rows)), index=paths).reindex(loaded['path']).values] = loaded['TEMP']
+    return rows, temp
+
+
+def load_temps(meta, rows, v_grid, **load_options):
+    """
+    Second pass of a scanned run: read and interpolate the files of the given profile rows only.
+    :param meta: profile metadata table of the scan, with its 'path' column
+    :param rows: rows of meta whose TEMP is needed, e.g. those of the transects to write
+    :param load_options: passed to load_profiles
+    :return: the temperature matrix of the profile store, NaN in the rows not loaded and in those of files
+        that gave no valid data
+    """
+    rows, loaded = load_row_temps(meta, rows, v_grid, **load_options)
+    temp = np.full((len(meta), len(v_grid)), np.nan, dtype=np.float32)
+    temp[rows] = loaded
+    return temp
+
+
+def streamed_payloads(meta, groups, v_grid, mask_depths=None, **load_options):
+    """
+    Second pass of a streamed run: the writer payloads of the transects, group after group (see
+    profile_store.stream_groups). The TEMP of a group is read and interpolated when its first transect is asked
+    for and dropped after its last one, so only one group is held at a time besides the transects queued for the
+    writers.
+    :param mask_depths: mask depth of each row of meta, NaN for none, see data_rules.apply_data_rules
+    :param load_options: passed to load_profiles
+    """
+    report = load_options.get('report')
+    # one executor for every group. Groups are loaded while the writers run, so worker processes are started by
+    # a fork server rather than forked from this process, whose locks other threads may hold
+    mp_context = multiprocessing.get_context('forkserver') if load_options.get('backend') == 'process' else None
+    with file_executor(load_options.get('backend', 'thread'), load_options.get('max_workers'),
+                       mp_context) as executor:
+        for i, group in enumerate(groups):
+            rows = np.concatenate(list(group.values()))
+            print(f"Loading the temperatures of group {i + 1} of {len(groups)}: {len(group)} transects, "
+                  f"{len(rows)} profiles...")
+            with stage(report, 'load_temps') if report is not None else nullcontext():
+                rows, temp = load_row_temps(meta, rows, v_grid, executor=executor, **load_options)
+            if mask_depths is not None:
+                mask_profiles(temp, v_grid, mask_depths[rows])
+            # the metadata of the group, its rows lining up with those of temp
+            group_meta = meta.iloc[rows].reset_index(drop=True)
+            for transect in group.values():
+                yield from transect_payloads(group_meta, temp, np.searchsorted(rows, transect), v_grid,
+                                             load_options.get('products'))
+            del temp, group_meta
+
+
+def clean_and_bin_transect(input_directories, output_directory, backend='thread', max_workers=None, files_per_task=64,
+                           cache_dir=None, prune_cache=False, crawl_concurrency=8, mirror_dir=None,
+                           mirror_max_age=None, mirror_max_bytes=2e9, writers=2, write_queue=None,
+                           write_backend='thread', write_metrics=None, write_options=None,
+                           lines_config='soopLines.csv', location_filter=True, rules_file='dataRules.csv',
+                           prescan=True, index_path=None, refresh_index=False, lines=None, time_range=None,
+                           bbox=None, drop_duplicates=True, duplicate_time_tolerance=TIME_TOLERANCE,
+                           duplicate_position_tolerance=POSITION_TOLERANCE, duplicates_report=None,
+                           report_file=None, profile_stage=None, profiler='cprofile', profile_output=None,
+                           stream=False, memory_budget=256e6, shard=None, shard_by='line', shard_timeout=None,
+                           smoothing='samples', vertical=('gauss',), bin_widths=None, archive_dir=None):
+    # stage times, file read times and outcomes and counts, summarized at the end of the run
+    report = new_report(profile_stage=profile_stage, profiler=profiler, profile_output=profile_output)
+
+    # the vertical grid, smoothing and segmentation rules come from the lines config, loaded once per process
+    registry = load_line_registry(lines_config)
+    v_grid = registry[DEFAULT_LINE]['v_grid']
+    half_width = registry[DEFAULT_LINE]['half_width']
+    # the Gaussian smoothed profiles on v_grid, or several vertical products read in the same pass: TEMP then
+    # holds the levels of all products side by side, v_grid standing for the depth of each column, and the files
+    # of each product go to a subfolder named after it when there are several
+    products = None
+    subfolders = ['']
+    if list(vertical) != ['gauss']:
+        products = vertical_products(v_grid, vertical, bin_widths or [registry[DEFAULT_LINE]['depth_step']])
+        v_grid = product_depths(products)
+        if len(products) > 1:
+            subfolders = [product['name'] for product in products]
 
-        # change df to contain the lats, longs, times and station numbers
-        # Remove redundant operations and use loc directly
-        metadata_df = transect_df.drop_duplicates(subset=['Institution_unique_identifier'])[
-            ['LATITUDE', 'LONGITUDE', 'TIME', 'SOOP_line', 'SOOP_line_description',
-             'Cruise_ID', 'Institution_unique_identifier', 'transect_id']
-        ].reset_index(drop=True)
+    # Check if input_directory is a URL (THREDDS) or local path
+    remote = is_url(input_directories[0])
+
+    load_options = {'backend': backend, 'max_workers': max_workers, 'files_per_task': files_per_task,
+                    'mirror_dir': mirror_dir, 'mirror_max_age': mirror_max_age, 'mirror_max_bytes': mirror_max_bytes,
+                    'half_width': half_width, 'smoothing': smoothing, 'products': products, 'report': report}
+    # without a profile cache, first scan only the metadata of the files to plan the transects, then read TEMP of
+    # the profiles that are written. The cache keeps every profile, so it reads files in one pass
+    scan = prescan and cache_dir is None
+    if stream and not scan:
+        raise ValueError('streaming loads TEMP after the metadata scan, it needs prescan and no cache_dir')
+    if shard is not None:
+        # shards share the metadata scan and each writes its part of the transects, see sharding
+        if not scan:
+            raise ValueError('shards exchange the metadata scan, they need prescan and no cache_dir')
+        if index_path is not None and (refresh_index or not has_source(index_path, source_key(input_directories))):
+            raise ValueError('shards only read a profile index, build or refresh it before running them')
+        if archive_dir is not None:
+            raise ValueError('shards write transect files only, build the line archives from the merged output with '
+                             'python line_archive.py build')
+        clear_shard_manifest(output_directory, shard[0])
+    if index_path is None and (lines is not None or time_range is not None or bbox is not None):
+        raise ValueError('selecting files by line, time or region needs a profile index (index_path)')
+    source = source_key(input_directories)
+    if index_path is not None and (refresh_index or not has_source(index_path, source)):
+        # add new and changed files to the index, scanning only those
+        with stage(report, 'index'):
+            update_index(index_path, source, list_input_files(input_directories, crawl_concurrency),
+                         **load_options)
+
+    if index_path is not None:
+        # the selected files and their metadata come from the index, without listing or opening the input
+        with stage(report, 'select'):
+            profiles = select_profiles(index_path, source, lines=lines, time_range=time_range, bbox=bbox,
+                                       registry=registry)
+        filepaths = list(profiles['path'])
+        with stage(report, 'ingest'):
+            if cache_dir is not None:
+                profiles, _ = load_profiles_cached(filepaths, v_grid, cache_dir, prune=prune_cache, **load_options)
+            elif not scan:
+                profiles = load_profiles(filepaths, v_grid, **load_options)
+    elif shard is not None:
+        # every shard lists the input the same way, scans every n-th file and takes the metadata of the others
+        with stage(report, 'list'):
+            filepaths = list_input_files(input_directories, crawl_concurrency)
+        count(report, 'files_listed', len(filepaths))
+        print(f"Shard {shard[0] + 1} of {shard[1]}: scanning {len(filepaths[shard[0]::shard[1]])} of "
+              f"{len(filepaths)} files...")
+        with stage(report, 'ingest'):
+            profiles = scan_shard(filepaths, output_directory, shard, timeout=shard_timeout, **load_options)
+    elif remote and cache_dir is None:
+        # crawl the THREDDS catalogs and read files as they are found, then put the profiles in file name order
+        print(f"Crawling {len(input_directories)} THREDDS catalogs and processing files as they are found...")
+        with stage(report, 'ingest'):
+            profiles = load_profiles(iter_thredds_files(input_directories, max_concurrency=crawl_concurrency),
+                                     v_grid, metadata_only=scan, **load_options)
+            order = np.argsort(profiles['path'], kind='stable')
+            profiles = {key: values[order] for key, values in profiles.items()}
+    else:
+        # the cache needs the full list of files up front
+        with stage(report, 'list'):
+            filepaths = list_input_files(input_directories, crawl_concurrency)
+        count(report, 'files_listed', len(filepaths))
+
+        # Parallel file reading and interpolation, in batches of files per task
+        print(f"Processing {len(filepaths)} files in parallel...")
+        with stage(report, 'ingest'):
+            if cache_dir is not None:
+                # only new or changed files are read and interpolated, the rest come from the profile cache
+                profiles, _ = load_profiles_cached(filepaths, v_grid, cache_dir, prune=prune_cache, **load_options)
+            else:
+                profiles = load_profiles(filepaths, v_grid, metadata_only=scan, **load_options)
+    n_profiles = len(profiles['TIME'])
+    count(report, 'profiles', n_profiles)
+
+    print(f"Successfully {'scanned' if scan else 'processed'} {n_profiles} files")
+
+    # Keep the profiles as a per-profile metadata table plus one temperature matrix, sorted by TIME.
+    # Everything below works on meta, one row per profile, and rows of temp are looked up by index only to write.
+    # A scan has no temperatures yet, they are loaded once the transects to write are known
+    meta, temp = build_profile_store(profiles)
+    del profiles
+
+    # keep one copy of each drop found more than once (same station, time and position), so the other copies are
+    # neither read for TEMP, segmented nor averaged into the transect
+    if drop_duplicates:
+        with stage(report, 'duplicates'):
+            duplicates = find_duplicates(meta, duplicate_time_tolerance, duplicate_position_tolerance)
+        count(report, 'duplicates_removed', len(duplicates))
+        for row in duplicates.itertuples():
+            print('Duplicate profile removed: %s (station %s), keeping %s'
+                  % (row.path, row.Institution_unique_identifier, row.kept))
+        print(f"{len(duplicates)} duplicate profiles removed")
+        if duplicates_report is not None:
+            duplicates.to_csv(duplicates_report, index=False)
+        if len(duplicates) > 0:
+            keep = np.ones(len(meta), dtype=bool)
+            keep[duplicates.index] = False
+            meta = meta[keep].reset_index(drop=True)
+            temp = None if temp is None else temp[keep]
+
+    # split the profiles into transects by cruise, time gaps and changes of direction
+    with stage(report, 'segment'):
+        meta['transect_id'] = segment_transects(meta, registry=registry)
+
+    # now combine transects with same direction and combined duration < merge_window_days (15 by default)
+    print("Combining transects...")
+    with stage(report, 'combine'):
+        meta['transect_id'] = combine_transects(meta, registry=registry)
+    count(report, 'transects', meta['transect_id'].nunique())
+
+    # drop and mask bad data and merge transects split incorrectly, as the rules config says, so nothing a rule
+    # removes is assembled or written. Dropped profiles are left without a transect
+    mask_depths = None
+    if rules_file is not None:
+        with stage(report, 'rules'):
+            meta['transect_id'], mask_depths = apply_data_rules(meta, load_data_rules(rules_file), registry)
+        count(report, 'profiles_removed_by_rules', meta['transect_id'].isna().sum())
+        count(report, 'profiles_masked_by_rules', np.isfinite(mask_depths).sum())
 
-        # now use write2netcdf function to write the transect to a netcdf file
-        write_vert_grid_nc(output_directory, metadata_df, pivot_df, globals_file_path='netcdfGlobalAtts.csv',
-                        vars_file_path='netcdfVars.csv')
+    # for each unique transect, write out the data to a netcdf file
+    rows_by_transect = transect_rows(meta)
+    if location_filter:
+        # drop transects mostly outside the polygon of their line, from the metadata alone
+        with stage(report, 'location_filter'):
+            rejected = rejected_transects(meta, registry)
+        rows_by_transect = {transect: rows for transect, rows in rows_by_transect.items()
+                            if transect not in rejected.index}
+        count(report, 'transects_rejected_location', len(rejected))
+    if shard is not None:
+        # every shard has the same plan, and writes the transects of its lines or years into its own folder
+        plan = plan_digest(meta, rows_by_transect, mask_depths)
+        n_planned = len(rows_by_transect)
+        rows_by_transect = shard_transects(meta, rows_by_transect, shard, shard_by)
+        print(f"Shard {shard[0] + 1} of {shard[1]}: {len(rows_by_transect)} of {n_planned} transects")
+        count(report, 'shard_transects', len(rows_by_transect))
+        write_directory = shard_folder(output_directory, shard[0])
+        os.makedirs(write_directory, exist_ok=True)
+    else:
+        write_directory = output_directory
+    if cache_dir is not None:
+        # skip transects whose member files are unchanged since they were last written and remove the files of
+        # transects that no longer exist
+        # masks and the run parameters are part of the digests, so transects are rewritten when their masks, the
+        # vertical grid, smoothing or products, or the writer options change
+        row_tags = None if mask_depths is None else \
+            np.where(np.isfinite(mask_depths), np.char.add('|mask ', mask_depths.astype(str)), '').astype(object)
+        params_key = run_key(v_grid=v_grid, half_width=half_width, smoothing=smoothing, products=products,
+                             write_options=write_options or {})
+        digests = transect_digests(meta, rows_by_transect, row_tags, params_key)
+        manifest_file = manifest_path(cache_dir, output_directory)
+        written = read_manifest(manifest_file)
+        for transect in set(written) - set(digests):
+            for subfolder in subfolders:
+                stale_file = os.path.join(output_directory, subfolder, transect + '.nc')
+                if os.path.exists(stale_file):
+                    os.remove(stale_file)
+        rows_by_transect = {transect: rows for transect, rows in rows_by_transect.items()
+                            if written.get(transect) != digests[transect]
+                            or not all(os.path.exists(os.path.join(output_directory, subfolder, transect + '.nc'))
+                                       for subfolder in subfolders)}
+        print(f"{len(digests) - len(rows_by_transect)} transects unchanged since the last run")
+        count(report, 'transects_unchanged', len(digests) - len(rows_by_transect))
+    if stream:
+        # second pass one group of cruises at a time: the metadata table is held for the whole run, the rest of
+        # the memory budget bounds the profiles whose TEMP is loaded at once
+        meta_bytes = meta.memory_usage(deep=True).sum()
+        row_bytes = STREAM_TEMP_COPIES * np.dtype(np.float32).itemsize * len(v_grid)
+        if meta_bytes >= memory_budget:
+            print(f"The profile metadata takes {meta_bytes / 1e6:.0f} MB, over the memory budget of "
+                  f"{memory_budget / 1e6:.0f} MB: loading one transect at a time")
+        groups = stream_groups(meta, rows_by_transect, max(1, int((memory_budget - meta_bytes) // row_bytes)))
+        count(report, 'stream_groups', len(groups))
+        print(f"Writing {len(rows_by_transect)} transects to netCDF files in {len(groups)} groups...")
+        payloads = streamed_payloads(meta, groups, v_grid, mask_depths, **load_options)
+    else:
+        if temp is None:
+            # second pass: read and interpolate only the files of the transects to write
+            rows = np.concatenate(list(rows_by_transect.values())) if rows_by_transect else \
+                np.array([], dtype=np.int64)
+            print(f"Loading the temperatures of {len(rows)} of {n_profiles} profiles...")
+            with stage(report, 'load_temps'):
+                temp = load_temps(meta, rows, v_grid, **load_options)
+        if mask_depths is not None:
+            mask_profiles(temp, v_grid, mask_depths)
+        print(f"Writing {len(rows_by_transect)} transects to netCDF files...")
+        # the lats, longs, times and station numbers, and a matrix of TEMP with one row per profile, assembled
+        # while the writers write the previous transects
+        payloads = (payload for rows in rows_by_transect.values()
+                    for payload in transect_payloads(meta, temp, rows, v_grid, products))
+    if archive_dir is not None:
+        # every transect is also appended to the archive of its line on its way to the writers
+        payloads = archive_transects(payloads, archive_dir, report=report)
+    with stage(report, 'write'):
+        metrics = write_transects(write_directory, payloads, workers=writers, queue_depth=write_queue,
+                                  backend=write_backend, globals_file_path='netcdfGlobalAtts.csv',
+                                  vars_file_path='netcdfVars.csv', write_options=write_options)
+    report['transects'] = metrics
+    print_write_metrics(metrics)
+    if write_metrics is not None:
+        metrics.to_csv(write_metrics, index=False)
+
+    if cache_dir is not None:
+        write_manifest(manifest_file, digests)
+    if shard is not None:
+        write_shard_manifest(output_directory, shard, shard_by, plan, n_planned, rows_by_transect, subfolders)
+
+    summary = summarize(report)
+    print_summary(summary)
+    if report_file is not None:
+        write_report(summary, report_file)
+    return summary
 
 
 # create main function to call clean_and_bin_transect with input and output arguments
 if __name__ == "__main__":
 
-    if len(sys.argv) == 3:
-        # input directory and output directory from command line arguments
-        input_directory = sys.argv[1]
-        output_folder = sys.argv[2]
-        # Check if input_directory is a URL (THREDDS) or local path
-        is_url = input_directory.startswith('http://') or input_directory.startswith('https://')
-        if not is_url:
-            clean_and_bin_transect(input_directory, output_folder)
-        else:
-            # go to the thredds server https://thredds.aodn.org.au/thredds/catalog/IMOS/SOOP/SOOP-XBT/DELAYED/catalog.html
-            # go through each folder in the catalog and subfolders to create a list of input files with the full path
-            # appended and then cycle through the full list of files to call clean_and_bin_transect
-            base_url = input_directory
-
-            response = requests.get(base_url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            links = soup.find_all('a')
-            input_directories = []
-            for link in links:
-                href = link.get('href')
-                if href and href.endswith('catalog.html'):
-                    # use base_url and remove 'catalog.html' to get the directory url
-                    sub_url = base_url.rsplit('/', 1)[0] + '/' + href
-                    sub_response = requests.get(sub_url)
-                    sub_soup = BeautifulSoup(sub_response.text, 'html.parser')
-                    sub_links = sub_soup.find_all('a')
-                    for sub_link in sub_links:
-                        sub_href = sub_link.get('href')
-                        if sub_href and sub_href.endswith('catalog.html'):
-                            # get the next level of the catalog
-                            sub_sub_url = sub_url.rsplit('/', 1)[0] + '/' + sub_href
-                            input_directories.append(sub_sub_url)
-                        elif sub_href and sub_href.endswith('.nc'):
-                            # if there are netcdf files directly in this folder, add this folder as input directory
-                            input_directories.append(sub_url)
-                            break  # no need to check further links in this folder
-            # remove duplicates from input_directories
-            input_directories = list(set(input_directories))
-            # call clean_and_bin_transect for the full list of input directories
-            clean_and_bin_transect(input_directories, output_folder)
-    else:
-        print("Usage: python clean_and_bin_transect.py <input_directory or input_url> <output_directory>")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Grid XBT profiles vertically and write one netCDF file per transect')
+    parser.add_argument('input_directory', help='local folder of .nc files or a THREDDS catalog url')
+    parser.add_argument('output_folder', help='folder to write the transect netCDF files to')
+    parser.add_argument('--backend', choices=['thread', 'process'], default='thread',
+                        help='parallel backend for reading and interpolating files: threads download remote files '
+                             'in parallel but decode netCDF one at a time, processes also decode in parallel '
+                             '(default: thread)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of workers (default: 4 threads or one process per CPU)')
+    parser.add_argument('--files-per-task', type=int, default=64,
+                        help='number of files handed to a worker at a time (default: 64)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='folder for the profile cache; reruns then only process new or changed files '
+                             'and only rewrite the transects they belong to')
+    parser.add_argument('--prune-cache', action='store_true',
+                        help='drop cache entries for files that are no longer in the input')
+    parser.add_argument('--crawl-concurrency', type=int, default=8,
+                        help='number of THREDDS catalogs fetched at a time (default: 8)')
+    parser.add_argument('--mirror-dir', default=None,
+                        help='folder of a local mirror of remote files, so reruns read them locally')
+    parser.add_argument('--mirror-max-age', type=float, default=None,
+                        help='seconds a mirrored file is used before checking the server for changes '
+                             '(default: never check)')
+    parser.add_argument('--mirror-max-gb', type=float, default=2,
+                        help='size cap of the mirror in GB, least recently used files are evicted (default: 2)')
+    parser.add_argument('--writers', type=int, default=2,
+                        help='number of netCDF writers (default: 2)')
+    parser.add_argument('--write-queue', type=int, default=None,
+                        help='maximum number of transects assembled ahead of the writers (default: twice --writers)')
+    parser.add_argument('--write-backend', choices=['thread', 'process'], default='thread',
+                        help='writer threads overlap writing with assembling the next transects, writer processes '
+                             'also create files in parallel (default: thread)')
+    parser.add_argument('--write-metrics', default=None,
+                        help='csv file to save the per-transect write metrics to')
+    parser.add_argument('--complevel', type=int, default=0,
+                        help='zlib compression level of the output files, 0 for no compression (default: 0)')
+    parser.add_argument('--no-shuffle', action='store_true',
+                        help='do not apply the shuffle filter before compressing')
+    parser.add_argument('--fixed-time', action='store_true',
+                        help='write TIME as a fixed size dimension instead of an unlimited one')
+    parser.add_argument('--chunks', default=None,
+                        help="chunk shape of TEMP as TIME,DEPTH, e.g. 64,181, or 'section' for one chunk per transect "
+                             "(default: library chunking)")
+    parser.add_argument('--lines-config', default='soopLines.csv',
+                        help='csv file of the per-line settings: vertical grid, segmentation rules, horizontal grids '
+                             '(default: soopLines.csv)')
+    parser.add_argument('--no-location-filter', action='store_true',
+                        help='keep transects that are mostly outside the polygon of their line')
+    parser.add_argument('--rules', default='dataRules.csv',
+                        help='csv file of the bad data and merge rules (default: dataRules.csv)')
+    parser.add_argument('--no-rules', action='store_true',
+                        help='do not apply the bad data and merge rules')
+    parser.add_argument('--index', default=None,
+                        help='SQLite profile index of the input files, built on first use; the files and their '
+                             'metadata are then taken from the index without listing or crawling the input')
+    parser.add_argument('--refresh-index', action='store_true',
+                        help='list or crawl the input and add new or changed files to the index before selecting')
+    parser.add_argument('--lines', nargs='+', default=None,
+                        help='only grid files of these lines, e.g. PX30 IX28 (needs --index)')
+    parser.add_argument('--start', default=None, help='only grid profiles from this time on, e.g. 2010-01-01 '
+                                                      '(needs --index)')
+    parser.add_argument('--end', default=None, help='only grid profiles before this time, e.g. 2011-01-01 '
+                                                    '(needs --index)')
+    parser.add_argument('--bbox', type=float, nargs=4, default=None,
+                        metavar=('LON_MIN', 'LAT_MIN', 'LON_MAX', 'LAT_MAX'),
+                        help='only grid profiles in this region (needs --index)')
+    parser.add_argument('--keep-duplicates', action='store_true',
+                        help='keep every copy of profiles found more than once instead of the newest file only')
+    parser.add_argument('--duplicate-time-tolerance', type=float, default=TIME_TOLERANCE,
+                        help='seconds the times of two copies of a profile may differ by (default: 600)')
+    parser.add_argument('--duplicate-position-tolerance', type=float, default=POSITION_TOLERANCE,
+                        help='degrees the latitudes and longitudes of two copies of a profile may differ by '
+                             '(default: 0.05)')
+    parser.add_argument('--duplicates-report', default=None,
+                        help='csv file to list the duplicate profiles removed and the copy kept of each')
+    parser.add_argument('--report', default=None,
+                        help='JSON file to write the run report to: stage times and peak memory, file read times, '
+                             'counts, errors and the slowest files and transects')
+    parser.add_argument('--profile-stage', default=None,
+                        choices=['index', 'select', 'list', 'ingest', 'duplicates', 'segment', 'combine', 'rules',
+                                 'location_filter', 'load_temps', 'write'],
+                        help='run this stage under the profiler')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile',
+                        help='cprofile (also profiles the worker threads) or pyinstrument, a sampling profiler '
+                             '(needs the pyinstrument package) (default: cprofile)')
+    parser.add_argument('--profile-output', default=None,
+                        help='file to save the profile to (default: <stage>.prof or <stage>.html)')
+    parser.add_argument('--no-prescan', action='store_true',
+                        help='read and interpolate every file in one pass instead of scanning the metadata first '
+                             'and reading TEMP only for the transects that are written')
+    parser.add_argument('--stream', action='store_true',
+                        help='read TEMP and write the transects one group of cruises at a time, within '
+                             '--memory-budget-mb, instead of loading the TEMP of every transect before writing')
+    parser.add_argument('--memory-budget-mb', type=float, default=256,
+                        help='memory for the profile metadata and the TEMP of a group of cruises in a streamed run '
+                             '(default: 256)')
+    parser.add_argument('--smoothing', choices=list(SMOOTHING_METHODS), default='samples',
+                        help='vertical smoothing: samples, a Gaussian over the samples at the median depth spacing of '
+                             'each profile, or depth, a Gaussian in metres that follows the spacing and does not '
+                             'bridge QC gaps (default: samples)')
+    parser.add_argument('--vertical', nargs='+', choices=VERTICAL_METHODS, default=['gauss'],
+                        help='vertical products: gauss, the Gaussian smoothed profiles on the vertical grid of the '
+                             'lines config, and/or bin, bin averages of --bin-widths. With several products each is '
+                             'written to a subfolder of output_folder named after it, e.g. gauss or bin_5m '
+                             '(default: gauss)')
+    parser.add_argument('--bin-widths', type=float, nargs='+', default=None,
+                        help='widths in m of the bins of --vertical bin, one product each, e.g. 2 5 10 '
+                             '(default: depth_step of the lines config)')
+    parser.add_argument('--archive-dir', default=None,
+                        help='folder of per-line archives: every transect written is also appended to one chunked, '
+                             'compressed netCDF4 file per SOOP line there, see line_archive.py')
+    parser.add_argument('--shard', default=None,
+                        help='run shard I of N, e.g. 2/4: output_folder is then a folder shared by the shards, '
+                             'merged with python sharding.py merge (see sharding.py)')
+    parser.add_argument('--shard-by', choices=SHARD_BY, default='line',
+                        help='split the transects to write between shards by SOOP line or by year (default: line)')
+    parser.add_argument('--shard-timeout', type=float, default=None,
+                        help='seconds to wait for the metadata scan of the other shards (default: no limit)')
+    args = parser.parse_args()
+    run_options = {'backend': args.backend, 'max_workers': args.workers, 'files_per_task': args.files_per_task,
+                   'cache_dir': args.cache_dir, 'prune_cache': args.prune_cache,
+                   'crawl_concurrency': args.crawl_concurrency, 'mirror_dir': args.mirror_dir,
+                   'mirror_max_age': args.mirror_max_age, 'mirror_max_bytes': args.mirror_max_gb * 1e9,
+                   'writers': args.writers, 'write_queue': args.write_queue, 'write_backend': args.write_backend,
+                   'write_metrics': args.write_metrics, 'lines_config': args.lines_config,
+                   'location_filter': not args.no_location_filter,
+                   'rules_file': None if args.no_rules else args.rules, 'prescan': not args.no_prescan,
+                   'index_path': args.index, 'refresh_index': args.refresh_index, 'lines': args.lines,
+                   'time_range': None if args.start is None and args.end is None else (args.start, args.end),
+                   'bbox': args.bbox, 'drop_duplicates': not args.keep_duplicates,
+                   'duplicate_time_tolerance': args.duplicate_time_tolerance,
+                   'duplicate_position_tolerance': args.duplicate_position_tolerance,
+                   'duplicates_report': args.duplicates_report, 'report_file': args.report,
+                   'profile_stage': args.profile_stage, 'profiler': args.profiler,
+                   'profile_output': args.profile_output, 'stream': args.stream,
+                   'memory_budget': args.memory_budget_mb * 1e6,
+                   'shard': None if args.shard is None else parse_shard(args.shard), 'shard_by': args.shard_by,
+                   'shard_timeout': args.shard_timeout, 'smoothing': args.smoothing, 'vertical': args.vertical,
+                   'bin_widths': args.bin_widths, 'archive_dir': args.archive_dir}
+    chunks = args.chunks
+    if chunks is not None and chunks != 'section':
+        chunks = tuple(int(c) for c in chunks.split(','))
+    run_options['write_options'] = {'complevel': args.complevel, 'shuffle': not args.no_shuffle,
+                                    'fixed_time': args.fixed_time, 'chunks': chunks}
+
+    # input directory and output directory from command line arguments
+    input_directory = args.input_directory
+    output_folder = args.output_folder
+    # a THREDDS catalog url, e.g. https://thredds.aodn.org.au/thredds/catalog/IMOS/SOOP/SOOP-XBT/DELAYED/catalog.html,
+    # is crawled through all its sub catalogs, a local path is read directly
+    clean_and_bin_transect([input_directory], output_folder, **run_options)
@@ -1,7 +1,40 @@
+import numpy as np
 import pandas as pd
 import os
+import time
+import threading
+import contextlib
 from pathlib import Path
 
+# the HDF5 library under netCDF4 is not thread safe, so threads open, read, write and close files under this lock
+HDF5_LOCK = threading.Lock()
+# seconds each thread has waited for and held HDF5_LOCK through hdf5_lock, see lock_times
+_LOCK_TIMES = threading.local()
+
+
+def lock_times():
+    """
+    Seconds the calling thread has spent waiting for HDF5_LOCK ('wait') and holding it ('held') through hdf5_lock,
+    running totals to take differences of
+    """
+    if not hasattr(_LOCK_TIMES, 'times'):
+        _LOCK_TIMES.times = {'wait': 0.0, 'held': 0.0}
+    return _LOCK_TIMES.times
+
+
+@contextlib.contextmanager
+def hdf5_lock():
+    """Hold HDF5_LOCK for the block, adding the time waited for it and held to the lock_times of the thread"""
+    t0 = time.perf_counter()
+    with HDF5_LOCK:
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            times = lock_times()
+            times['wait'] += t1 - t0
+            times['held'] += time.perf_counter() - t1
+
 
 def read_globals_config(file_path):
     """
@@ -46,15 +79,59 @@ def read_variables_config(file_path):
 
     return df
 
-def make_transect_id(soop_line, date_like, existing_ids):
+def read_lines_config(file_path):
+    """
+    read the per-line settings from the SOOP lines config file, one row per line plus a 'default' row
+    """
+    p = Path(file_path)
+    if not p.is_absolute():
+        p = Path(os.path.dirname(__file__)) / p
+    p = p.resolve()
+
+    # keep the polygon vertex lists as strings, empty cells are NaN
+    df = pd.read_csv(str(p), dtype={'line': str, 'axis': str, 'polygon_lons': str, 'polygon_lats': str})
+    df['line'] = df['line'].str.strip()
+    return df
+
+def read_data_rules(file_path):
+    """
+    read the bad data and merge rules from the data rules config file, one row per rule
+    """
+    p = Path(file_path)
+    if not p.is_absolute():
+        p = Path(os.path.dirname(__file__)) / p
+    p = p.resolve()
+
+    # keep ids, profile lists and comments as strings, empty cells are NaN
+    text_columns = ['line', 'transect', 'action', 'profiles', 'stations', 'into', 'comment']
+    df = pd.read_csv(str(p), dtype={col: str for col in text_columns})
+    for col in ['line', 'transect', 'action', 'into']:
+        df[col] = df[col].str.strip()
+    return df
+
+def make_transect_id(soop_line, date_like, counters):
     """
     Return a unique transect id like: soop_line-YYYYMM-I
-    where I starts at 1 and increments until the id is not in existing_ids.
+    where I counts the ids made for this soop_line and month, starting at 1.
+    :param counters: dict of (soop_line, YYYYMM): number of ids made so far, updated in place
     """
     yyyymm = pd.to_datetime(date_like).strftime('%Y%m')
-    i = 1
-    while True:
-        candidate = f"{soop_line}-{yyyymm}-{i}"
-        if candidate not in existing_ids:
-            return candidate
-        i += 1
\ No newline at end of file
+    i = counters.get((soop_line, yyyymm), 0) + 1
+    counters[(soop_line, yyyymm)] = i
+    return f"{soop_line}-{yyyymm}-{i}"
+
+
+def make_transect_ids(soop_lines, dates, counters):
+    """
+    Vectorized make_transect_id: return the ids for each (soop_line, date) pair, allocated in order.
+    :param counters: dict of (soop_line, YYYYMM): number of ids made so far, updated in place
+    """
+    keys = pd.DataFrame({'line': np.asarray(soop_lines, dtype=str),
+                         'yyyymm': pd.DatetimeIndex(dates).strftime('%Y%m')})
+    if len(keys) == 0:
+        return np.array([], dtype=str)
+    start = np.array([counters.get(key, 0) for key in zip(keys['line'], keys['yyyymm'])], dtype=int)
+    i = start + keys.groupby(['line', 'yyyymm'], sort=False).cumcount().values + 1
+    for key, last in zip(zip(keys['line'], keys['yyyymm']), i):
+        counters[key] = max(counters.get(key, 0), last)
+    return (keys['line'] + '-' + keys['yyyymm'] + '-' + i.astype(str)).values.astype(str)
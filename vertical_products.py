@@ -0,0 +1,75 @@
+# Vertical products of a run, all computed from one read of each file: the profiles Gaussian smoothed onto the
+# v_grid of the lines config ('gauss', see interp_gaussian) and averaged in depth bins of one or more widths
+# ('bin', see bin_data_10m). The TEMP matrix of the profile store then holds the levels of every product side by
+# side, in the order of the products, and each product is written to a folder of its own.
+import numpy as np
+
+from interp_gaussian import vinterp_batch
+from bin_data_10m import bin_edges, bin_data_batch
+
+VERTICAL_METHODS = ['gauss', 'bin']
+
+
+def product_name(method, bin_width=None):
+    """Name of a product, also the folder it is written to: 'gauss' or e.g. 'bin_5m'"""
+    return method if method == 'gauss' else 'bin_%gm' % bin_width
+
+
+def vertical_products(v_grid, methods=('gauss',), bin_widths=(10,)):
+    """
+    The products of a run.
+    :param v_grid: depths of the Gaussian smoothed product, the bins cover the same depth range
+    :param methods: list of VERTICAL_METHODS
+    :param bin_widths: widths in m of the bins, one 'bin' product for each
+    :return: list of dicts with the 'name', 'method', 'depths' (levels, bin centres for 'bin') and 'bin_width'
+        (None for 'gauss') of each product
+    """
+    products = []
+    for method in methods:
+        if method == 'gauss':
+            products.append({'name': 'gauss', 'method': 'gauss', 'depths': np.asarray(v_grid), 'bin_width': None})
+        elif method == 'bin':
+            for width in bin_widths:
+                edges = bin_edges(np.max(v_grid), width)
+                products.append({'name': product_name('bin', width), 'method': 'bin',
+                                 'depths': edges[:-1] + width / 2, 'bin_width': float(width)})
+        else:
+            raise ValueError('vertical method must be one of %s, got %r' % (VERTICAL_METHODS, method))
+    names = [product['name'] for product in products]
+    if len(set(names)) < len(names):
+        raise ValueError('vertical products given more than once: %s' % names)
+    return products
+
+
+def product_depths(products):
+    """Depth of each column of the TEMP matrix holding all products"""
+    return np.concatenate([product['depths'] for product in products])
+
+
+def product_columns(products):
+    """List of (product, slice of its columns in the TEMP matrix holding all products)"""
+    columns, start = [], 0
+    for product in products:
+        columns.append((product, slice(start, start + len(product['depths']))))
+        start += len(product['depths'])
+    return columns
+
+
+def grid_products(depths, data, products, half_width=11, smoothing='samples'):
+    """
+    All products of a batch of profiles, side by side.
+    :param depths: list of 1D depth arrays, one per profile
+    :param data: list of 1D temperature arrays
+    :param half_width: half width in m of the Gaussian smoothing
+    :param smoothing: smoothing of the 'gauss' product, see interp_gaussian.SMOOTHING_METHODS
+    :return: (n_profiles x len(product_depths(products))) array
+    """
+    grids = []
+    for product in products:
+        if product['method'] == 'gauss':
+            grids.append(vinterp_batch(depths, data, product['depths'], half_width=half_width, smoothing=smoothing))
+        else:
+            edges = np.append(product['depths'] - product['bin_width'] / 2,
+                              product['depths'][-1] + product['bin_width'] / 2)
+            grids.append(bin_data_batch(depths, data, edges))
+    return np.hstack(grids) if grids else np.empty((len(depths), 0))
@@ -1,12 +1,15 @@
 # import a parquet file and write it to a netcdf file
 import os
+import time
 from time import strftime, gmtime
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
 import pandas as pd
 from netCDF4 import Dataset, date2num
-from utils import read_variables_config, read_globals_config
+from utils import read_variables_config, read_globals_config, HDF5_LOCK
 
 def create_filename_output(df):
 
@@ -30,97 +33,217 @@ def create_filename_output(df):
     return filename
 
 
-def write_vert_grid_nc(output_folder, transect_df, data_df, globals_file_path='netcdfGlobalAtts.csv', vars_file_path='netcdfVars.csv'):
+@lru_cache(maxsize=None)
+def load_schema(globals_file_path='netcdfGlobalAtts.csv', vars_file_path='netcdfVars.csv'):
+    """
+    Read the attribute config files once per process.
+    :return: (globals_list, var_atts) where globals_list is the dictionary of global attributes and var_atts maps
+        each variable name to the dictionary of its attributes, leaving out the empty ones.
+        Both are shared between calls, copy globals_list before changing it.
+    """
+    globals_list = read_globals_config(globals_file_path)
+    vars = read_variables_config(vars_file_path)
+
+    # Identify attribute columns starting with 'att_' and remove the 'att_' prefix
+    att_cols = [col for col in vars.columns if col.startswith('att_')]
+    var_atts = {}
+    for _, var_info in vars.iterrows():
+        var_atts[var_info['variable_name']] = {col.replace('att_', ''): var_info[col] for col in att_cols
+                                               if not pd.isna(var_info[col])}
+    return globals_list, var_atts
+
+
+def write_vert_grid_nc(output_folder, transect_df, data_df, globals_file_path='netcdfGlobalAtts.csv',
+                       vars_file_path='netcdfVars.csv', **write_options):
     """output the binned data to the IMOS format netcdf version
     :param output_folder: the folder to write the netcdf file to
     :param transect_df: data frame with transect location and cruise information
     :param data_df: data frame with binned data for TEMP and DEPTH
     :param globals_file_path: path to the global attributes config file
     :param vars_file_path: path to the variable attributes config file
-    :return: None
+    :param write_options: complevel, shuffle, fixed_time and chunks, see write_payload_nc
+    :return: path of the netcdf file
     """
+    payload = {col: transect_df[col].to_numpy() for col in transect_df.columns}
+    payload['TIME'] = pd.to_datetime(transect_df['TIME']).to_numpy()
+    payload['DEPTH'] = data_df.index.to_numpy()
+    payload['TEMP'] = data_df.to_numpy(dtype=np.float32).T
+    return write_payload_nc(output_folder, payload, globals_file_path=globals_file_path,
+                            vars_file_path=vars_file_path, **write_options)
 
-    # now begin write out to new format
-    netcdf_filepath = Path(output_folder) / f"{create_filename_output(transect_df)}.nc"
-    print('Creating output %s' % str(netcdf_filepath))
 
-    # read the variables config file
-    vars = read_variables_config(vars_file_path)
+def write_payload_nc(output_folder, payload, globals_file_path='netcdfGlobalAtts.csv',
+                     vars_file_path='netcdfVars.csv', complevel=0, shuffle=True, fixed_time=False, chunks=None):
+    """
+    Write one transect to the IMOS format netcdf file from its payload of arrays (see profile_store.transect_payload).
+    The defaults give the same file layout as before: an unlimited TIME dimension, default chunks, no compression.
+    :param complevel: zlib compression level of all variables, 0 for no compression
+    :param shuffle: apply the HDF5 shuffle filter before compressing
+    :param fixed_time: make TIME a fixed size dimension instead of an unlimited one
+    :param chunks: chunk shape (TIME, DEPTH) of TEMP, with (TIME,) for the coordinates, or 'section' for one chunk
+        holding the whole transect, which suits readers loading whole sections. None for the library defaults.
+    :return: path of the netcdf file, in the subfolder of output_folder named by the 'product' entry of the payload
+        if it has one (see profile_store.transect_payloads)
+    """
+    output_folder = Path(output_folder) / payload.get('product', '')
+    output_folder.mkdir(parents=True, exist_ok=True)
+    netcdf_filepath = output_folder / f"{create_filename_output(payload)}.nc"
+    print('Creating output %s' % str(netcdf_filepath))
+    # write to a temporary file and rename it once complete, so a crash never leaves a truncated .nc
+    tmp_filepath = netcdf_filepath.with_name(netcdf_filepath.name + '.tmp')
+
+    globals_list, var_atts = load_schema(globals_file_path, vars_file_path)
+    globals_list = dict(globals_list)
+
+    times = pd.DatetimeIndex(payload['TIME'])
+    depth_data = np.asarray(payload['DEPTH'])
+    # change NAN values in TEMP to the missing value
+    temp = np.where(np.isnan(payload['TEMP']), np.float32(-9999.9), payload['TEMP']).astype(np.float32)
+
+    n_time = len(times)
+    if chunks == 'section':
+        chunks = (n_time, len(depth_data))
+    if chunks is not None:
+        chunks = (max(1, min(chunks[0], n_time)), max(1, min(chunks[1], len(depth_data))))
+    compression = {'zlib': complevel > 0, 'complevel': complevel or 4, 'shuffle': shuffle and complevel > 0}
+
+    # add geospatial information to global attributes dictionary
+    globals_list['geospatial_lat_max'] = np.nanmax(payload['LATITUDE'])
+    globals_list['geospatial_lat_min'] = np.nanmin(payload['LATITUDE'])
+    globals_list['geospatial_lon_max'] = np.nanmax(payload['LONGITUDE'])
+    globals_list['geospatial_lon_min'] = np.nanmin(payload['LONGITUDE'])
+    globals_list['geospatial_vertical_max'] = depth_data.max()
+    globals_list['geospatial_vertical_min'] = depth_data.min()
+    # add time coverage information to global attributes dictionary
+    globals_list['time_coverage_start'] = times.min().strftime("%Y-%m-%dT%H:%M:%SZ")
+    globals_list['time_coverage_end'] = times.max().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # Add date created to the global attributes
+    utctime = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
+    globals_list['date_created'] = utctime
+
+    # set the SOOP_line_label, SOOP_line_description and transect_id global attributes
+    globals_list['SOOP_line_label'] = payload['SOOP_line'][0]
+    globals_list['SOOP_line_description'] = payload['SOOP_line_description'][0]
+    globals_list['transect_id'] = payload['transect_id'][0]
+    globals_list['Cruise_ID'] = payload['Cruise_ID'][0]
+
+    try:
+        with HDF5_LOCK, Dataset(str(tmp_filepath), "w", format="NETCDF4") as output_netcdf_obj:
+            # create DEPTH and TIME dimensions
+            output_netcdf_obj.createDimension('DEPTH', len(depth_data))
+            output_netcdf_obj.createDimension('TIME', n_time if fixed_time else None)
+
+            # Create the variables, all coordinates are written in one call each
+            coord_chunks = None if chunks is None else chunks[:1]
+            output_netcdf_obj.createVariable('TIME', 'f8', ('TIME',), chunksizes=coord_chunks, **compression)
+            output_netcdf_obj.createVariable('LATITUDE', 'f8', ('TIME',), chunksizes=coord_chunks, **compression)
+            output_netcdf_obj.createVariable('LONGITUDE', 'f8', ('TIME',), chunksizes=coord_chunks, **compression)
+            output_netcdf_obj.createVariable('TEMP', 'f4', ('TIME', 'DEPTH',), fill_value=np.float32(-9999.9),
+                                             chunksizes=chunks, **compression)
+            output_netcdf_obj.createVariable('DEPTH', 'f4', ('DEPTH',), **compression)
+
+            # set variable attributes
+            for var_name, atts in var_atts.items():
+                output_netcdf_obj.variables[var_name].setncatts(atts)
+
+            output_netcdf_obj.variables['TIME'][:] = date2num(times.to_pydatetime(), units=var_atts['TIME']['units'],
+                                                              calendar=var_atts['TIME']['calendar'])
+            output_netcdf_obj.variables['LATITUDE'][:] = payload['LATITUDE']
+            output_netcdf_obj.variables['LONGITUDE'][:] = payload['LONGITUDE']
+            output_netcdf_obj.variables['TEMP'][:, :] = temp
+            output_netcdf_obj.variables['DEPTH'][:] = depth_data
+
+            # set the global attributes where the index is the attribute name
+            for att_name, att_value in globals_list.items():
+                # if the global_att[att_name] is None, replace with 'Unknown'
+                if pd.isna(att_value):
+                    att_value = 'Unknown'
+                output_netcdf_obj.setncattr(att_name, att_value)
+        os.replace(tmp_filepath, netcdf_filepath)
+    except BaseException:
+        if tmp_filepath.exists():
+            os.remove(tmp_filepath)
+        raise
+    return netcdf_filepath
+
+
+def write_transect(output_folder, payload, globals_file_path='netcdfGlobalAtts.csv', vars_file_path='netcdfVars.csv',
+                   write_options=None):
+    """
+    Write one transect from its payload of arrays (see profile_store.transect_payload).
+    :param write_options: dictionary of keyword arguments of write_payload_nc (complevel, shuffle, fixed_time, chunks)
+    :return: dict of write metrics: transect_id, product (empty without one), n_profiles, write_seconds and bytes
+        of the file
+    """
+    t0 = time.perf_counter()
+    netcdf_filepath = write_payload_nc(output_folder, payload, globals_file_path=globals_file_path,
+                                       vars_file_path=vars_file_path, **(write_options or {}))
+    return {'transect_id': str(payload['transect_id'][0]), 'product': payload.get('product', ''),
+            'n_profiles': len(payload['TIME']),
+            'write_seconds': time.perf_counter() - t0, 'bytes': os.path.getsize(netcdf_filepath)}
 
-    # read the global attributes config file
-    globals_list = read_globals_config(globals_file_path)
 
-    # Identify attribute columns starting with 'att_'
-    att_cols = [col for col in vars.columns if col.startswith('att_')]
-    # remove the 'att_' prefix from the attribute columns
-    att_labels = [col.replace('att_', '') for col in att_cols]
-
-    with Dataset(str(netcdf_filepath), "w", format="NETCDF4") as output_netcdf_obj:
-        # Create the dimensions from the size of the data DataFrame
-        depth_data = data_df.index.values
-
-        # transform the TIME data to datetime objects in the dataframe
-        transect_df['TIME'] = pd.to_datetime(transect_df['TIME'])
-        # create DEPTH and TIME dimensions
-        output_netcdf_obj.createDimension('DEPTH', len(depth_data))
-        output_netcdf_obj.createDimension('TIME', None)
-
-        # Create the variables from the vars Dataframe
-        output_netcdf_obj.createVariable('TIME', 'f8', ('TIME',))
-        output_netcdf_obj.createVariable('LATITUDE', 'f8', ('TIME',))
-        output_netcdf_obj.createVariable('LONGITUDE', 'f8', ('TIME',))
-        output_netcdf_obj.createVariable('TEMP', 'f4', ('TIME', 'DEPTH',), fill_value=np.float32(-9999.9))
-        output_netcdf_obj.createVariable('DEPTH', 'f4', ('DEPTH',))
-
-        # change NAN values in data_df to the missing value
-        data_df = data_df.fillna(np.float32(-9999.9))
-
-        # set variable attributes
-        for var_name in vars['variable_name']:
-            var_obj = output_netcdf_obj.variables[var_name]
-            var_info = vars[vars['variable_name'] == var_name].iloc[0]
-            # set attributes from the att_* columns
-            for att_label, att_col in zip(att_labels, att_cols):
-                att_value = var_info[att_col]
-                if pd.isna(att_value):
-                    continue
-                var_obj.setncattr(att_label, att_value)
-
-        # append the data to the file
-        # first locate v in either transect_df or data_df
-        for i, t in enumerate(transect_df['TIME']):
-            output_netcdf_obj.variables['TIME'][i] = date2num(t, units=output_netcdf_obj.variables['TIME'].units,
-                                                             calendar=output_netcdf_obj.variables['TIME'].calendar)
-            output_netcdf_obj.variables['LATITUDE'][i] = transect_df['LATITUDE'].iloc[i]
-            output_netcdf_obj.variables['LONGITUDE'][i] = transect_df['LONGITUDE'].iloc[i]
-        output_netcdf_obj.variables['TEMP'][:,:] = data_df.values.T
-        output_netcdf_obj.variables['DEPTH'][:] = depth_data
-
-
-        # add geospatial information to global attributes dictionary
-        globals_list['geospatial_lat_max'] = transect_df['LATITUDE'].max()
-        globals_list['geospatial_lat_min'] = transect_df['LATITUDE'].min()
-        globals_list['geospatial_lon_max'] = transect_df['LONGITUDE'].max()
-        globals_list['geospatial_lon_min'] = transect_df['LONGITUDE'].min()
-        globals_list['geospatial_vertical_max'] = max(depth_data)
-        globals_list['geospatial_vertical_min'] = min(depth_data)
-        # add time coverage information to global attributes dictionary
-        globals_list['time_coverage_start'] = min(transect_df['TIME']).strftime("%Y-%m-%dT%H:%M:%SZ")
-        globals_list['time_coverage_end'] = max(transect_df['TIME']).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        # Add date created to the global attributes
-        utctime = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
-        globals_list['date_created'] = utctime
-
-        # set the SOOP_line_label, SOOP_line_description and transect_id global attributes
-        globals_list['SOOP_line_label'] = transect_df['SOOP_line'].iloc[0]
-        globals_list['SOOP_line_description'] = transect_df['SOOP_line_description'].iloc[0]
-        globals_list['transect_id'] = transect_df['transect_id'].iloc[0]
-        globals_list['Cruise_ID'] = transect_df['Cruise_ID'].iloc[0]
-
-        # set the global attributes where the index is the attribute name
-        for att_name, att_value in globals_list.items():
-            # if the global_att[att_name] is None, replace with 'Unknown'
-            if pd.isna(att_value):
-                att_value = 'Unknown'
-            output_netcdf_obj.setncattr(att_name, att_value)
+def write_transects(output_folder, payloads, workers=2, queue_depth=None, backend='thread',
+                    globals_file_path='netcdfGlobalAtts.csv', vars_file_path='netcdfVars.csv', write_options=None):
+    """
+    Write transects from an iterable of payloads through a pool of writers, so the payloads are assembled
+    while earlier ones are written. At most queue_depth payloads are waiting or being written at a time,
+    which bounds the memory held by the pipeline.
+    :param payloads: iterable of payloads (see profile_store.transect_payload), e.g. a generator assembling them
+    :param workers: number of writers
+    :param queue_depth: maximum number of payloads in flight, defaults to twice the number of writers
+    :param backend: 'thread' for writer threads, which take turns in the HDF5 library (see utils.HDF5_LOCK) and
+        overlap writing with the assembly of the next payloads, or 'process' to create files in parallel
+    :param write_options: dictionary of keyword arguments of write_payload_nc (complevel, shuffle, fixed_time, chunks)
+    :return: DataFrame of per-transect metrics: transect_id, product, n_profiles, assemble_seconds, write_seconds
+        (in the writer, including any wait for the HDF5 lock) and bytes, with the wall time of the whole stage
+        in metrics.attrs['wall_seconds']
+    """
+    if backend == 'thread':
+        executor_class = ThreadPoolExecutor
+    elif backend == 'process':
+        executor_class = ProcessPoolExecutor
+    else:
+        raise ValueError("backend must be 'thread' or 'process', got %r" % backend)
+    queue_depth = queue_depth or 2 * workers
+
+    metrics = []
+    assemble_seconds = {}
+    start = time.perf_counter()
+    with executor_class(max_workers=workers) as executor:
+        pending = set()
+        payloads = iter(payloads)
+        while True:
+            t0 = time.perf_counter()
+            payload = next(payloads, None)
+            if payload is None:
+                break
+            key = (str(payload['transect_id'][0]), payload.get('product', ''))
+            assemble_seconds[key] = time.perf_counter() - t0
+            if len(pending) >= queue_depth:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                metrics.extend(future.result() for future in done)
+            pending.add(executor.submit(write_transect, output_folder, payload, globals_file_path, vars_file_path,
+                                           write_options))
+        metrics.extend(future.result() for future in pending)
+
+    metrics = pd.DataFrame(metrics, columns=['transect_id', 'product', 'n_profiles', 'write_seconds', 'bytes'])
+    metrics.insert(3, 'assemble_seconds', [assemble_seconds.get(key) for key in
+                                           zip(metrics['transect_id'], metrics['product'])])
+    metrics.attrs['wall_seconds'] = time.perf_counter() - start
+    return metrics
+
+
+def print_write_metrics(metrics, n_slowest=5):
+    """Print a summary of the metrics of write_transects"""
+    if len(metrics) == 0:
+        return
+    print(f"Wrote {len(metrics)} transects, {metrics['n_profiles'].sum()} profiles, "
+          f"{metrics['bytes'].sum() / 1e6:.1f} MB in {metrics.attrs.get('wall_seconds', np.nan):.2f} s: write time total {metrics['write_seconds'].sum():.2f} s, "
+          f"mean {metrics['write_seconds'].mean() * 1000:.1f} ms, max {metrics['write_seconds'].max() * 1000:.1f} ms")
+    slowest = metrics.nlargest(n_slowest, 'write_seconds')
+    for row in slowest.itertuples():
+        name = row.transect_id if not row.product else '%s/%s' % (row.product, row.transect_id)
+        print(f"  {name}: {row.write_seconds * 1000:.1f} ms, {row.n_profiles} profiles, "
+              f"{row.bytes / 1e3:.0f} kB")